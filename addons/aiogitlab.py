@@ -0,0 +1,40 @@
+# -*- coding: utf8 -*-
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncGitLabApi(object):
+    '''
+        asyncio front of GitLabApi for the AsyncIRCBot orders: every api
+        method becomes a coroutine function.
+
+            api = AsyncGitLabApi(gitlab.GitLabApi(baseurl, token))
+            projects = await api.get_projects()
+
+        At most max_in_flight calls run at once, in a dedicated thread pool,
+        the other ones wait on the loop without holding a thread.
+    '''
+    def __init__(self, gitlab_api, max_in_flight=10):
+        self.gitlab_api = gitlab_api
+
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_in_flight)
+
+    def __getattr__(self, name):
+        method = getattr(self.gitlab_api, name)
+        if not callable(method):
+            return method
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            async with self._semaphore:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._executor,
+                    functools.partial(method, *args, **kwargs))
+
+        return call
+
+    def close(self):
+        self._executor.shutdown(wait=False)
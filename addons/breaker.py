@@ -0,0 +1,93 @@
+# -*- coding: utf8 -*-
+
+import time
+import unittest
+
+
+class CircuitBreaker(object):
+    '''
+        Closed, calls go through until `failures` of them fail in a row,
+        which opens the breaker: calls are refused for reset_timeout
+        seconds, then one trial call goes through (half open). Its success
+        closes the breaker, its failure opens it again. If the trial never
+        reports, another one is allowed reset_timeout seconds later.
+    '''
+    def __init__(self, failures=5, reset_timeout=30, clock=time.time):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+
+        self._clock = clock
+        self._failed = 0
+        self._opened = None
+
+    def allow(self):
+        if self.state == 'closed':
+            return True
+
+        now = self._clock()
+        if now - self._opened >= self.reset_timeout:
+            self.state = 'half_open'
+            self._opened = now
+            return True
+
+        return False
+
+    def success(self):
+        self.state = 'closed'
+        self._failed = 0
+
+    def failure(self):
+        self._failed += 1
+        if self.state == 'half_open' or self._failed >= self.failures:
+            self.state = 'open'
+            self._opened = self._clock()
+
+
+class testCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.breaker = CircuitBreaker(3, 10, clock=lambda: self.now)
+
+    def testTrip(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.allow())
+
+    def testHalfOpen(self):
+        for _ in range(3):
+            self.breaker.failure()
+
+        self.now += 10
+        self.assertTrue(self.breaker.allow())
+        # one trial at a time
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.failure()
+        self.assertFalse(self.breaker.allow())
+
+        self.now += 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertTrue(self.breaker.allow())
+
+    def testLostTrial(self):
+        for _ in range(3):
+            self.breaker.failure()
+
+        self.now += 10
+        self.assertTrue(self.breaker.allow())
+        self.now += 10
+        self.assertTrue(self.breaker.allow())
+
+
+if __name__ == '__main__':
+    unittest.main()
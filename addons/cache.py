@@ -1,7 +1,11 @@
 # -*- coding: utf8 -*-
 
+import sys
 import time
+import heapq
+import itertools
 import unittest
+from collections import OrderedDict
 
 class Cacher(object):
     def __init__(self, expired=3600):
@@ -34,6 +38,197 @@ class Cacher(object):
         self._cached_data[key] = dict.fromkeys(['value', 'timestamp'])
 
 
+def deep_sizeof(value):
+    '''
+        Rough size in bytes of value and of what it contains, for the json
+        like values we cache.
+    '''
+    size = sys.getsizeof(value)
+
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += deep_sizeof(key) + deep_sizeof(item)
+
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += deep_sizeof(item)
+
+    return size
+
+
+class LRUCacher(object):
+    '''
+        Bounded replacement of Cacher, with the same get/set/retire/refresh
+        api.
+
+        At most max_entries entries, and/or max_bytes bytes (as estimated
+        by sizeof), are kept: the least recently used ones are evicted
+        first. Expired entries are removed when they are read, and each
+        get or set removes at most sweep_batch more, the first to expire.
+        set takes an optional per-key ttl, defaulting to expired.
+
+        Expired entries are kept grace more seconds, for get_stale.
+    '''
+    def __init__(self, expired=3600, max_entries=None, max_bytes=None,
+            sweep_batch=16, sizeof=deep_sizeof, clock=time.time, grace=0):
+        self.expired = expired
+        self.grace = grace
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_batch = sweep_batch
+
+        self._sizeof = sizeof
+        self._clock = clock
+
+        # key => [value, expiration timestamp, size], least recently used first
+        self._cached_data = OrderedDict()
+        self.size = 0
+        # heap of (expiration timestamp, sequence, key), entries of keys
+        # set again or removed are skipped when they come up
+        self._expirations = []
+        self._sequence = itertools.count()
+
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self.stale_hits = 0
+
+    def __len__(self):
+        return len(self._cached_data)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, count=True):
+        found = self._lookup(key)
+        if found is None or not found[1]:
+            if count:
+                self.misses += 1
+            return None
+
+        if count:
+            self.hits += 1
+        return found[0]
+
+    def get_stale(self, key):
+        '''
+            Return (value, fresh), value may have expired less than grace
+            seconds ago, or None.
+        '''
+        found = self._lookup(key)
+        if found is None:
+            self.misses += 1
+        elif found[1]:
+            self.hits += 1
+        else:
+            self.stale_hits += 1
+
+        return found
+
+    def _lookup(self, key):
+        now = self._clock()
+        self._expire(now, self.sweep_batch)
+
+        entry = self._cached_data.pop(key, None)
+        if entry is None:
+            return None
+
+        if now >= entry[1] + self.grace:
+            self.size -= entry[2]
+            self.expirations += 1
+            return None
+
+        # most recently used entries are at the end
+        self._cached_data[key] = entry
+
+        return entry[0], now < entry[1]
+
+    def set(self, key, value, ttl=None):
+        now = self._clock()
+        self._expire(now, self.sweep_batch)
+
+        old = self._cached_data.pop(key, None)
+        if old is not None:
+            self.size -= old[2]
+
+        size = self._sizeof(value) if self.max_bytes is not None else 0
+        expires = now + (self.expired if ttl is None else ttl)
+
+        self._cached_data[key] = [value, expires, size]
+        self.size += size
+        heapq.heappush(self._expirations, (expires, next(self._sequence), key))
+
+        self._evict()
+
+        # keys set again, and the evicted ones, leave entries behind
+        if len(self._expirations) > 2 * len(self._cached_data) + 100:
+            self._expirations = [(entry[1], next(self._sequence), key)
+                for key, entry in self._cached_data.items()]
+            heapq.heapify(self._expirations)
+
+    def refresh(self):
+        self._cached_data.clear()
+        self.size = 0
+        self._expirations = []
+
+    def retire(self, key):
+        entry = self._cached_data.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def entries(self):
+        ''' (key, value, expiration timestamp) of every entry, LRU first. '''
+        return [(key, entry[0], entry[1])
+            for key, entry in self._cached_data.items()]
+
+    def restore(self, key, value, expires):
+        ''' set, with the expiration timestamp of an entries() item. '''
+        self.set(key, value, ttl=expires - self._clock())
+
+    def stats(self):
+        return {
+            'entries': len(self._cached_data),
+            'bytes': self.size,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    def sweep(self, now=None):
+        ''' Remove every expired entry. '''
+        if now is None:
+            now = self._clock()
+
+        self._expire(now, None)
+
+    def _expire(self, now, limit):
+        ''' Remove at most limit (None for all) expired entries. '''
+        expirations = self._expirations
+        while expirations and now >= expirations[0][0] + self.grace:
+            if limit is not None:
+                if limit <= 0:
+                    return
+                limit -= 1
+
+            expires, _, key = heapq.heappop(expirations)
+            entry = self._cached_data.get(key)
+            if entry is None or entry[1] != expires:
+                continue
+
+            del self._cached_data[key]
+            self.size -= entry[2]
+            self.expirations += 1
+
+    def _evict(self):
+        while self._cached_data and (
+                (self.max_entries is not None and
+                    len(self._cached_data) > self.max_entries) or
+                (self.max_bytes is not None and self.size > self.max_bytes)):
+            key, entry = self._cached_data.popitem(last=False)
+            self.size -= entry[2]
+            self.evictions += 1
+
+
 class testCacher(unittest.TestCase):
     def setUp(self):
         """
@@ -71,5 +266,95 @@ class testCacher(unittest.TestCase):
         self.assertIsNone(self.cache.get(self.key))
 
 
+class testLRUCacher(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.cache = LRUCacher(10, max_entries=3, sweep_batch=2,
+            clock=lambda: self.now)
+
+    def testGetSet(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def testExpiry(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2, ttl=20)
+
+        self.now = 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), 2)
+        self.assertEqual(len(self.cache), 1)
+
+    def testGrace(self):
+        self.cache.grace = 5
+        self.cache.set('a', 1)
+
+        self.now = 12
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get_stale('a'), (1, False))
+
+        self.now = 15
+        self.assertIsNone(self.cache.get_stale('a'))
+        self.assertEqual(len(self.cache), 0)
+
+    def testSweep(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+
+        self.now = 100
+        self.cache.set('c', 3)
+        self.assertEqual(list(self.cache._cached_data), ['c'])
+        self.assertEqual(self.cache.expirations, 2)
+
+    def testSweepBounded(self):
+        cache = LRUCacher(10, sweep_batch=2, clock=lambda: self.now)
+        for i in range(5):
+            cache.set(i, i, ttl=i + 1)
+        # set again, the former expiration is skipped
+        cache.set(0, 0, ttl=50)
+
+        self.now = 20
+        cache.get('missing')
+        self.assertEqual(len(cache), 4)
+        cache.get('missing')
+        self.assertEqual(len(cache), 2)
+
+        cache.sweep()
+        self.assertEqual(list(cache._cached_data), [0])
+        self.assertEqual(cache.expirations, 4)
+
+    def testLRUEviction(self):
+        for key in 'abc':
+            self.cache.set(key, key)
+
+        self.cache.get('a')
+        self.cache.set('d', 'd')
+
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 'a')
+        self.assertEqual(self.cache.evictions, 1)
+
+    def testByteBudget(self):
+        cache = LRUCacher(10, max_bytes=10, sizeof=len, clock=lambda: self.now)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'yyyy')
+        cache.set('c', 'zzzz')
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.size, 8)
+
+    def testRetireRefresh(self):
+        self.cache.set('a', 1)
+        self.cache.retire('a')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+
+        self.cache.set('a', 1)
+        self.cache.refresh()
+        self.assertEqual(len(self.cache), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,179 @@
+# -*- coding: utf8 -*-
+
+import re
+import heapq
+import unittest
+
+
+_words = re.compile(r'\w+', re.UNICODE)
+
+
+def words(text):
+    return set(_words.findall((text or '').lower()))
+
+
+class CommitIndex(object):
+    '''
+        Inverted index of the commits of all projects: the words of their
+        title, author name and project name => the commits holding them.
+
+        At most max_commits commits are kept, the oldest ones (by
+        created_at) are dropped first, whichever project they belong to.
+    '''
+    def __init__(self, max_commits=50000):
+        self.max_commits = max_commits
+
+        # (project id, sha) => (short sha, title, author, project name,
+        # created at)
+        self._commits = {}
+        # word => set of (project id, sha)
+        self._words = {}
+        # heap of (created at, (project id, sha)), entries of removed
+        # commits are skipped when they come up
+        self._ages = []
+
+    def __len__(self):
+        return len(self._commits)
+
+    def __contains__(self, key):
+        return key in self._commits
+
+    def add(self, project_id, project_name, commit):
+        ''' Index a commit, as returned by the commits api. '''
+        key = (project_id, commit['id'])
+        if key in self._commits:
+            return
+
+        entry = (commit.get('short_id') or commit['id'][:11],
+            commit.get('title') or '', commit.get('author_name') or '',
+            project_name or '', commit.get('created_at') or '')
+        self._commits[key] = entry
+        heapq.heappush(self._ages, (entry[4], key))
+
+        for word in self._entry_words(entry):
+            self._words.setdefault(word, set()).add(key)
+
+        if self.max_commits is not None:
+            while len(self._commits) > self.max_commits:
+                self.remove(heapq.heappop(self._ages)[1])
+
+        # removed projects leave entries behind
+        if len(self._ages) > 2 * len(self._commits) + 100:
+            self._ages = [(self._commits[key][4], key)
+                for key in self._commits]
+            heapq.heapify(self._ages)
+
+    def add_commits(self, project_id, project_name, commits):
+        ''' Index commits listed newest first, as by the commits api. '''
+        for commit in reversed(list(commits)):
+            self.add(project_id, project_name, commit)
+
+    def remove(self, key):
+        entry = self._commits.pop(key, None)
+        if entry is None:
+            return
+
+        for word in self._entry_words(entry):
+            keys = self._words.get(word)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self._words[word]
+
+    def remove_project(self, project_id):
+        for key in [key for key in self._commits if key[0] == project_id]:
+            self.remove(key)
+
+    def search(self, text, limit=20):
+        '''
+            Commits holding every word of text, newest first, as dicts
+            with project_id, short_id, title, author_name, project_name
+            and created_at.
+        '''
+        found = None
+        # the rarest words first, the intersection only shrinks
+        for word in sorted(words(text), key=lambda word: len(
+                self._words.get(word, ()))):
+            keys = self._words.get(word)
+            if not keys:
+                return []
+
+            found = set(keys) if found is None else found & keys
+            if not found:
+                return []
+
+        if not found:
+            return []
+
+        entries = sorted(found, reverse=True,
+            key=lambda key: self._commits[key][4])[:limit]
+
+        return [dict(zip(('short_id', 'title', 'author_name', 'project_name',
+            'created_at'), self._commits[key]), project_id=key[0])
+            for key in entries]
+
+    def _entry_words(self, entry):
+        return words(entry[1]) | words(entry[2]) | words(entry[3])
+
+
+class testCommitIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = CommitIndex(max_commits=4)
+        self.index.add_commits(1, 'ircbot', [
+            {'id': 'c' * 40, 'title': 'Fix the reconnect backoff',
+                'author_name': 'xpen', 'created_at': '2013-03-03'},
+            {'id': 'b' * 40, 'title': 'Add the search order',
+                'author_name': 'Jordi', 'created_at': '2013-02-02'},
+        ])
+        self.index.add(2, 'browser', {'id': 'a' * 40,
+            'title': 'Fix rendering', 'author_name': 'xpen',
+            'created_at': '2013-01-01'})
+
+    def titles(self, text):
+        return [commit['title'] for commit in self.index.search(text)]
+
+    def testSearch(self):
+        self.assertEqual(self.titles('fix'),
+            ['Fix the reconnect backoff', 'Fix rendering'])
+        self.assertEqual(self.titles('FIX xpen ircbot'),
+            ['Fix the reconnect backoff'])
+        self.assertEqual(self.titles('fix jordi'), [])
+        self.assertEqual(self.titles(''), [])
+
+        commit = self.index.search('search')[0]
+        self.assertEqual(commit['project_id'], 1)
+        self.assertEqual(commit['short_id'], 'b' * 11)
+
+    def testBounded(self):
+        self.index.add(2, 'browser', {'id': 'a' * 40, 'title': 'Fix rendering'})
+        self.assertEqual(len(self.index), 3)
+
+        self.index.add(2, 'browser', {'id': 'd' * 40, 'title': 'One',
+            'created_at': '2013-04-04'})
+        self.index.add(3, 'idle', {'id': 'e' * 40, 'title': 'Two',
+            'created_at': '2012-12-12'})
+        self.assertEqual(len(self.index), 4)
+        # older than all the others, whatever the indexing order
+        self.assertNotIn((3, 'e' * 40), self.index)
+        self.assertIn((2, 'a' * 40), self.index)
+
+        self.index.add(3, 'idle', {'id': 'f' * 40, 'title': 'Three',
+            'created_at': '2013-05-05'})
+        self.assertNotIn((2, 'a' * 40), self.index)
+        self.assertEqual(self.titles('rendering'), [])
+        self.assertNotIn('rendering', self.index._words)
+
+        self.index.remove_project(1)
+        self.index.add(3, 'idle', {'id': 'g' * 40, 'title': 'Four',
+            'created_at': '2011-01-01'})
+        self.assertEqual(len(self.index), 3)
+
+    def testRemoveProject(self):
+        self.index.remove_project(1)
+        self.assertEqual(self.titles('fix'), ['Fix rendering'])
+        self.assertNotIn('ircbot', self.index._words)
+
+
+if __name__ == '__main__':
+    unittest.main()
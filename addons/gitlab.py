@@ -1,6 +1,63 @@
 # -*- coding: utf8 -*-
 
+import time
+import json
+import threading
+import unittest
+
+try:
+    from urlparse import urlparse
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlparse, urlencode
+
 import requests
+from requests.structures import CaseInsensitiveDict
+
+try:
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    # requests < 1.0, the pool is configured through session.config
+    HTTPAdapter = None
+
+from addons import cache
+from addons.breaker import CircuitBreaker
+from metrics import registry
+
+
+# in-flight requests limits, shared by every GitLabApi talking to a host
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+
+def host_slots(url, max_in_flight):
+    host = urlparse(url).netloc
+
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(max_in_flight)
+
+        return _host_slots[host]
+
+
+# segments following these ones are ids, names or shas
+_id_after = frozenset(['projects', 'users', 'branches', 'commits', 'tags'])
+
+
+def endpoint_label(api_url):
+    ''' api_url with its ids replaced, as projects/:id/repository/commits '''
+    parts = api_url.split('/')
+    for i in range(1, len(parts)):
+        if parts[i - 1] in _id_after:
+            parts[i] = ':id'
+
+    return '/'.join(parts)
+
+
+def response_json(res):
+    ''' The parsed body: json is a property before requests 1.0, a method since. '''
+    return res.json() if callable(res.json) else res.json
+
 
 def raiseExceptionOn40X(func):
     def wrapper(*args, **kwargs):
@@ -14,6 +71,20 @@ def raiseExceptionOn40X(func):
     return wrapper
 
 
+class CachedResponse(object):
+    '''
+        Response of a GET whose body has been parsed once, and kept with
+        its validators (ETag/Last-Modified) for the next conditional GET.
+        from_cache is True if it answers a 304 Not Modified.
+    '''
+    def __init__(self, status_code, headers, json, from_cache=False):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = headers
+        self.json = json
+        self.from_cache = from_cache
+
+
 class NotFoundException(BaseException):
     ''' {"message":"404 Not Found"} '''
     pass
@@ -28,14 +99,66 @@ class UnauthorizeException(BaseException):
     pass
 
 
+class UnavailableException(BaseException):
+    '''
+        The circuit breaker of the endpoint is open, after too many
+        failures in a row, and there is no former response to serve.
+    '''
+    pass
+
+
+# everything a GitLabApi call may raise, the exceptions above derive
+# from BaseException so `except Exception` doesn't catch them
+api_errors = (Exception, NotFoundException, UnauthorizeException,
+    UnavailableException)
+
+
 class GitLabApi(object):
     '''
         api wrapper for gitlab:
         https://github.com/gitlabhq/gitlabhq/tree/master/doc/api
     '''
-    def __init__(self, api_baseurl, private_token):
+    def __init__(self, api_baseurl, private_token, max_in_flight=10,
+            pool_size=10, max_validators=1000, timeout=10,
+            breaker_failures=5, breaker_reset=30):
         self.private_token = private_token
         self.api_baseurl = api_baseurl
+
+        # seconds to connect, and between two bytes of the response
+        self.timeout = timeout
+
+        # endpoint => CircuitBreaker, while one is open its GETs are
+        # answered with the last response, if any
+        self._breakers = {}
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+
+        # keep-alive connections, with the token sent as a header
+        self.session = requests.session()
+        self.session.headers['PRIVATE-TOKEN'] = private_token
+
+        if HTTPAdapter is not None:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        else:
+            self.session.config['pool_maxsize'] = pool_size
+            self.session.config['keep_alive'] = True
+
+        self._slots = host_slots(api_baseurl, max_in_flight)
+
+        # url => (etag, last modified, headers, parsed body, size, parse time)
+        # of the last response with validators, for the max_validators
+        # urls used last
+        self._validators = cache.LRUCacher(365 * 24 * 3600, max_validators)
+        self.conditional_stats = {
+            'requests': 0,
+            'not_modified': 0,
+            'bytes_saved': 0,
+            'parse_seconds_saved': 0.0,
+        }
+
+        self.metrics = registry
     
     # NOTE: project apis #
     def get_projects(self):
@@ -46,6 +169,13 @@ class GitLabApi(object):
         res = self.call('projects')
         return res
 
+    def iter_projects(self, per_page=100):
+        '''
+            Same as get_projects, yielding the projects of every page as
+            each page arrives.
+        '''
+        return self.paginate('projects', per_page)
+
     def get_single_project(self, project_id):
         '''
             Get a specific project, identified by project ID, 
@@ -59,7 +189,7 @@ class GitLabApi(object):
     def get_project_name_by_pid(self, project_id):
         project = self.get_single_project(project_id)
 
-        return project.json['name']
+        return response_json(project)['name']
 
     def get_project_members(self, project_id):
         '''
@@ -80,6 +210,14 @@ class GitLabApi(object):
         res = self.call('projects/%s/repository/branches' % project_id)
         return res
 
+    def iter_project_branches(self, project_id, per_page=100):
+        '''
+            Same as get_project_branches, yielding the branches of every
+            page as each page arrives.
+        '''
+        return self.paginate('projects/%s/repository/branches' % project_id,
+            per_page)
+
     def get_project_single_branch(self, project_id, branch):
         '''
             Get a single project repository branch.
@@ -101,17 +239,46 @@ class GitLabApi(object):
         res = self.call('projects/%s/repository/tags' % project_id)
         return res
 
-    def get_project_commits(self, project_id, ref_name=None):
+    def iter_project_tags(self, project_id, per_page=100):
+        '''
+            Same as get_project_tags, yielding the tags of every page as
+            each page arrives.
+        '''
+        return self.paginate('projects/%s/repository/tags' % project_id,
+            per_page)
+
+    def get_project_commits(self, project_id, ref_name=None, since=None):
         '''
             Get a list of repository commits in a project.
             api: GET /projects/:id/repository/commits
             parameters: 
                 id (required) - The ID or code name of a project
                 ref_name (optional) - The name of a repository branch or tag
+                since (optional) - Only commits after or on this date
+                    (ISO 8601) are returned
         '''
-        res = self.call('projects/%s/repository/commits' % project_id)
+        params = {}
+        if ref_name:
+            params['ref_name'] = ref_name
+        if since:
+            params['since'] = since
+
+        res = self.call('projects/%s/repository/commits' % project_id,
+            params=params or None)
         return res
 
+    def iter_project_commits(self, project_id, ref_name=None, per_page=100):
+        '''
+            Same as get_project_commits, yielding the commits of every page
+            as each page arrives.
+        '''
+        params = {}
+        if ref_name:
+            params['ref_name'] = ref_name
+
+        return self.paginate('projects/%s/repository/commits' % project_id,
+            per_page, **params)
+
     def get_raw_blob_content(self, project_id, sha, filepath):
         '''
             Get the raw file contents for a file. 
@@ -149,19 +316,338 @@ class GitLabApi(object):
         res = self.call('users/%s' % uid)
         return res
 
+    def paginate(self, api_url, per_page=100, **params):
+        '''
+            Yield the items of a list api, following the page/per_page
+            parameters. Only one page is held in memory at a time.
+
+            There is a next page if the Link header says so, or without
+            Link header, if the page is full.
+        '''
+        params['per_page'] = per_page
+        page = 1
+
+        while True:
+            params['page'] = page
+            res = self.call(api_url, params=params)
+
+            items = response_json(res)
+            for item in items:
+                yield item
+
+            link = res.headers.get('link')
+            if link is not None:
+                if 'rel="next"' not in link:
+                    return
+            elif len(items) < per_page:
+                return
+
+            page += 1
+
     @raiseExceptionOn40X
     def call(self, api_url, http_method='GET', **kwargs):
         res = None
-        url = self.api_baseurl + api_url + '?private_token=' + self.private_token
+        url = self.api_baseurl + api_url
+
+        if http_method not in ('GET', 'POST'):
+            result = 'Http Method' + http_method + ' unsupported'
+            raise Exception(result)
+
+        endpoint = endpoint_label(api_url)
+        params = kwargs.get('params')
+
+        breaker = self._breaker(endpoint)
+        if not breaker.allow():
+            # fail fast, without holding a slot
+            self.metrics.inc('gitlab_short_circuits_total', endpoint=endpoint)
+            return self._degraded(http_method, url, params,
+                UnavailableException('GitLab %s is unavailable' % endpoint))
+
+        queued = time.time()
+
+        with self._slots:
+            start = time.time()
+            self.metrics.observe('gitlab_slot_wait_seconds', start - queued)
 
-        if http_method == 'GET':
-            res = requests.get(url)
+            try:
+                if http_method == 'GET':
+                    res = self._conditional_get(url, params)
 
-        elif http_method == 'POST':
-            res = requests.post(url, data=kwargs['data'])
+                else:
+                    res = self.session.post(url, data=kwargs['data'],
+                        timeout=self.timeout)
+            except Exception as e:
+                # timeouts and connection errors
+                self.metrics.inc('gitlab_errors_total', endpoint=endpoint)
+                breaker.failure()
+                return self._degraded(http_method, url, params, e)
 
+        self.metrics.observe('gitlab_request_seconds', time.time() - start,
+            endpoint=endpoint, method=http_method)
+
+        status = 304 if getattr(res, 'from_cache', False) else res.status_code
+        self.metrics.inc('gitlab_responses_total', endpoint=endpoint,
+            status=status)
+
+        if res.status_code >= 500:
+            breaker.failure()
+            stale = self._stale_response(http_method, url, params)
+            if stale is not None:
+                return stale
         else:
-            result = 'Http Method' + http_method + ' unsupported'
-            raise Exception(result)
+            breaker.success()
 
         return res
+
+    def _breaker(self, endpoint):
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            breaker = self._breakers[endpoint] = CircuitBreaker(
+                self.breaker_failures, self.breaker_reset)
+
+        return breaker
+
+    def _degraded(self, http_method, url, params, error):
+        ''' The last response to a failed GET, else raise error. '''
+        stale = self._stale_response(http_method, url, params)
+        if stale is None:
+            raise error
+
+        return stale
+
+    def _stale_response(self, http_method, url, params):
+        if http_method != 'GET':
+            return None
+
+        cached = self._validators.get(self._validators_key(url, params))
+        if cached is None:
+            return None
+
+        self.metrics.inc('gitlab_stale_responses_total')
+        return CachedResponse(200, cached[2], cached[3], from_cache=True)
+
+    # parameters of one-off queries: the next one asks another `since`,
+    # their responses are not kept
+    one_off_params = ('since',)
+
+    def _validators_key(self, url, params=None):
+        key = url
+        if params:
+            key += '?' + urlencode(sorted(params.items()))
+
+        return key
+
+    def _conditional_get(self, url, params=None):
+        '''
+            GET url, sending the validators of its last response: on a 304,
+            the body parsed then is returned again.
+        '''
+        key = self._validators_key(url, params)
+
+        headers = {}
+        cached = self._validators.get(key)
+        if cached is not None:
+            etag, last_modified = cached[:2]
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        res = self.session.get(url, params=params, headers=headers,
+            timeout=self.timeout)
+        self.conditional_stats['requests'] += 1
+
+        if res.status_code == 304 and cached is not None:
+            etag, last_modified, headers, parsed, size, parse_seconds = cached
+
+            self.conditional_stats['not_modified'] += 1
+            self.conditional_stats['bytes_saved'] += size
+            self.conditional_stats['parse_seconds_saved'] += parse_seconds
+
+            return CachedResponse(200, headers, parsed, from_cache=True)
+
+        etag = res.headers.get('etag')
+        last_modified = res.headers.get('last-modified')
+        if not res.ok or not (etag or last_modified):
+            return res
+
+        if params and any(name in params for name in self.one_off_params):
+            return res
+
+        start = time.time()
+        parsed = response_json(res)
+        parse_seconds = time.time() - start
+
+        self._validators.set(key, (etag, last_modified, res.headers, parsed,
+            len(res.content), parse_seconds))
+
+        return CachedResponse(res.status_code, res.headers, parsed)
+
+
+class FakeHTTPResponse(object):
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.content = b'' if body is None else json.dumps(body).encode('utf-8')
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+class FakeSession(object):
+    ''' Answers the GETs with the responses of handler(url, params, headers). '''
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        self.requests.append((url, dict(params or {}), dict(headers or {})))
+        return self.handler(url, params or {}, headers or {})
+
+
+class testGitLabApi(unittest.TestCase):
+    def setUp(self):
+        self.api = GitLabApi('http://gitlab.test/api/v3/', 'token')
+
+    def testConditionalGet(self):
+        def handler(url, params, headers):
+            if headers.get('If-None-Match') == '"v1"':
+                return FakeHTTPResponse(304, headers={'ETag': '"v1"'})
+            return FakeHTTPResponse(200, [{'id': 1}], {'ETag': '"v1"'})
+
+        self.api.session = FakeSession(handler)
+
+        res = self.api.call('projects', params={'page': 1, 'per_page': 20})
+        self.assertFalse(res.from_cache)
+        self.assertEqual(res.json, [{'id': 1}])
+
+        # same url and parameters, whatever their order
+        res = self.api.call('projects', params={'per_page': 20, 'page': 1})
+        self.assertTrue(res.from_cache)
+        self.assertEqual(res.json, [{'id': 1}])
+        self.assertEqual(self.api.session.requests[1][2],
+            {'If-None-Match': '"v1"'})
+
+        # other parameters, other validators
+        self.api.call('projects', params={'page': 2, 'per_page': 20})
+        self.assertEqual(self.api.session.requests[2][2], {})
+
+        self.assertEqual(self.api.conditional_stats['requests'], 3)
+        self.assertEqual(self.api.conditional_stats['not_modified'], 1)
+        self.assertEqual(self.api.conditional_stats['bytes_saved'],
+            len(b'[{"id": 1}]'))
+
+    def testWithoutValidators(self):
+        self.api.session = FakeSession(
+            lambda url, params, headers: FakeHTTPResponse(200, {'id': 7}))
+
+        res = self.api.get_single_project(7)
+        self.assertEqual(response_json(res), {'id': 7})
+        self.api.get_single_project(7)
+        self.assertEqual(self.api.session.requests[1][2], {})
+
+    def testResponseJson(self):
+        # json is a method since requests 1.0, a property before, and on
+        # the responses kept with their validators
+        self.assertEqual(response_json(FakeHTTPResponse(200, {'id': 7})),
+            {'id': 7})
+        self.assertEqual(response_json(CachedResponse(200, {}, {'id': 7})),
+            {'id': 7})
+
+        self.api.session = FakeSession(lambda url, params, headers:
+            FakeHTTPResponse(200, {'id': 7, 'name': 'ircbot'}))
+        self.assertEqual(self.api.get_project_name_by_pid(7), 'ircbot')
+
+    def testValidatorsBounded(self):
+        self.api = GitLabApi('http://gitlab.test/api/v3/', 'token',
+            max_validators=2)
+        self.api.session = FakeSession(lambda url, params, headers:
+            FakeHTTPResponse(200, [], {'ETag': '"v1"'}))
+
+        for project_id in (1, 2, 3):
+            self.api.call('projects/%d' % project_id)
+        self.assertEqual(len(self.api._validators), 2)
+        self.assertIsNone(self.api._validators.get(
+            'http://gitlab.test/api/v3/projects/1'))
+
+        # each sync asks the commits since another date
+        self.api.get_project_commits(3, since='2013-01-01')
+        self.assertEqual(len(self.api._validators), 2)
+        self.assertIsNone(self.api._validators.get(self.api._validators_key(
+            'http://gitlab.test/api/v3/projects/3/repository/commits',
+            {'since': '2013-01-01'})))
+
+    def testSession(self):
+        api = GitLabApi('http://gitlab.test/api/v3/', 'token', pool_size=4)
+        self.assertEqual(api.session.headers['PRIVATE-TOKEN'], 'token')
+
+        adapter = api.session.get_adapter('http://gitlab.test/api/v3/')
+        self.assertEqual(adapter._pool_maxsize, 4)
+
+        # the token is not in the urls
+        api.session = FakeSession(lambda url, params, headers:
+            FakeHTTPResponse(200, {'id': 7}))
+        api.get_single_project(7)
+        self.assertEqual(api.session.requests,
+            [('http://gitlab.test/api/v3/projects/7', {}, {})])
+
+    def testInFlight(self):
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        def handler(url, params, headers):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+            return FakeHTTPResponse(200, {})
+
+        # the limit is per host, whatever the clients
+        apis = [GitLabApi('http://slots.test/api/v3/', 'token',
+            max_in_flight=2) for _ in range(2)]
+        for api in apis:
+            api.session = FakeSession(handler)
+
+        threads = [threading.Thread(target=apis[i % 2].get_single_project,
+            args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(in_flight, [0, 2])
+        self.assertEqual(sum(len(api.session.requests) for api in apis), 8)
+
+    def testPaginateLink(self):
+        def handler(url, params, headers):
+            page = params['page']
+            link = '<projects?page=%d>; rel="next"' % (page + 1) if page < 3 else ''
+            return FakeHTTPResponse(200, [{'id': page}], {'Link': link})
+
+        self.api.session = FakeSession(handler)
+
+        # short pages, the Link header says there are more
+        ids = [proj['id'] for proj in self.api.iter_projects(per_page=10)]
+        self.assertEqual(ids, [1, 2, 3])
+
+    def testPaginateFullPages(self):
+        items = list(range(5))
+
+        def handler(url, params, headers):
+            start = (params['page'] - 1) * params['per_page']
+            return FakeHTTPResponse(200, items[start:start + params['per_page']])
+
+        self.api.session = FakeSession(handler)
+        self.assertEqual(list(self.api.iter_projects(per_page=2)), items)
+        self.assertEqual(len(self.api.session.requests), 3)
+
+        # a full last page costs one more, empty, page
+        self.assertEqual(list(self.api.iter_projects(per_page=5)), items)
+        self.assertEqual(len(self.api.session.requests), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# -*- coding: utf8 -*-
+
+import logging
+import unittest
+
+import gevent
+from gevent import GreenletExit
+from gevent.event import AsyncResult
+
+from metrics import registry
+
+
+class Memoizer(object):
+    '''
+        Memoizes fetch(key) in cache, a cache.LRUCacher:
+
+        - concurrent misses for the same key share one in-flight fetch
+        - values expired less than cache.grace seconds ago are returned at
+          once, while one background greenlet fetches them again
+
+        Failed fetches are logged and counted, as memoize_errors_total,
+        nobody waits for the background ones.
+    '''
+    def __init__(self, cache, fetch, logger=None):
+        self.cache = cache
+        self.fetch = fetch
+        self.logger = logger or logging.getLogger('ircconnection.logger')
+        self.metrics = registry
+
+        # key => AsyncResult of the fetch in flight
+        self._in_flight = {}
+
+    def get(self, key):
+        found = self.cache.get_stale(key)
+        if found is not None:
+            value, fresh = found
+            if not fresh:
+                self.refresh(key)
+            return value
+
+        return self.refresh(key).get()
+
+    def refresh(self, key):
+        '''
+            Fetch key again in the background, unless it is already being
+            fetched, and return the AsyncResult of the fetch.
+        '''
+        result = self._in_flight.get(key)
+        if result is None:
+            result = self._in_flight[key] = AsyncResult()
+            gevent.spawn(self._fetch, key, result)
+
+        return result
+
+    def _fetch(self, key, result):
+        try:
+            value = self.fetch(key)
+        except BaseException as e:
+            # GitLabApi exceptions derive from BaseException
+            del self._in_flight[key]
+            result.set_exception(e)
+            if isinstance(e, GreenletExit):
+                raise
+
+            self.logger.warning('Unable to fetch %r', key, exc_info=True)
+            self.metrics.inc('memoize_errors_total',
+                fetch=getattr(self.fetch, '__name__', 'fetch'))
+            return
+
+        self.cache.set(key, value)
+        del self._in_flight[key]
+        result.set(value)
+
+
+class testMemoizer(unittest.TestCase):
+    def setUp(self):
+        from addons.cache import LRUCacher
+
+        self.now = 0.0
+        self.fetched = []
+        self.cache = LRUCacher(10, grace=5, clock=lambda: self.now)
+        self.memoizer = Memoizer(self.cache, self.fetch)
+
+    def fetch(self, key):
+        self.fetched.append(key)
+        gevent.sleep(0.01)
+        if key == 'missing':
+            raise KeyError(key)
+        return '%s-%d' % (key, len(self.fetched))
+
+    def testSingleFlight(self):
+        greenlets = [gevent.spawn(self.memoizer.get, 'a') for _ in range(10)]
+        gevent.joinall(greenlets)
+
+        self.assertEqual([g.value for g in greenlets], ['a-1'] * 10)
+        self.assertEqual(self.fetched, ['a'])
+
+    def testStaleWhileRevalidate(self):
+        self.assertEqual(self.memoizer.get('a'), 'a-1')
+
+        self.now = 12
+        self.assertEqual(self.memoizer.get('a'), 'a-1')
+        self.assertEqual(self.memoizer.get('a'), 'a-1')
+
+        gevent.sleep(0.02)
+        self.assertEqual(self.memoizer.get('a'), 'a-2')
+        self.assertEqual(self.fetched, ['a', 'a'])
+
+    def testFailure(self):
+        self.assertRaises(KeyError, self.memoizer.get, 'missing')
+        self.assertEqual(self.memoizer._in_flight, {})
+
+    def testRefreshFailure(self):
+        from metrics import Metrics
+
+        self.memoizer.metrics = Metrics()
+        self.cache.set('missing', 'former')
+
+        self.now = 12
+        with self.assertLogs('ircconnection.logger', 'WARNING') as logs:
+            self.assertEqual(self.memoizer.get('missing'), 'former')
+            gevent.sleep(0.02)
+
+        self.assertIn('KeyError', logs.output[0])
+        self.assertEqual(self.memoizer.metrics._counters,
+            {('memoize_errors_total', (('fetch', 'fetch'),)): 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
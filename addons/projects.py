@@ -0,0 +1,205 @@
+# -*- coding: utf8 -*-
+
+import heapq
+import bisect
+import difflib
+import unittest
+
+
+def trigrams(key):
+    ''' The 3 character slices of key, padded so short keys have some. '''
+    key = '  %s ' % key
+    return set(key[i:i + 3] for i in range(len(key) - 2))
+
+
+def format_projects(projects):
+    '''
+        Lines of the git projects order for projects, from the projects
+        api, run in a worker process (see IRCProtocol.offload).
+    '''
+    return ['project name: %s, id: %s, owner: %s' % (proj['name'],
+        proj['id'], proj['owner']['name']) for proj in projects]
+
+
+class ProjectIndex(object):
+    '''
+        In-memory index of the GitLab projects, by id and by name, path and
+        path with namespace (case insensitive).
+
+        Only the fields the bot uses are kept for each project.
+    '''
+    fields = ('id', 'name', 'path', 'path_with_namespace', 'last_activity_at',
+        'default_branch')
+
+    def __init__(self):
+        # id => project
+        self._projects = {}
+        # lower cased name/path => set of ids, and its sorted keys for
+        # prefix lookups
+        self._keys = {}
+        self._sorted_keys = []
+        # trigram => set of keys holding it, to narrow the fuzzy lookups
+        self._trigrams = {}
+
+    def __len__(self):
+        return len(self._projects)
+
+    def __contains__(self, project_id):
+        return project_id in self._projects
+
+    def get(self, project_id):
+        return self._projects.get(project_id)
+
+    def add(self, project):
+        ''' Add or update a project, as returned by the projects api. '''
+        project_id = project['id']
+        if project_id in self._projects:
+            self.remove(project_id)
+
+        entry = dict((field, project.get(field)) for field in self.fields)
+        owner = project.get('owner') or {}
+        entry['owner_name'] = owner.get('name')
+        self._projects[project_id] = entry
+
+        for key in self._project_keys(entry):
+            if key not in self._keys:
+                self._keys[key] = set()
+                bisect.insort(self._sorted_keys, key)
+                for trigram in trigrams(key):
+                    self._trigrams.setdefault(trigram, set()).add(key)
+            self._keys[key].add(project_id)
+
+        return entry
+
+    def remove(self, project_id):
+        entry = self._projects.pop(project_id, None)
+        if entry is None:
+            return
+
+        for key in self._project_keys(entry):
+            ids = self._keys.get(key)
+            if ids is None:
+                continue
+            ids.discard(project_id)
+            if not ids:
+                del self._keys[key]
+                del self._sorted_keys[bisect.bisect_left(self._sorted_keys, key)]
+                for trigram in trigrams(key):
+                    keys = self._trigrams[trigram]
+                    keys.discard(key)
+                    if not keys:
+                        del self._trigrams[trigram]
+
+    def find(self, text, fuzzy=True):
+        '''
+            Projects matching text: the project with this id, else the
+            ones with this exact name or path, else the ones whose name or
+            path starts with text, else (if fuzzy) the closest ones.
+        '''
+        text = text.strip()
+        if text.isdigit() and int(text) in self._projects:
+            return [self._projects[int(text)]]
+
+        key = text.lower()
+        ids = self._keys.get(key)
+
+        if not ids:
+            ids = set()
+            start = bisect.bisect_left(self._sorted_keys, key)
+            for candidate in self._sorted_keys[start:]:
+                if not candidate.startswith(key):
+                    break
+                ids.update(self._keys[candidate])
+
+        if not ids and fuzzy:
+            ids = set()
+            for candidate in difflib.get_close_matches(key,
+                    self._fuzzy_candidates(key), n=5, cutoff=0.75):
+                ids.update(self._keys[candidate])
+
+        return sorted((self._projects[project_id] for project_id in ids),
+            key=lambda entry: entry['id'])
+
+    def _fuzzy_candidates(self, key, count=50):
+        '''
+            The count keys sharing the most trigrams with key: the only
+            ones difflib compares, instead of every key.
+        '''
+        # the common trigrams ('pro', 'oje'...) tell little and cost the
+        # most, a close key shares some of the rarer half too
+        postings = sorted((self._trigrams[trigram] for trigram in trigrams(key)
+            if trigram in self._trigrams), key=len)
+
+        shared = {}
+        for keys in postings[:(len(postings) + 1) // 2]:
+            for candidate in keys:
+                shared[candidate] = shared.get(candidate, 0) + 1
+
+        return heapq.nlargest(count, shared, key=shared.get)
+
+    def _project_keys(self, entry):
+        keys = set()
+        for field in ('name', 'path', 'path_with_namespace'):
+            if entry.get(field):
+                keys.add(entry[field].lower())
+        return keys
+
+
+class testProjectIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = ProjectIndex()
+        self.index.add({'id': 1, 'name': 'ircbot', 'path': 'ircbot',
+            'path_with_namespace': 'oupeng/ircbot', 'owner': {'name': 'xpen'}})
+        self.index.add({'id': 2, 'name': 'Browser', 'path': 'browser',
+            'path_with_namespace': 'oupeng/browser'})
+        self.index.add({'id': 3, 'name': 'browser-sync', 'path': 'browser-sync',
+            'path_with_namespace': 'web/browser-sync'})
+
+    def ids(self, text):
+        return [entry['id'] for entry in self.index.find(text)]
+
+    def testExact(self):
+        self.assertEqual(self.ids('1'), [1])
+        self.assertEqual(self.ids('IRCBOT'), [1])
+        self.assertEqual(self.ids('oupeng/browser'), [2])
+        self.assertEqual(self.ids('browser'), [2])
+        self.assertEqual(self.index.get(1)['owner_name'], 'xpen')
+
+    def testPrefix(self):
+        self.assertEqual(self.ids('brow'), [2, 3])
+        self.assertEqual(self.ids('oupeng/'), [1, 2])
+
+    def testFuzzy(self):
+        self.assertEqual(self.ids('ircbto'), [1])
+        self.assertEqual(self.ids('nothing like it'), [])
+
+    def testFormat(self):
+        self.assertEqual(format_projects([{'id': 1, 'name': 'ircbot',
+            'owner': {'name': 'xpen'}}]),
+            ['project name: ircbot, id: 1, owner: xpen'])
+
+    def testUpdateRemove(self):
+        self.index.add({'id': 1, 'name': 'ircbots', 'path': 'ircbots',
+            'path_with_namespace': 'oupeng/ircbots'})
+        self.assertEqual(self.ids('oupeng/ircbot'), [1])
+        self.assertEqual(self.index.find('oupeng/ircbot')[0]['name'], 'ircbots')
+
+        self.index.remove(1)
+        self.assertEqual(self.ids('ircbots'), [])
+        self.assertEqual(len(self.index), 2)
+        self.assertNotIn('ircbot', self.index._sorted_keys)
+        self.assertFalse(any('ircbots' in keys
+            for keys in self.index._trigrams.values()))
+
+    def testFuzzyCandidates(self):
+        for i in range(100):
+            self.index.add({'id': 100 + i, 'name': 'service-%d' % i})
+
+        candidates = self.index._fuzzy_candidates('ircbto', count=3)
+        self.assertEqual(candidates[0], 'ircbot')
+        self.assertNotIn('service-1', candidates)
+        self.assertIn(142, self.ids('servce-42'))
+
+
+if __name__ == '__main__':
+    unittest.main()
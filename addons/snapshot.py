@@ -0,0 +1,125 @@
+# -*- coding: utf8 -*-
+
+import os
+import json
+import time
+import sqlite3
+import tempfile
+import unittest
+
+
+class CacheSnapshot(object):
+    '''
+        On-disk snapshot of a cache.LRUCacher, in a SQLite database, so a
+        restarted bot answers from it at once.
+
+        Keys and values are stored as json, with their expiration timestamp:
+        load only reads the entries which are still fresh, or expired less
+        than the cache's grace period ago, those are then served stale and
+        refreshed.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute('CREATE TABLE IF NOT EXISTS entries '
+            '(key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)')
+        return db
+
+    def save(self, cache):
+        return self.write(cache.entries())
+
+    def write(self, entries):
+        '''
+            Save the entries() of a cache. It doesn't touch the cache: it
+            may run in another thread, on the entries taken in the loop.
+        '''
+        rows = [(json.dumps(key), json.dumps(value), expires)
+            for key, value, expires in entries]
+
+        db = self._connect()
+        try:
+            # one transaction, a crash leaves the former snapshot
+            with db:
+                db.execute('DELETE FROM entries')
+                db.executemany('INSERT INTO entries VALUES (?, ?, ?)', rows)
+        finally:
+            db.close()
+
+        return len(rows)
+
+    def load(self, cache, now=None):
+        if not os.path.exists(self.path):
+            return 0
+
+        if now is None:
+            now = time.time()
+
+        db = self._connect()
+        try:
+            # least recently used first, as saved
+            rows = db.execute('SELECT key, value, expires FROM entries '
+                'WHERE expires > ? ORDER BY rowid', (now - cache.grace,))
+
+            count = 0
+            for key, value, expires in rows:
+                cache.restore(json.loads(key), json.loads(value), expires)
+                count += 1
+        finally:
+            db.close()
+
+        return count
+
+
+class testCacheSnapshot(unittest.TestCase):
+    def setUp(self):
+        from addons.cache import LRUCacher
+
+        self.now = 1000.0
+        self.new_cache = lambda: LRUCacher(10, grace=5, clock=lambda: self.now)
+
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        os.remove(self.path)
+        self.snapshot = CacheSnapshot(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def testMissing(self):
+        self.assertEqual(self.snapshot.load(self.new_cache(), self.now), 0)
+
+    def testSaveLoad(self):
+        cache = self.new_cache()
+        cache.set(1, {'title': 'fresh'})
+        cache.set(2, {'title': 'stale'}, ttl=1)
+        cache.set(3, {'title': 'gone'}, ttl=-10)
+        self.assertEqual(self.snapshot.save(cache), 3)
+
+        self.now += 3
+        restored = self.new_cache()
+        self.assertEqual(self.snapshot.load(restored, self.now), 2)
+
+        self.assertEqual(restored.get(1), {'title': 'fresh'})
+        self.assertEqual(restored.get_stale(2), ({'title': 'stale'}, False))
+        self.assertIsNone(restored.get_stale(3))
+
+    def testSaveReplaces(self):
+        cache = self.new_cache()
+        cache.set(1, 'a')
+        self.snapshot.save(cache)
+
+        cache.retire(1)
+        cache.set(2, 'b')
+        self.snapshot.save(cache)
+
+        restored = self.new_cache()
+        self.snapshot.load(restored, self.now)
+        self.assertEqual([key for key, _, _ in restored.entries()], [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
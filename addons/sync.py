@@ -0,0 +1,186 @@
+# -*- coding: utf8 -*-
+
+import unittest
+
+import gevent
+from gevent.pool import Pool
+
+from addons.gitlab import response_json
+
+
+# fields of the commits kept by the store, the ones the bot prints
+commit_fields = ('id', 'short_id', 'title', 'author_name', 'created_at')
+
+
+def compact_commit(commit):
+    return dict((field, commit.get(field)) for field in commit_fields)
+
+
+class CommitSync(object):
+    '''
+        Keeps the latest commit of the projects current with delta requests.
+
+        The store holds, by project id, a cursor: the latest commit seen on
+        the project's default branch (its compact form), and the
+        last_activity_at of the project when it was synced. A sync asks the
+        commits since the cursor's date only, a pass over the projects
+        list syncs the projects whose activity moved, and nothing for the
+        idle ones.
+
+        on_commits(project_id, commits) gets the new commits of a sync,
+        newest first.
+    '''
+    def __init__(self, gitlab_api, on_commits=None):
+        self.gitlab_api = gitlab_api
+        self.on_commits = on_commits
+
+        # project id => [latest commit (None for an empty project),
+        # last_activity_at]
+        self._cursors = {}
+
+    def __len__(self):
+        return len(self._cursors)
+
+    def latest(self, project_id):
+        cursor = self._cursors.get(project_id)
+        if cursor is not None:
+            return cursor[0]
+
+    def sync_project(self, project_id, ref_name=None, activity=None):
+        '''
+            Fetch the commits newer than the project's cursor and return
+            its latest commit, None if it has no commits.
+        '''
+        latest = self.latest(project_id)
+        since = latest['created_at'] if latest is not None else None
+
+        commits = response_json(self.gitlab_api.get_project_commits(
+            project_id, ref_name, since=since))
+
+        if latest is not None:
+            # since is inclusive, keep the commits above the cursor
+            seen = latest['id']
+            for i, commit in enumerate(commits):
+                if commit['id'] == seen:
+                    commits = commits[:i]
+                    break
+
+        if commits:
+            self.advance(project_id, commits[0])
+            if self.on_commits is not None:
+                self.on_commits(project_id, commits)
+
+        if activity is not None:
+            self._cursors.setdefault(project_id, [None, None])[1] = activity
+
+        return self.latest(project_id)
+
+    def advance(self, project_id, commit):
+        ''' Move the cursor to commit, pushed to the default branch say. '''
+        cursor = self._cursors.get(project_id)
+        if cursor is None:
+            self._cursors[project_id] = [compact_commit(commit), None]
+        else:
+            cursor[0] = compact_commit(commit)
+
+    def forget(self, project_id):
+        self._cursors.pop(project_id, None)
+
+    def is_active(self, project):
+        ''' Whether project, from the projects api, moved since its sync. '''
+        cursor = self._cursors.get(project['id'])
+        return (cursor is None or cursor[1] is None or
+            cursor[1] != project.get('last_activity_at'))
+
+    def sync_projects(self, projects, concurrency=8, errors=None):
+        '''
+            Sync the active ones of projects, concurrency at once. The
+            failures are kept in errors, by project id. Returns the count
+            of projects synced.
+        '''
+        active = [proj for proj in projects if self.is_active(proj)]
+
+        pool = Pool(concurrency)
+        for proj in active:
+            pool.spawn(self._sync_one, proj, errors)
+        pool.join()
+
+        return len(active)
+
+    def _sync_one(self, project, errors):
+        try:
+            self.sync_project(project['id'], project.get('default_branch'),
+                project.get('last_activity_at'))
+        except BaseException as e:
+            if isinstance(e, gevent.GreenletExit) or errors is None:
+                raise
+            errors[project['id']] = e
+
+
+class FakeResponse(object):
+    def __init__(self, json):
+        self.json = json
+
+
+class FakeGitLabApi(object):
+    def __init__(self, commits):
+        # project id => commits, newest first
+        self.commits = commits
+        self.requests = []
+
+    def get_project_commits(self, project_id, ref_name=None, since=None):
+        self.requests.append((project_id, ref_name, since))
+        return FakeResponse([commit for commit in self.commits[project_id]
+            if since is None or commit['created_at'] >= since])
+
+
+class testCommitSync(unittest.TestCase):
+    def setUp(self):
+        self.api = FakeGitLabApi({
+            1: [{'id': 'b', 'title': 'two', 'created_at': '2013-02-02'},
+                {'id': 'a', 'title': 'one', 'created_at': '2013-01-01'}],
+            2: [],
+        })
+        self.new = []
+        self.sync = CommitSync(self.api,
+            lambda project_id, commits: self.new.append(
+                (project_id, [commit['id'] for commit in commits])))
+
+    def testDelta(self):
+        self.assertEqual(self.sync.sync_project(1)['title'], 'two')
+        self.assertIsNone(self.sync.sync_project(2))
+        self.assertEqual(self.sync.sync_project(1)['id'], 'b')
+
+        self.api.commits[1].insert(0, {'id': 'c', 'title': 'three',
+            'created_at': '2013-03-03', 'author_name': 'xpen', 'stats': {}})
+        latest = self.sync.sync_project(1, 'master')
+        self.assertEqual(latest, {'id': 'c', 'short_id': None,
+            'title': 'three', 'author_name': 'xpen', 'created_at': '2013-03-03'})
+
+        self.assertEqual(self.api.requests, [(1, None, None), (2, None, None),
+            (1, None, '2013-02-02'), (1, 'master', '2013-02-02')])
+        self.assertEqual(self.new, [(1, ['b', 'a']), (1, ['c'])])
+
+    def testIdleProjects(self):
+        projects = [
+            {'id': 1, 'last_activity_at': '2013-02-02'},
+            {'id': 2, 'last_activity_at': '2013-01-01'},
+        ]
+        self.assertEqual(self.sync.sync_projects(projects), 2)
+        self.assertEqual(len(self.sync), 2)
+        self.assertIsNone(self.sync.latest(2))
+
+        projects[0]['last_activity_at'] = '2013-03-03'
+        self.assertEqual(self.sync.sync_projects(projects), 1)
+        self.assertEqual(self.sync.sync_projects(projects), 0)
+        self.assertEqual(self.api.requests, [(1, None, None), (2, None, None),
+            (1, None, '2013-02-02')])
+
+    def testErrors(self):
+        errors = {}
+        self.sync.sync_projects([{'id': 3}], errors=errors)
+        self.assertIsInstance(errors[3], KeyError)
+
+
+if __name__ == '__main__':
+    unittest.main()
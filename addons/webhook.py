@@ -0,0 +1,195 @@
+# -*- coding: utf8 -*-
+
+import hmac
+import json
+import logging
+import unittest
+
+
+# X-Gitlab-Event header => event kind, for payloads without object_kind
+event_headers = {
+    'Push Hook': 'push',
+    'Tag Push Hook': 'tag_push',
+    'System Hook': 'system',
+}
+
+
+class GitLabWebhook(object):
+    '''
+        WSGI application receiving GitLab web hooks (and system hooks).
+
+        handlers maps event kinds to callables taking the decoded payload:
+        'push', 'tag_push', and for system hooks their event_name, as
+        'project_create' or 'project_destroy'. Events without handler are
+        acknowledged and dropped.
+
+        Requests must carry token in the X-Gitlab-Token header, and have a
+        body of at most max_body bytes.
+    '''
+    def __init__(self, handlers, token, logger=None, max_body=1024 * 1024):
+        # anybody could feed the bot commits otherwise
+        if not token:
+            raise Exception('The web hooks need a token')
+
+        self.handlers = handlers
+        self.token = token
+        self.max_body = max_body
+        self.logger = logger or logging.getLogger('ircconnection.logger')
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] != 'POST':
+            return self._respond(start_response, '405 Method Not Allowed')
+
+        if not self.valid_token(environ.get('HTTP_X_GITLAB_TOKEN')):
+            return self._respond(start_response, '403 Forbidden')
+
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return self._respond(start_response, '400 Bad Request')
+
+        if length > self.max_body:
+            return self._respond(start_response, '413 Request Entity Too Large')
+
+        try:
+            body = environ['wsgi.input'].read(length)
+            if not isinstance(body, str):
+                body = body.decode('utf-8')
+            payload = json.loads(body)
+        except ValueError:
+            return self._respond(start_response, '400 Bad Request')
+
+        kind = self.event_kind(payload, environ.get('HTTP_X_GITLAB_EVENT'))
+        handler = self.handlers.get(kind)
+        if handler is None:
+            self.logger.debug('Ignored %s web hook', kind)
+            return self._respond(start_response, '200 OK')
+
+        try:
+            handler(payload)
+        except Exception as e:
+            self.logger.error('Unable to handle %s web hook: %s', kind, e)
+            return self._respond(start_response, '500 Internal Server Error')
+
+        return self._respond(start_response, '200 OK')
+
+    def valid_token(self, token):
+        # in constant time, not to tell how much of the token is right
+        return hmac.compare_digest((token or '').encode('utf-8'),
+            self.token.encode('utf-8'))
+
+    def event_kind(self, payload, header=None):
+        kind = payload.get('object_kind') or event_headers.get(header)
+
+        # system hooks only have an event_name, older push hooks nothing
+        if kind in (None, 'system'):
+            kind = payload.get('event_name')
+        if kind is None and 'commits' in payload:
+            kind = 'push'
+
+        return kind
+
+    def _respond(self, start_response, status):
+        start_response(status, [('Content-Type', 'text/plain')])
+        return [status.encode('utf-8')]
+
+
+def commit_from_push(commit):
+    '''
+        Convert a commit of a push payload to the format of the commits api.
+    '''
+    message = commit.get('message') or ''
+    author = commit.get('author') or {}
+
+    return {
+        'id': commit['id'],
+        'short_id': commit['id'][:11],
+        'title': message.split('\n', 1)[0],
+        'author_name': author.get('name'),
+        'author_email': author.get('email'),
+        'created_at': commit.get('timestamp'),
+    }
+
+
+def project_from_system_hook(payload):
+    '''
+        Convert the project of a project_* system hook to the format of the
+        projects api.
+    '''
+    return {
+        'id': payload['project_id'],
+        'name': payload.get('name'),
+        'path': payload.get('path'),
+        'path_with_namespace': payload.get('path_with_namespace'),
+        'owner': {'name': payload.get('owner_name')},
+    }
+
+
+class testGitLabWebhook(unittest.TestCase):
+    def setUp(self):
+        self.received = []
+        self.app = GitLabWebhook({
+            'push': self.received.append,
+            'project_destroy': self.received.append,
+        }, token='secret', max_body=100)
+
+    def call(self, payload, method='POST', token='secret', event=None):
+        from io import BytesIO
+
+        body = json.dumps(payload).encode('utf-8')
+        environ = {
+            'REQUEST_METHOD': method,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': BytesIO(body),
+            'HTTP_X_GITLAB_TOKEN': token,
+        }
+        if event:
+            environ['HTTP_X_GITLAB_EVENT'] = event
+
+        status = []
+        self.app(environ, lambda s, headers: status.append(s))
+        return status[0]
+
+    def testPush(self):
+        payload = {'object_kind': 'push', 'project_id': 1, 'commits': []}
+        self.assertEqual(self.call(payload), '200 OK')
+        self.assertEqual(self.received, [payload])
+
+    def testOldPush(self):
+        payload = {'project_id': 1, 'commits': []}
+        self.assertEqual(self.call(payload), '200 OK')
+        self.assertEqual(self.received, [payload])
+
+    def testSystemHook(self):
+        payload = {'event_name': 'project_destroy', 'project_id': 1}
+        self.assertEqual(self.call(payload, event='System Hook'), '200 OK')
+        self.assertEqual(self.received, [payload])
+
+    def testIgnored(self):
+        self.assertEqual(self.call({'object_kind': 'issue'}), '200 OK')
+        self.assertEqual(self.received, [])
+
+    def testRefused(self):
+        self.assertEqual(self.call({}, token='wrong'), '403 Forbidden')
+        self.assertEqual(self.call({}, token=None), '403 Forbidden')
+        self.assertEqual(self.call({}, method='GET'), '405 Method Not Allowed')
+        self.assertEqual(self.call({'commits': ['x' * 100]}),
+            '413 Request Entity Too Large')
+        self.assertEqual(self.received, [])
+
+        self.assertRaises(Exception, GitLabWebhook, {}, '')
+        self.assertRaises(Exception, GitLabWebhook, {}, None)
+
+    def testCommitFromPush(self):
+        commit = commit_from_push({
+            'id': 'b6568db1bc1dcd7f8b4d5a946b0b91f9dacd7327',
+            'message': 'Update Catalan translation\n\nmore',
+            'timestamp': '2011-12-12T14:27:31+02:00',
+            'author': {'name': 'Jordi Mallach', 'email': 'jordi@softcatala.org'},
+        })
+        self.assertEqual(commit['title'], 'Update Catalan translation')
+        self.assertEqual(commit['author_name'], 'Jordi Mallach')
+
+
+if __name__ == '__main__':
+    unittest.main()
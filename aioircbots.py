@@ -0,0 +1,403 @@
+# -*- coding: utf8 -*-
+'''
+    asyncio connection engine, an alternative to the gevent one in ircbots.
+
+    AsyncIRCBot keeps the handler API of IRCBot: irc_* methods and
+    register_order. Orders registered as coroutine functions are awaited on
+    the loop, plain ones (like the OupengBot orders calling GitLabApi) run in
+    an executor so they don't block the other connections. Like the gevent
+    engine, orders run order_concurrency at once, with at most order_queue
+    more waiting, the others are refused with "Busy, try later!".
+
+    Many bots can share one loop:
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(asyncio.gather(
+            bot.run('irc.freenode.net', 6667, '#channel'),
+            other_bot.run('irc.example.com', 6667, '#other'),
+        ))
+'''
+
+import re
+import time
+import asyncio
+import inspect
+import functools
+import unittest
+
+import workers
+from tools import TokenBucket, Backoff
+from ircmessage import IRCBadMessage
+from ircprotocol import IRCProtocol
+from outbound import OutboundQueue
+
+
+class AsyncOutboundQueue(OutboundQueue):
+    '''
+        OutboundQueue drained by a writer task, write is a coroutine function.
+    '''
+    def __init__(self, write, bucket=None, logger=None):
+        super(AsyncOutboundQueue, self).__init__(write, bucket, logger)
+
+        self._wakeup = None
+        self._writer = None
+
+    def start(self):
+        if self._writer is None:
+            self._wakeup = asyncio.Event()
+            self._writer = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+
+    def _notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            batch, control = self._next_batch()
+
+            if batch:
+                try:
+                    await self._write(''.join(batch))
+                except (IOError, OSError) as e:
+                    self._write_failed(batch, control, e)
+                    self._writer = None
+                    return
+
+            if self._control:
+                continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._next_timeout())
+            except asyncio.TimeoutError:
+                pass
+
+
+class AsyncIRCBot(IRCProtocol):
+    def __init__(self, nick, logfile=None, verbosity='INFO',
+            send_rate=1, send_burst=5, executor=None,
+            order_limits=None, merge_window=5, page_lines=10,
+            reconnect_delay=1, reconnect_max_delay=300, order_deadlines=None,
+            cpu_workers=2, admins=None, order_concurrency=10, order_queue=50):
+        super(AsyncIRCBot, self).__init__(nick, logfile, verbosity,
+            order_limits, merge_window, page_lines, order_deadlines,
+            cpu_workers, admins)
+
+        # run reconnects until disconnect_ircserver is called
+        self.backoff = Backoff(reconnect_delay, reconnect_max_delay)
+        self.stopped = False
+
+        # executor for the orders which are not coroutine functions,
+        # None is the loop's default one
+        self.executor = executor
+
+        self._outbound = AsyncOutboundQueue(self._write,
+            TokenBucket(send_rate, send_burst), self.logger)
+
+        # orders being served, order_concurrency at once holding a slot,
+        # order_queue more waiting for one
+        self.order_concurrency = order_concurrency
+        self.order_queue = order_queue
+        self._order_slots = asyncio.Semaphore(order_concurrency)
+        self._tasks = set()
+
+    async def run(self, server, port, channels):
+        '''
+            Connect, join channels (see IRCProtocol.join_all) and serve
+            until disconnect_ircserver is called, see IRCBot.run.
+        '''
+        self.stopped = False
+        self.reclaim_nick = True
+        joined = False
+
+        while not self.stopped:
+            try:
+                await self.connect_ircserver(server, port)
+            except OSError:
+                await self._wait_reconnect()
+                continue
+
+            if joined:
+                self.rejoin()
+            else:
+                self.join_all(channels)
+                joined = True
+
+            await self._enter_eventloop()
+            if not self.stopped:
+                await self._wait_reconnect()
+
+    async def _wait_reconnect(self):
+        delay = self.backoff.next()
+        self.logger.error('Reconnecting to %s in %.1f seconds', self.server, delay)
+        await asyncio.sleep(delay)
+
+    async def connect_ircserver(self, server, port):
+        self.server = server
+        self.port = port
+
+        try:
+            self._reader, self._writer = await asyncio.open_connection(server, port)
+        except OSError:
+            self.logger.error('Unable to connect to %s on port %d', self.server, self.port, exc_info=1)
+            raise
+
+        # what was queued for the former connection follows the
+        # registration
+        self._outbound.discard_control()
+        self.register_gauges()
+        self.register_nick()
+        self.register()
+        self._outbound.start()
+
+    def disconnect_ircserver(self):
+        self.stopped = True
+        self.running = False
+
+        for task in list(self._tasks):
+            task.cancel()
+
+        self.stop_workers()
+        self._outbound.stop()
+        self._writer.close()
+
+    def _connection_lost(self):
+        # orders being served go on, their lines wait for the next
+        # connection
+        self.running = False
+        self._outbound.stop()
+        self._writer.close()
+
+    async def _write(self, data):
+        self._writer.write(data.encode('utf-8'))
+        await self._writer.drain()
+
+    async def join_channel(self, channel):
+        self.join(channel)
+        return await self._enter_eventloop()
+
+    async def _enter_eventloop(self):
+        self.running = True
+        while self.running:
+            try:
+                message = await self._reader.readline()
+            except (IOError, OSError):
+                message = None
+            except ValueError:
+                # a line over the reader's limit: the stream can't be
+                # read on from a known place
+                self.logger.error('Line too long from %s', self.server)
+                message = None
+
+            if not message:
+                if self.running:
+                    self._connection_lost()
+                return True
+
+            # the server talks, the next drop starts a new backoff
+            self.backoff.reset()
+
+            # irc_* handlers are cheap, orders are served in their own task
+            try:
+                self.handle(message.decode('utf-8', 'replace').rstrip())
+            except IRCBadMessage as e:
+                self.logger.error('Bad message %r: %s', message, e)
+
+    def execute_order(self, pending, handler, kwargs):
+        if len(self._tasks) >= self.order_concurrency + self.order_queue:
+            self.order_dropped(pending, handler)
+            return
+
+        task = asyncio.ensure_future(self._run_order(pending, handler, kwargs,
+            time.time()))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_order(self, pending, handler, kwargs, queued):
+        try:
+            async with self._order_slots:
+                await self._serve_order(pending, handler, kwargs, queued)
+        except asyncio.CancelledError:
+            self.abort_order(pending)
+            raise
+
+    async def _serve_order(self, pending, handler, kwargs, queued):
+        name = handler.__name__
+        self.metrics.observe('order_queue_seconds', time.time() - queued)
+        self.metrics.inc('orders_total', order=name)
+        start = time.time()
+
+        try:
+            result = await asyncio.wait_for(self._call(handler, kwargs),
+                self.order_deadline(handler, queued))
+        except asyncio.TimeoutError:
+            self.order_timed_out(pending, handler)
+            return
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            # GitLabApi exceptions derive from BaseException
+            self.logger.error('Exception: %s', e)
+            self.metrics.inc('order_errors_total', order=name)
+            self.abort_order(pending)
+            return
+
+        self.deliver(pending, result)
+        self.metrics.observe('order_seconds', time.time() - start, order=name)
+
+    async def _call(self, handler, kwargs):
+        if asyncio.iscoroutinefunction(handler):
+            return await handler(**kwargs)
+
+        loop = asyncio.get_running_loop()
+        if handler in self._cpu_heavy:
+            return await loop.run_in_executor(self.process_pool(),
+                functools.partial(workers.call_handler, handler, kwargs))
+
+        # past the deadline, the executor thread finishes on its own
+        result = await loop.run_in_executor(self.executor,
+            functools.partial(handler, **kwargs))
+
+        # generated results may block as well
+        if inspect.isgenerator(result):
+            result = await loop.run_in_executor(self.executor, list, result)
+
+        return result
+
+
+class testAsyncIRCBot(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def testServe(self):
+        received = []
+        resumed = []
+
+        async def handle_client(reader, writer):
+            if received:
+                # reconnected
+                while len(resumed) < 4:
+                    line = await reader.readline()
+                    resumed.append(line.decode('utf-8').rstrip())
+
+                bot.disconnect_ircserver()
+                writer.close()
+                return
+
+            # bad lines are logged and skipped
+            writer.write(b'\r\n:prefix-only\r\n')
+            writer.write(b'PING :fake.server\r\n')
+            writer.write(b':xpen!~xpen@10.0.0.1 PRIVMSG bot :bot: async 42\r\n')
+            writer.write(b':xpen!~xpen@10.0.0.1 PRIVMSG bot :bot: sync\r\n')
+            await writer.drain()
+
+            while len(received) < 6:
+                line = await reader.readline()
+                received.append(line.decode('utf-8').rstrip())
+
+            writer.close()
+
+        async def async_order(value):
+            await asyncio.sleep(0)
+            return 'async %s' % value
+
+        bot = AsyncIRCBot('bot', send_rate=100, send_burst=100,
+            reconnect_delay=0.01)
+        connection_lost = bot._connection_lost
+
+        def lost():
+            connection_lost()
+            # queued while disconnected, sent once connected again
+            bot.send('PRIVMSG xpen :queued')
+
+        bot._connection_lost = lost
+        bot.register_order([
+            (re.compile(r'^async (?P<value>\d+)$'), async_order, 'async order'),
+            (re.compile(r'^sync$'), lambda: ['sync 1', 'sync 2'], 'sync order'),
+        ])
+
+        async def main():
+            server = await asyncio.start_server(handle_client, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            await asyncio.wait_for(bot.run('127.0.0.1', port, 'channel'), 5)
+            server.close()
+
+        self.loop.run_until_complete(main())
+
+        self.assertEqual(received[:3], ['NICK bot', 'USER bot 127.0.0.1 bla :bot',
+            'JOIN #channel'])
+        self.assertIn('PONG :fake.server', received)
+        self.assertIn('PRIVMSG xpen :async 42', received)
+        # packed in one line
+        self.assertIn('PRIVMSG xpen :sync 1 | sync 2', received)
+
+        self.assertEqual(resumed, ['NICK bot', 'USER bot 127.0.0.1 bla :bot',
+            'JOIN #channel', 'PRIVMSG xpen :queued'])
+
+    def testLongLine(self):
+        connections = []
+
+        async def handle_client(reader, writer):
+            connections.append(await reader.readline())
+            if len(connections) == 1:
+                # over the reader's 64KB limit, read as a lost connection
+                writer.write(b'PING :' + b'x' * 70000 + b'\r\n')
+                await writer.drain()
+                return
+
+            bot.disconnect_ircserver()
+            writer.close()
+
+        bot = AsyncIRCBot('bot', reconnect_delay=0.01)
+
+        async def main():
+            server = await asyncio.start_server(handle_client, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            await asyncio.wait_for(bot.run('127.0.0.1', port, []), 5)
+            server.close()
+
+        self.loop.run_until_complete(main())
+        self.assertEqual(connections, [b'NICK bot\r\n'] * 2)
+
+    def testBusy(self):
+        class FakeOutbound(list):
+            def put(self, line):
+                self.append(line.rstrip())
+
+        bot = AsyncIRCBot('bot', order_concurrency=1, order_queue=1)
+        bot._outbound = FakeOutbound()
+        released = asyncio.Event()
+
+        async def wait(value):
+            await released.wait()
+            return 'done %s' % value
+
+        bot.register_order([
+            (re.compile(r'^wait (?P<value>\d+)$'), wait, 'wait'),
+        ])
+
+        async def main():
+            # one served, one waiting for a slot, the third refused
+            for i, sender in enumerate(['xpen', 'alice', 'bob']):
+                bot.serve(sender, 'wait %d' % i)
+            await asyncio.sleep(0)
+            released.set()
+            await asyncio.gather(*bot._tasks)
+
+        self.loop.run_until_complete(main())
+        self.assertEqual(bot._outbound, ['PRIVMSG bob :Busy, try later!',
+            'PRIVMSG xpen :done 0', 'PRIVMSG alice :done 1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
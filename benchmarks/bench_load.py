@@ -0,0 +1,323 @@
+# -*- coding: utf8 -*-
+'''
+    load benchmark of OupengBot, offline, run it from the repo root:
+
+        python -m benchmarks.bench_load --users 50 --orders 20 --latency 0.05
+
+    starts a fake GitLab api (with `--projects` projects, answering after
+    `--latency` seconds) and a fake IRC server, whose `--users` users each
+    ask `--orders` orders privately to the bot, one after the other. Reports
+    orders and lines per second, the order to first reply line latency, the
+    memory used and the requests GitLab received, by endpoint.
+
+    The flood control and the order limits of the settings are lifted, see
+    --send-rate and --limits. Runs are reproducible with --seed.
+'''
+if '__main__' == __name__:
+    from gevent import monkey
+    monkey.patch_all()
+
+import json
+import time
+import random
+import hashlib
+import argparse
+import resource
+
+import gevent
+from gevent.lock import Semaphore
+from gevent.queue import Queue, Empty
+from gevent.server import StreamServer
+from gevent.pywsgi import WSGIServer
+
+from tools import get_logger
+from metrics import registry
+from settings import global_conf as gc
+from replies import pack_lines, reply_bytes
+from addons.gitlab import endpoint_label
+
+
+# first reply lines which end an order
+refusals = ('Busy, try later!', 'Slow down, try later!')
+
+
+class FakeGitLab(object):
+    '''
+        WSGI application answering the projects, single project and commits
+        apis of `projects` projects, after `latency` seconds. Responses
+        carry an ETag, requests with a matching If-None-Match get a 304.
+    '''
+    def __init__(self, projects, latency):
+        self.latency = latency
+        self.projects = [{
+            'id': i,
+            'name': 'project-%d' % i,
+            'path': 'project-%d' % i,
+            'path_with_namespace': 'bench/project-%d' % i,
+            'last_activity_at': '2013-%02d-01T00:00:00Z' % (i % 12 + 1),
+            'owner': {'name': 'owner-%d' % (i % 7)},
+        } for i in range(1, projects + 1)]
+
+        # endpoint => requests, status => responses
+        self.requests = {}
+        self.statuses = {}
+
+    def __call__(self, environ, start_response):
+        gevent.sleep(self.latency)
+
+        api_url = environ['PATH_INFO'].split('/api/v3/', 1)[-1]
+        endpoint = endpoint_label(api_url)
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+        body, headers = self.route(api_url, environ.get('QUERY_STRING', ''))
+        if body is None:
+            return self.respond(start_response, '404 Not Found', [],
+                b'{"message":"404 Not Found"}')
+
+        body = json.dumps(body).encode('utf-8')
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        headers.append(('ETag', etag))
+
+        if environ.get('HTTP_IF_NONE_MATCH') == etag:
+            return self.respond(start_response, '304 Not Modified', headers, b'')
+
+        return self.respond(start_response, '200 OK', headers, body)
+
+    def route(self, api_url, query):
+        parts = api_url.strip('/').split('/')
+
+        if parts == ['projects']:
+            params = dict(param.split('=', 1) for param in query.split('&')
+                if '=' in param)
+            page = int(params.get('page', 1))
+            per_page = int(params.get('per_page', 20))
+
+            start = (page - 1) * per_page
+            items = self.projects[start:start + per_page]
+            link = ''
+            if start + per_page < len(self.projects):
+                link = '<projects?page=%d>; rel="next"' % (page + 1)
+            return items, [('Link', link)]
+
+        if len(parts) < 2 or not parts[1].isdigit():
+            return None, []
+
+        project_id = int(parts[1])
+        if not 1 <= project_id <= len(self.projects):
+            return None, []
+
+        project = self.projects[project_id - 1]
+        if len(parts) == 2:
+            return project, []
+
+        if parts[2:] == ['repository', 'commits']:
+            return [{
+                'id': hashlib.sha1(project['name'].encode('utf-8')).hexdigest(),
+                'title': 'Latest commit of %s' % project['name'],
+                'author_name': project['owner']['name'],
+            }], []
+
+        return None, []
+
+    def respond(self, start_response, status, headers, body):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+        start_response(status, headers + [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+
+class FakeIRCServer(object):
+    '''
+        Accepts the bot's connection and, once it joined, runs the users:
+        each one sends an order, waits for all of its reply lines, and asks
+        the next one.
+    '''
+    def __init__(self, bot_nick, users, orders, projects, projects_lines,
+            projects_ratio, seed, timeout=30):
+        self.bot_nick = bot_nick
+        self.users = ['user%d' % i for i in range(users)]
+        self.orders = orders
+        self.projects = projects
+        self.projects_lines = projects_lines
+        self.projects_ratio = projects_ratio
+        self.timeout = timeout
+        self.random = random.Random(seed)
+
+        self.inboxes = dict((user, Queue()) for user in self.users)
+        self.latencies = []
+        self.lines = 0
+        self.refused = 0
+        self.timeouts = 0
+
+        self.started = self.finished = None
+        self.done = gevent.event.Event()
+
+    def handle(self, sock, address):
+        self._sock = sock
+        self._send_lock = Semaphore()
+
+        joined = gevent.event.Event()
+        reader = gevent.spawn(self._read, sock.makefile('rb'), joined)
+
+        joined.wait()
+        self.started = time.time()
+        gevent.joinall([gevent.spawn(self._user, user, self._plan())
+            for user in self.users])
+        self.finished = time.time()
+
+        reader.kill()
+        self.done.set()
+
+    def _plan(self):
+        # orders of a user, drawn here so runs are reproducible
+        plan = []
+        for _ in range(self.orders):
+            if self.random.random() < self.projects_ratio:
+                plan.append(('git projects', self.projects_lines))
+            else:
+                plan.append(('project %d commit' % self.random.randint(
+                    1, self.projects), 1))
+        return plan
+
+    def _read(self, reader, joined):
+        for line in reader:
+            line = line.decode('utf-8').rstrip()
+            parts = line.split(' ', 2)
+
+            if parts[0] == 'PING':
+                self._send('PONG %s' % parts[1])
+            elif parts[0] == 'JOIN':
+                joined.set()
+            elif parts[0] == 'PRIVMSG':
+                target, text = parts[1], parts[2][1:]
+                if target in self.inboxes:
+                    self.lines += 1
+                    self.inboxes[target].put((time.time(), text))
+
+    def _send(self, line):
+        with self._send_lock:
+            self._sock.sendall(('%s\r\n' % line).encode('utf-8'))
+
+    def _user(self, user, plan):
+        inbox = self.inboxes[user]
+
+        for order, expected in plan:
+            sent = time.time()
+            self._send(':%s!~%s@bench PRIVMSG %s :%s: %s' % (user, user,
+                self.bot_nick, self.bot_nick, order))
+
+            try:
+                received, text = inbox.get(timeout=self.timeout)
+                if text in refusals:
+                    self.refused += 1
+                    continue
+
+                self.latencies.append(received - sent)
+                for _ in range(expected - 1):
+                    inbox.get(timeout=self.timeout)
+            except Empty:
+                self.timeouts += 1
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='OupengBot load benchmark')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--orders', type=int, default=20,
+        help='orders asked by each user')
+    parser.add_argument('--projects', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05,
+        help='seconds the fake GitLab takes to answer')
+    parser.add_argument('--projects-ratio', type=float, default=0.02,
+        help='fraction of "git projects" orders, the others ask a commit')
+    parser.add_argument('--send-rate', type=float, default=100000,
+        help='outbound lines per second')
+    parser.add_argument('--limits', action='store_true',
+        help='keep the order limits of the settings')
+    parser.add_argument('--cold', action='store_true',
+        help='don\'t wait for the cache warmup')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--metrics', action='store_true',
+        help='print the bot\'s metrics too')
+    args = parser.parse_args(argv)
+
+    # the bot logs errors only, before it gets its logger
+    get_logger('ircconnection.logger', None, 'ERROR')
+
+    gitlab = FakeGitLab(args.projects, args.latency)
+    gitlab_server = WSGIServer(('127.0.0.1', 0), gitlab, log=None)
+    gitlab_server.start()
+
+    gc.gitlab['api_baseurl'] = 'http://127.0.0.1:%d/api/v3/' % gitlab_server.server_port
+    gc.irc['send_rate'] = gc.irc['send_burst'] = args.send_rate
+    gc.cache['snapshot'] = None
+    gc.webhook['listen'] = None
+    if not args.limits:
+        gc.irc['order_limits'] = {'*': {'sender_rate': None, 'channel_rate': None}}
+
+    # imported once the settings are patched
+    from oupengbots import OupengBot
+
+    # reply lines of git projects: its first page, and the more hint
+    projects_lines = len(list(pack_lines(('project name: %s, id: %s, owner: %s' % (
+        proj['name'], proj['id'], proj['owner']['name'])
+        for proj in gitlab.projects), reply_bytes)))
+    if gc.irc['page_lines'] and projects_lines > gc.irc['page_lines']:
+        projects_lines = gc.irc['page_lines'] + 1
+
+    irc = FakeIRCServer('bench', args.users, args.orders, args.projects,
+        projects_lines, args.projects_ratio, args.seed)
+    irc_server = StreamServer(('127.0.0.1', 0), irc.handle)
+    irc_server.start()
+
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    bot = OupengBot('bench')
+    if not args.cold:
+        bot.warmup.join()
+    warmup_requests = sum(gitlab.requests.values())
+
+    gevent.spawn(bot.run, '127.0.0.1', irc_server.server_port, '#bench')
+    irc.done.wait()
+
+    duration = irc.finished - irc.started
+    served = len(irc.latencies)
+
+    print('users %d, orders %d, projects %d, gitlab latency %.3fs' % (
+        args.users, args.users * args.orders, args.projects, args.latency))
+    print('duration          %10.2f s' % duration)
+    print('orders/s          %10.1f' % (served / duration))
+    print('reply lines/s     %10.1f' % (irc.lines / duration))
+    print('latency p50       %10.2f ms' % (percentile(irc.latencies, 0.5) * 1000))
+    print('latency p99       %10.2f ms' % (percentile(irc.latencies, 0.99) * 1000))
+    print('refused/timeouts  %10d / %d' % (irc.refused, irc.timeouts))
+    print('max rss growth    %10d KB' % (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory))
+    print('gitlab requests   %10d (%d during warmup)' % (
+        sum(gitlab.requests.values()), warmup_requests))
+    for endpoint, count in sorted(gitlab.requests.items()):
+        print('    %-40s %6d' % (endpoint, count))
+    for status, count in sorted(gitlab.statuses.items()):
+        print('    %-40s %6d' % (status, count))
+
+    if args.metrics:
+        for line in registry.summary():
+            print(line)
+
+    bot.disconnect_ircserver()
+    irc_server.stop()
+    gitlab_server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf8 -*-
+'''
+    micro-benchmark for order dispatching, run it from the repo root:
+
+        python -m benchmarks.bench_orders
+
+    compares the per-command cost of the former two linear scans in
+    IRCBot.serve against OrderDispatcher.match, with a growing number of
+    registered orders.
+'''
+
+import re
+import timeit
+
+from orders import OrderDispatcher
+
+
+def make_orders(count):
+    orders = [
+        (re.compile(r'^\s*git projects\s*$'), None, 'help'),
+        (re.compile(r'^\s*project\s(?P<project_id>.*?)\scommit'), None, 'help'),
+    ]
+
+    for i in range(count - len(orders)):
+        pattern = r'^\s*order%d\s(?P<arg>\S+)\s*$' % i
+        orders.append((re.compile(pattern), None, 'help'))
+
+    return orders
+
+
+def legacy_dispatch(orders, text):
+    # what IRCBot.serve did: _validate_order, then a second scan
+    res = [x[0] for x in orders]
+    if not [x for x in res if x.match(text)]:
+        return None
+
+    for pattern, handler, help_text in orders:
+        match = pattern.match(text)
+        if match:
+            return match.groupdict()
+
+
+def main(number=20000):
+    commands = ['project 123 commit', 'git projects', 'no such order']
+
+    print('%8s %12s %12s' % ('orders', 'legacy(us)', 'compiled(us)'))
+    for count in (2, 10, 100, 500):
+        orders = make_orders(count)
+
+        dispatcher = OrderDispatcher()
+        for order in orders:
+            dispatcher.add(order)
+
+        legacy = compiled = 0.0
+        for text in commands:
+            legacy += timeit.timeit(lambda: legacy_dispatch(orders, text),
+                number=number)
+            compiled += timeit.timeit(lambda: dispatcher.match(text),
+                number=number)
+
+        total = float(number * len(commands))
+        print('%8d %12.2f %12.2f' % (count, legacy / total * 1e6,
+            compiled / total * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# -*- coding: utf8 -*-
+'''
+    micro-benchmark for IRC line parsing, run it from the repo root:
+
+        python -m benchmarks.bench_parser
+
+    compares IRCBot.parsemsg (plus the params join handle used to do for
+    logging) against ircmessage.parse_message, with and without skipping
+    the commands the bot has no handler for, and IRCProtocol.handle, the
+    whole per-line work of the reader with the traffic log off.
+'''
+
+import timeit
+import logging
+
+from ircmessage import parse_message
+from ircprotocol import IRCProtocol
+
+
+# lines as seen from freenode in a busy channel
+CORPUS = [
+    ':xpen!~xpen@10.0.0.1 PRIVMSG #channel :bot: git projects',
+    ':xpen!~xpen@10.0.0.1 PRIVMSG #channel :bot: project 123 commit',
+    ':alice!~alice@unaffiliated/alice PRIVMSG #channel :anyone seen the build break this morning?',
+    ':bob!~bob@gateway/web/freenode/ip.10.0.0.2 PRIVMSG #channel :yes, reverting now',
+    ':carol!carol@2001:db8::1 JOIN #channel',
+    ':dave!~dave@host-10-0-0-3.example.com PART #channel :"Leaving"',
+    ':erin!~erin@10.0.0.4 QUIT :Ping timeout: 260 seconds',
+    ':ChanServ!ChanServ@services. MODE #channel +o xpen',
+    ':frank!~frank@10.0.0.5 NICK :frank_away',
+    'PING :wright.freenode.net',
+    ':wright.freenode.net 353 bot = #channel :bot @xpen alice bob carol dave',
+    ':wright.freenode.net 366 bot #channel :End of /NAMES list.',
+    ':wright.freenode.net NOTICE * :*** Looking up your hostname...',
+    '@time=2012-11-03T00:09:18.000Z;account=alice :alice!~alice@unaffiliated/alice PRIVMSG #channel :hello',
+]
+
+WANTED = set(['PING', 'PRIVMSG', 'NICKINUSE', '433'])
+
+
+def legacy_parsemsg(msg):
+    # IRCBot.parsemsg, which does not know about tags
+    prefix = ''
+    trailing = []
+
+    if msg[0] == ':':
+        prefix, msg = msg[1:].split(' ', 1)
+
+    if msg.find(' :') != -1:
+        msg, trailing = msg.split(' :', 1)
+        args = msg.split()
+        args.append(trailing)
+
+    else:
+        args = msg.split()
+
+    command = args.pop(0)
+
+    return prefix, command, args
+
+
+def legacy_handle(corpus):
+    for line in corpus:
+        prefix, command, params = legacy_parsemsg(line)
+        'parsed message: cmd=>[%s] prefix=>[%s], params=>[%s]' % (
+            command, prefix, ' '.join(params))
+
+
+def parse_all(corpus, commands=None):
+    for line in corpus:
+        parse_message(line, commands)
+
+
+class Protocol(IRCProtocol):
+    def irc_PRIVMSG(self, prefix, params):
+        pass
+
+    def irc_PING(self, prefix, params):
+        pass
+
+
+def handle_all(protocol, corpus):
+    for line in corpus:
+        protocol.handle(line)
+
+
+def main(number=20000):
+    total = float(number * len(CORPUS))
+
+    protocol = Protocol('bot', verbosity='ERROR')
+    protocol.traffic.setLevel(logging.ERROR)
+
+    cases = [
+        ('parsemsg + log join', lambda: legacy_handle(CORPUS)),
+        ('parse_message', lambda: parse_all(CORPUS)),
+        ('parse_message, skipping', lambda: parse_all(CORPUS, WANTED)),
+        ('IRCProtocol.handle', lambda: handle_all(protocol, CORPUS)),
+    ]
+
+    for name, func in cases:
+        elapsed = timeit.timeit(func, number=number)
+        print('%-26s %8.3f us/line' % (name, elapsed / total * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# -*- coding: utf8 -*-
+
+import re
+import unittest
+
+import gevent
+
+from ircprotocol import IRCProtocol, ChannelPolicy
+
+
+class BotHost(object):
+    '''
+        Runs many IRC connections, each with many channels, in one process,
+        one greenlet per connection.
+
+        bot_factory(nickname) returns the bot for a new connection, it is up
+        to the factory to share the expensive parts (GitLab client, cache)
+        between the bots.
+    '''
+    def __init__(self, bot_factory):
+        self.bot_factory = bot_factory
+        self.networks = []
+
+    def add_network(self, server, port, nickname, channels):
+        '''
+            channels maps channel names to ChannelPolicy instances, or to
+            the keyword arguments of one, as in settings.global_conf.networks
+        '''
+        policies = {}
+        for channel, policy in channels.items():
+            if not isinstance(policy, ChannelPolicy):
+                policy = ChannelPolicy(**(policy or {}))
+            policies[channel] = policy
+
+        bot = self.bot_factory(nickname)
+        self.networks.append((bot, server, port, policies))
+
+        return bot
+
+    def serve_forever(self):
+        greenlets = [gevent.spawn(bot.run, server, port, channels)
+            for bot, server, port, channels in self.networks]
+
+        gevent.joinall(greenlets)
+
+
+class FakeOutbound(list):
+    def put(self, line):
+        self.append(line.rstrip())
+
+
+def latest_commit():
+    return 'latest'
+
+
+def projects():
+    return 'projects'
+
+
+class FakeBot(IRCProtocol):
+    def __init__(self, nick):
+        super(FakeBot, self).__init__(nick)
+        self._outbound = FakeOutbound()
+        self.register_order([
+            (re.compile(r'^commit$'), latest_commit, 'commit'),
+            (re.compile(r'^projects$'), projects, 'projects'),
+        ])
+
+    def run(self, server, port, channels):
+        self.server = server
+        self.join_all(channels)
+
+    def said(self, sender, channel, text):
+        del self._outbound[:]
+        self.handle(':%s!~%s@10.0.0.1 PRIVMSG %s :%s' % (sender, sender,
+            channel, text))
+        return self._outbound
+
+
+class testBotHost(unittest.TestCase):
+    def setUp(self):
+        self.host = BotHost(FakeBot)
+        self.dev = self.host.add_network('irc.dev', 6667, 'bot', {
+            '#dev': {},
+            '#ops': {'orders': ['latest_commit'], 'reply_privately': False},
+        })
+        self.other = self.host.add_network('irc.other', 6697, 'bot2', {
+            '#other': ChannelPolicy(),
+        })
+        self.host.serve_forever()
+
+    def testJoin(self):
+        self.assertEqual((self.dev.nick, self.dev.server), ('bot', 'irc.dev'))
+        self.assertEqual(sorted(self.dev._outbound),
+            ['JOIN #dev', 'JOIN #ops'])
+        self.assertEqual(self.other._outbound, ['JOIN #other'])
+
+    def testRouting(self):
+        # replied privately, with a notice in the channel
+        self.assertEqual(self.dev.said('xpen', '#dev', 'bot: commit'), [
+            'PRIVMSG xpen :latest',
+            'PRIVMSG #dev :Message has been send privately!'])
+
+        # replied in the channel, other orders are not served there
+        self.assertEqual(self.dev.said('alice', '#ops', 'bot: commit'),
+            ['PRIVMSG #ops :latest'])
+        self.assertEqual(self.dev.said('alice', '#ops', 'bot: projects'),
+            ['PRIVMSG alice :commit', 'PRIVMSG alice :%s' %
+                'Get the next lines of a long reply: more'])
+
+        # each bot serves its own channels only
+        self.assertEqual(self.other.said('xpen', '#dev', 'bot2: commit'),
+            ['PRIVMSG xpen :Hey, Leave me alone!'])
+        self.assertEqual(self.other.said('xpen', '#other', 'bot2: projects'),
+            ['PRIVMSG xpen :projects',
+            'PRIVMSG #other :Message has been send privately!'])
+
+
+if __name__ == '__main__':
+    unittest.main()
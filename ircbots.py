@@ -1,114 +1,91 @@
 # -*- coding: utf8 -*-
 
-import sys
-import random
-import re
+import time
+import unittest
 
 import gevent
 from gevent import socket
-from gevent.pool import Pool
-
-from tools import get_logger
-
-
-class IRCBadMessage(BaseException):
-    pass
-
-
-class IRCBot(object):
-    digit_cmd_map = {
-        '433': 'nickinuse',
-    }
-
-    def __init__(self, nick, logfile=None, verbosity='INFO'):
-        self.nick = self.base_nick = nick
-
-        self.logger = get_logger('ircconnection.logger', logfile, verbosity)
-
-        # gevent pool
-        self.gpool = Pool(10)
-
-        self._valid_orders = []
-
-    def parsemsg(self, msg):
-        """
-            Breaks a message from an IRC server into its prefix, command, and arguments.
-        """
-        prefix = ''
-        trailing = []
-
-        '''
-            according to rfc2812, the message format is:
-            :<prefix> <command> <params> :<trailing>
-
-            here are some examples:
-            :CalebDelnay!calebd@localhost PRIVMSG #mychannel :Hello everyone!
-            :CalebDelnay!calebd@localhost QUIT :Bye bye!
-            :CalebDelnay!calebd@localhost JOIN #mychannel
-            :CalebDelnay!calebd@localhost MODE #mychannel -l
-            PING :irc.localhost.localdomain
-        '''
-        if not msg:
-            raise IRCBadMessage("Empty line.")
-
-        if msg[0] == ':':
-            prefix, msg = msg[1:].split(' ', 1)
-
-        if msg.find(' :') != -1:
-            msg, trailing = msg.split(' :', 1)
-            args = msg.split()
-            args.append(trailing)
-
-        else:
-            args = msg.split()
-
-        command = args.pop(0)
-        
-        return prefix, command, args
-
-    def _handleMsg(self, prefix, command, params):
-        """
-            Determine the function to call for the given command and call it with
-            the given arguments.
-        """
-        if command.isdigit():
-            command = self.convert_digit_cmd(command)
-
-        # we could get nothing if the command is digits format as 433
-        # if we get the digits command those we don't know how to handle
-        # it, using irc_IGNORECMD instead
-        method = getattr(self, "irc_%s" % command.upper(), None)
-
-        try:
-            if method is not None:
-                method(prefix, params)
-
-            else:
-                self.irc_unknown(prefix, command, params)
-        except BaseException as e:
-            self.logger.error('Exception: %s' % e)
-        
-    def convert_digit_cmd(self, cmd):
-        real_cmd_name = self.digit_cmd_map.get(cmd, 'ignorecmd')
-        return real_cmd_name.upper()
-
-    def irc_NICKINUSE(self, prefix, params):
-        ''' 
-            handle message like this:
-            :wright.freenode.net 433 * bot :Nickname is already in use.
-        '''
-        # seems there is already a bot running now
-        self.disconnect_ircserver()
-
-    def irc_unknown(self, prefix, command, params):
-        """
-        Called by L{handleCommand} on a command that doesn't have a defined
-        handler. Subclasses should override this method.
-        """
-        raise NotImplementedError(command, prefix, params)
-
-    def irc_IGNORECMD(self, prefix, params):
-        self.logger.info('Request ignored')
+from gevent.event import Event
+
+from tools import TokenBucket, Backoff
+from ircprotocol import IRCProtocol
+from ircmessage import IRCBadMessage
+from outbound import OutboundQueue
+from scheduler import Scheduler
+
+
+class GeventOutboundQueue(OutboundQueue):
+    '''
+        OutboundQueue drained by a writer greenlet.
+    '''
+    def __init__(self, write, bucket=None, logger=None):
+        super(GeventOutboundQueue, self).__init__(write, bucket, logger)
+
+        self._wakeup = Event()
+        self._writer = None
+
+    def start(self):
+        if self._writer is None:
+            self._writer = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._writer is not None:
+            self._writer.kill()
+            self._writer = None
+
+    def _notify(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            batch, control = self._next_batch()
+
+            if batch:
+                try:
+                    self._write(''.join(batch))
+                except (IOError, OSError) as e:
+                    self._write_failed(batch, control, e)
+                    self._writer = None
+                    return
+
+            if self._control:
+                continue
+
+            self._wakeup.clear()
+            self._wakeup.wait(self._next_timeout())
+
+
+class IRCBot(IRCProtocol):
+    def __init__(self, nick, logfile=None, verbosity='INFO',
+            send_rate=1, send_burst=5, order_concurrency=10, order_queue=50,
+            order_limits=None, merge_window=5, page_lines=10,
+            reconnect_delay=1, reconnect_max_delay=300, order_deadlines=None,
+            cpu_workers=2, admins=None, idle_timeout=120):
+        super(IRCBot, self).__init__(nick, logfile, verbosity,
+            order_limits, merge_window, page_lines, order_deadlines,
+            cpu_workers, admins)
+
+        # run reconnects until disconnect_ircserver is called
+        self.backoff = Backoff(reconnect_delay, reconnect_max_delay)
+        self.stopped = False
+
+        # after idle_timeout seconds without a line the server is sent a
+        # PING, without a line idle_timeout seconds more the connection is
+        # lost (None not to check)
+        self.idle_timeout = idle_timeout
+        self._keepalive = None
+        self._last_read = None
+
+        # protocol traffic is handled inline by the reader, orders run in
+        # the orders lane: order_concurrency at once, order_queue waiting
+        self.scheduler = Scheduler({
+            'orders': (order_concurrency, order_queue),
+        }, self.logger)
+
+        # outbound lines, paced by a token bucket: send_rate lines per
+        # second, with bursts of send_burst lines
+        self._outbound = GeventOutboundQueue(self._write,
+            TokenBucket(send_rate, send_burst), self.logger)
 
     def connect_ircserver(self, server, port):
         self.server = server
@@ -118,187 +95,228 @@ class IRCBot(object):
         try:
             self._socket.connect((self.server, self.port))
         except socket.error:
-            self.logger.error('Unable to connect to %s on port %d' % (self.server, self.port), exc_info=1)
-            sys.exit(1)
-
-        self._sock_file = self._socket.makefile()
-
+            self.logger.error('Unable to connect to %s on port %d', self.server, self.port, exc_info=1)
+            self._socket.close()
+            raise
+
+        # what the server sends is not always utf8: a bad byte must not
+        # pass for a closed file (UnicodeDecodeError is a ValueError)
+        self._sock_file = self._socket.makefile('rw', encoding='utf-8',
+            errors='replace', newline='')
+
+        # what was queued for the former connection follows the
+        # registration
+        self._outbound.discard_control()
+        self.register_gauges()
         self.register_nick()
         self.register()
+        self._outbound.start()
+
+        self._last_read = time.time()
+        if self.idle_timeout is not None:
+            self._keepalive = gevent.spawn(self._keep_alive)
 
     def disconnect_ircserver(self):
-        self.gpool.kill()
+        self.stopped = True
+        self.running = False
+
+        self.scheduler.kill()
+        self.stop_workers()
+        self._stop_keepalive()
+        self._outbound.stop()
+        self._socket.close()
+
+    def _connection_lost(self):
+        # orders being served go on, their lines wait for the next
+        # connection
+        self.running = False
+        self._stop_keepalive()
+        self._outbound.stop()
         self._socket.close()
 
-    def send(self, msg):
-        if not msg.endswith('\r\n'):
-            msg += '\r\n'
-        
-        self.logger.info(msg)     
-        self._sock_file.write(msg)
+    def _keep_alive(self):
+        '''
+            Tell a silent server from a dead connection: a socket timeout
+            would leave the socket file unusable, the socket is shut down
+            here instead, which ends the reader's readline.
+        '''
+        pinged = False
+        while True:
+            idle = time.time() - self._last_read
+            if idle < self.idle_timeout:
+                pinged = False
+                gevent.sleep(self.idle_timeout - idle)
+
+            elif not pinged:
+                self.send('PING :%s' % self.server)
+                pinged = True
+                gevent.sleep(self.idle_timeout)
+
+            else:
+                self.logger.error('No reply from %s in %g seconds',
+                    self.server, 2 * self.idle_timeout)
+                self._keepalive = None
+                try:
+                    self._socket.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                self._connection_lost()
+                return
+
+    def _stop_keepalive(self):
+        if self._keepalive is not None:
+            self._keepalive.kill(block=False)
+            self._keepalive = None
+
+    def _write(self, data):
+        # called by the outbound writer greenlet only, with as many lines
+        # as the flood control allows
+        self._sock_file.write(data)
         self._sock_file.flush()
 
     def join_channel(self, channel):
-        if not channel.startswith('#'):
-            channel = '#%s' % channel
-        
-        self.channel = channel
+        self.join(channel)
+        self._enter_eventloop()
 
-        self.logger.debug('joining %s' % channel)
-        self.send('JOIN %s' % channel)
+    def run(self, server, port, channels):
+        '''
+            Connect, join channels (see IRCProtocol.join_all) and serve
+            until disconnect_ircserver is called: a lost connection is
+            opened again after a backoff delay, the channels joined again
+            and the lines not sent yet are sent then. If the former session
+            still holds the nick, an alternate one is used until the nick
+            is free again.
+        '''
+        self.stopped = False
+        self.reclaim_nick = True
+        joined = False
 
-        self._enter_eventloop()
+        while not self.stopped:
+            try:
+                self.connect_ircserver(server, port)
+            except socket.error:
+                self._wait_reconnect()
+                continue
+
+            if joined:
+                self.rejoin()
+            else:
+                self.join_all(channels)
+                joined = True
+
+            self._enter_eventloop()
+            if not self.stopped:
+                self._wait_reconnect()
+
+    def _wait_reconnect(self):
+        delay = self.backoff.next()
+        self.logger.error('Reconnecting to %s in %.1f seconds', self.server, delay)
+        gevent.sleep(delay)
 
     def _enter_eventloop(self):
         self.running = True
         while self.running:
             try:
                 message = self._sock_file.readline()
-            except socket.error:
+            except (socket.error, ValueError):
+                # ValueError: the file has been closed
                 message = None
             
             if not message:
-                self.disconnect_ircserver()
+                if self.running:
+                    self._connection_lost()
                 return True
-            
-            message = message.rstrip()
-            self.gpool.spawn(self.handle, message)
-
-    def handle(self, msg):
-        self.logger.info('Handle %s' % msg)
-        prefix, command, params = self.parsemsg(msg)
-
-        log_text = 'parsed message: cmd=>[%s] prefix=>[%s], params=>[%s]'
-        self.logger.info(log_text % (command, prefix, ' '.join(params)))
-
-        self._handleMsg(prefix, command, params)
-
-    def register_nick(self):
-        self.logger.info('Registering nick %s' % self.nick)
-        self.send('NICK %s' % self.nick)
-
-    def register(self):
-        self.logger.info('Authing as %s' % self.nick)
-        self.send('USER %s %s bla :%s' % (self.nick, self.server, self.nick))
-
-    def irc_PING(self, prefix, params):
-        """
-            NOTE: ONLY response to periodic PING messages from server 
-
-            If there is no prefix, then the source of the 
-            message is the server for the current connection, 
-            as in this PING method
-        """
-        assert prefix == '', 'where is this PING message from?'
-
-        # ping message from server
-        self.send('PONG :%s' % params[0])
-
-    def irc_PRIVMSG(self, prefix, params):
-        # handle msg like the following:
-        # :xpen!~xpen@10.0.0.1 PRIVMSG bot :git project
-        # ('xpen!~xpen@10.0.0.1', 'PRIVMSG', ['bot', 'bot: hi'])
-        # ('xpen!~xpen@10.0.0.1', 'PRIVMSG', ['bot', 'hi'])
-
-        # in channel: bot: hi
-        # :xpen!~xpen@10.0.0.1 PRIVMSG #channel :bot: hi
-        # ('xpen!~xpen@10.0.0.1', 'PRIVMSG', ['#channel', 'bot: hi'])
-
-        # in channel: xxx
-        # :xpen!~xpen@10.0.0.1 PRIVMSG #channel :xxx
-        # ('xpen!~xpen@10.0.0.1', 'PRIVMSG', ['#channel', 'xxx'])
-
-        # NOTE: always send message as private msg to the person who emits this
-        # check this message is send to me
-        channel, msg = params
-
-        if channel != self.channel and channel != self.nick:
-            self.logger.info('Peeping Tom is here')
-            self.send('PRIVMSG %s :%s' % (sender, "Hey, Leave me alone!"))
-            return
-
-        # don't interupt normal communication(talking in the channel)
-        if re.match('%s:'%self.nick, msg):
-            me, msg = msg.split(':', 1)
-            sender = prefix.split('!', 1)[0]
-            
-            # echo in channel
-            is_in_channel = channel == self.channel
-            self.serve(sender, msg.strip(), is_in_channel)
 
-    def _register_single_order(self, order):
-        '''
-            order should be a tuple, and values are: 
-            (re object, handler, help_txt)
-        '''
-        if not isinstance(order, tuple):
-            raise Exception('tuple required')
+            # the server talks, the next drop starts a new backoff
+            self.backoff.reset()
+            self._last_read = time.time()
             
-        if self._validate_order(order):
-            raise Exception('Order already defined')
+            try:
+                self.handle(message.rstrip())
+            except IRCBadMessage as e:
+                self.logger.error('Bad message %r: %s', message, e)
+
+    def run_order(self, pending, handler, kwargs, queued=None):
+        # kills the handler, and the GitLab calls it waits for
+        timeout = gevent.Timeout(self.order_deadline(handler, queued))
+        timeout.start()
+        try:
+            super(IRCBot, self).run_order(pending, handler, kwargs, queued)
+        except gevent.Timeout as e:
+            if e is not timeout:
+                raise
+            self.order_timed_out(pending, handler)
+        finally:
+            timeout.cancel()
 
-        help_text = order[2]
-        if (help_text == '' or help_text is None or
-            not isinstance(help_text, str)):
-            raise Exception('Help text required')
+    def execute_order(self, pending, handler, kwargs):
+        if not self.scheduler.submit('orders', self.run_order,
+                pending, handler, kwargs, time.time()):
+            self.order_dropped(pending, handler)
 
-        handler = order[1]
-        if callable(handler):
-            self._valid_orders.append(order)
-            self.logger.info('successfully added handler')
 
-        else:
-            raise Exception('Your order seems invalid')
+class testIRCBot(unittest.TestCase):
+    def testEncoding(self):
+        from gevent.server import StreamServer
 
-    def register_order(self, orders):
-        for order in orders:
-            self._register_single_order(order)
+        received = []
 
-    def _validate_order(self, order):
-        res = [x[0] for x in self._valid_orders]
+        def handle_client(sock, address):
+            sock_file = sock.makefile('rwb')
+            sock_file.write(b':xpen!~xpen@10.0.0.1 PRIVMSG bot :caf\xe9\r\n')
+            sock_file.write(b'PING :fake.server\r\n')
+            sock_file.flush()
 
-        is_valid = False
-        if isinstance(order, tuple):
-            is_valid = True if order[0] in res else False
+            for line in sock_file:
+                received.append(line.decode('utf-8').rstrip())
+                if line.startswith(b'PONG'):
+                    break
 
-        if isinstance(order, str):
-            matched = filter(lambda x: x.match(order), res)
-            is_valid = matched != []
+            bot.disconnect_ircserver()
 
-        return is_valid
+        server = StreamServer(('127.0.0.1', 0), handle_client)
+        server.start()
 
-    # always send private msg to the person who asks for 
-    # it even get this from channel
-    # if get message from channel, give a feedback as 
-    # 'message has been send privately!'
-    def serve(self, sender, order, is_in_channle=False):
-        self.logger.info('In: sender=>[%s],  order=>[%s]' %(sender, order))
-        # only registered orders allowed
-        if not self._validate_order(order):
-            self.logger.error('Invalid order %s' % order)
+        bot = IRCBot('bot', send_rate=100, send_burst=100)
+        try:
+            bot.connect_ircserver('127.0.0.1', server.server_port)
+            with gevent.Timeout(5):
+                bot._enter_eventloop()
+        finally:
+            server.stop()
+
+        self.assertEqual(received, ['NICK bot', 'USER bot 127.0.0.1 bla :bot',
+            'PONG :fake.server'])
 
-            for order in self._valid_orders:
-                self.send('PRIVMSG %s :%s' % (sender, order[2]))
+    def testSilentServer(self):
+        from gevent.server import StreamServer
 
-            return
+        received = []
+        closed = Event()
 
-        # ok, let's do it
-        response = []
-        for registered_handler in self._valid_orders:
-            pattern, handler, help_text = registered_handler
+        def handle_client(sock, address):
+            # reads, never answers
+            for line in sock.makefile('rb'):
+                received.append(line.decode('utf-8').rstrip())
+            closed.set()
 
-            match = pattern.match(order)
-            if match:
-                result = handler(**match.groupdict())
+        server = StreamServer(('127.0.0.1', 0), handle_client)
+        server.start()
 
-                if isinstance(result, list):
-                    response.extend(result)
+        bot = IRCBot('bot', send_rate=100, send_burst=100, idle_timeout=0.05)
+        try:
+            bot.connect_ircserver('127.0.0.1', server.server_port)
+            with gevent.Timeout(5):
+                self.assertTrue(bot._enter_eventloop())
+                closed.wait()
+        finally:
+            server.stop()
 
-                else:
-                    response.append(result)
+        self.assertFalse(bot.running)
+        self.assertIsNone(bot._keepalive)
+        self.assertEqual(received, ['NICK bot', 'USER bot 127.0.0.1 bla :bot',
+            'PING :127.0.0.1'])
 
-        for result in response:
-            self.send('PRIVMSG %s :%s' % (sender, result))
 
-        if is_in_channle:
-            self.send('PRIVMSG %s :%s' %(self.channel, 'Message has been send privately!'))
+if __name__ == '__main__':
+    unittest.main()
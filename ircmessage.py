@@ -0,0 +1,196 @@
+# -*- coding: utf8 -*-
+
+import unittest
+
+
+class IRCBadMessage(BaseException):
+    pass
+
+
+# IRCv3 message tags escaping:
+# http://ircv3.net/specs/core/message-tags-3.2.html
+_tag_escapes = {
+    ':': ';',
+    's': ' ',
+    '\\': '\\',
+    'r': '\r',
+    'n': '\n',
+}
+
+
+def _unescape_tag_value(value):
+    if '\\' not in value:
+        return value
+
+    chars = []
+    escaped = False
+    for char in value:
+        if escaped:
+            chars.append(_tag_escapes.get(char, char))
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        else:
+            chars.append(char)
+
+    return ''.join(chars)
+
+
+class Message(object):
+    '''
+        A parsed IRC message:
+        [@<tags> ][:<prefix> ]<command>[ <params>][ :<trailing>]
+
+        prefix is '' if the message has no prefix (as the former
+        IRCBot.parsemsg did), nick/user/host and tags are only split out of
+        the raw line when they are asked for.
+    '''
+    __slots__ = ('raw', 'prefix', 'command', 'params', '_tags')
+
+    def __init__(self, raw, prefix, command, params, tags=None):
+        self.raw = raw
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+        self._tags = tags
+
+    def __repr__(self):
+        return '<Message cmd=>[%s] prefix=>[%s], params=>%r>' % (
+            self.command, self.prefix, self.params)
+
+    @property
+    def nick(self):
+        end = self.prefix.find('!')
+        if end == -1:
+            end = self.prefix.find('@')
+        return self.prefix if end == -1 else self.prefix[:end]
+
+    @property
+    def user(self):
+        start = self.prefix.find('!')
+        if start == -1:
+            return None
+        end = self.prefix.find('@', start)
+        return self.prefix[start + 1:] if end == -1 else self.prefix[start + 1:end]
+
+    @property
+    def host(self):
+        start = self.prefix.find('@')
+        return None if start == -1 else self.prefix[start + 1:]
+
+    @property
+    def tags(self):
+        tags = self._tags
+        if tags is None:
+            return {}
+
+        # tags are kept as the raw string until first access
+        if not isinstance(tags, dict):
+            parsed = {}
+            for item in tags.split(';'):
+                if not item:
+                    continue
+                key, sep, value = item.partition('=')
+                parsed[key] = _unescape_tag_value(value) if sep else True
+            tags = self._tags = parsed
+
+        return tags
+
+
+def parse_message(line, commands=None):
+    '''
+        Parse a line (without the trailing CRLF) from an IRC server into a
+        Message.
+
+        If commands is given (upper case), lines whose command is not in it
+        are skipped as soon as the command is known and None is returned
+        instead.
+    '''
+    if not line:
+        raise IRCBadMessage("Empty line.")
+
+    raw = line
+    tags = None
+    if line[0] == '@':
+        tags, sep, line = line[1:].partition(' ')
+        if not line:
+            raise IRCBadMessage("Tags without command.")
+
+    prefix = ''
+    if line[0] == ':':
+        prefix, sep, line = line[1:].partition(' ')
+        if not line:
+            raise IRCBadMessage("Prefix without command.")
+
+    command, sep, line = line.partition(' ')
+    # commands are case insensitive, servers send them upper case
+    if (commands is not None and command not in commands and
+            command.upper() not in commands):
+        return None
+
+    if not line:
+        params = []
+
+    elif line[0] == ':':
+        params = [line[1:]]
+
+    else:
+        line, sep, trailing = line.partition(' :')
+        params = line.split()
+        if sep:
+            params.append(trailing)
+
+    return Message(raw, prefix, command, params, tags)
+
+
+class testParseMessage(unittest.TestCase):
+    def testPrivmsg(self):
+        line = ':xpen!~xpen@10.0.0.1 PRIVMSG #channel :bot: git projects'
+        message = parse_message(line)
+
+        self.assertEqual(message.prefix, 'xpen!~xpen@10.0.0.1')
+        self.assertEqual(message.command, 'PRIVMSG')
+        self.assertEqual(message.params, ['#channel', 'bot: git projects'])
+        self.assertEqual((message.nick, message.user, message.host),
+            ('xpen', '~xpen', '10.0.0.1'))
+        self.assertEqual(message.tags, {})
+
+    def testNoPrefix(self):
+        message = parse_message('PING :irc.localhost.localdomain')
+
+        self.assertEqual(message.prefix, '')
+        self.assertEqual(message.command, 'PING')
+        self.assertEqual(message.params, ['irc.localhost.localdomain'])
+
+    def testMiddleParams(self):
+        message = parse_message(':CalebDelnay!calebd@localhost MODE #mychannel -l')
+        self.assertEqual(message.params, ['#mychannel', '-l'])
+
+        message = parse_message(':wright.freenode.net 433 * bot :Nickname is already in use.')
+        self.assertEqual(message.command, '433')
+        self.assertEqual(message.params, ['*', 'bot', 'Nickname is already in use.'])
+        self.assertEqual(message.nick, 'wright.freenode.net')
+        self.assertIsNone(message.user)
+
+    def testTags(self):
+        line = '@time=2012-11-03T00:09:18.000Z;msgid=a\\sb\\:c;bot :n!u@h PRIVMSG #c :hi'
+        message = parse_message(line)
+
+        self.assertEqual(message.command, 'PRIVMSG')
+        self.assertEqual(message.tags, {'time': '2012-11-03T00:09:18.000Z',
+            'msgid': 'a b;c', 'bot': True})
+
+    def testSkip(self):
+        line = ':n!u@h PRIVMSG #c :hi'
+        self.assertIsNone(parse_message(line, commands=set(['PING'])))
+        self.assertIsNotNone(parse_message(line, commands=set(['PRIVMSG'])))
+        self.assertIsNotNone(parse_message(':n!u@h privmsg #c :hi',
+            commands=set(['PRIVMSG'])))
+
+    def testBadMessage(self):
+        self.assertRaises(IRCBadMessage, parse_message, '')
+        self.assertRaises(IRCBadMessage, parse_message, ':prefix-only')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,822 @@
+# -*- coding: utf8 -*-
+
+import re
+import time
+import types
+import weakref
+import unittest
+
+import workers
+from tools import get_logger
+from limits import OrderLimiter
+from metrics import registry
+from replies import PagedReply, Cursor
+from addons.cache import LRUCacher
+from orders import OrderDispatcher
+from ircmessage import parse_message
+
+
+class ChannelPolicy(object):
+    '''
+        Per-channel routing and reply policy.
+
+        orders: names of the order handlers served in the channel, None
+        for all of them
+        reply_privately: answer the orders asked in the channel privately,
+        with a notice in the channel, or in the channel itself
+    '''
+    def __init__(self, orders=None, reply_privately=True):
+        self.orders = orders if orders is None else frozenset(orders)
+        self.reply_privately = reply_privately
+
+    def allows(self, handler):
+        return self.orders is None or handler.__name__ in self.orders
+
+
+class PendingOrder(object):
+    '''
+        An order being served, or served less than merge_window seconds
+        ago: who asked for it, the lines replied so far and, once served,
+        the cursor to the lines left.
+    '''
+    __slots__ = ('key', 'askers', 'lines', 'finished', 'cursor')
+
+    def __init__(self, key, sender, channel=None):
+        self.key = key
+        self.askers = [(sender, channel)]
+        self.lines = []
+        self.finished = None
+        self.cursor = None
+
+
+class IRCProtocol(object):
+    '''
+        IRC message handling, shared by the connection engines: the gevent
+        one in ircbots and the asyncio one in aioircbots.
+
+        Engines connect to the server, feed every received line to handle,
+        provide disconnect_ircserver and an outbound queue as self._outbound
+        (with put/start/stop), which send puts the lines into.
+    '''
+    digit_cmd_map = {
+        '433': 'nickinuse',
+    }
+
+    def __init__(self, nick, logfile=None, verbosity='INFO',
+            order_limits=None, merge_window=5, page_lines=10,
+            order_deadlines=None, cpu_workers=2, admins=None):
+        self.nick = self.base_nick = nick
+        # set by the engines' run: a nick in use is replaced by an
+        # alternate one, and base_nick is asked again at every PING
+        self.reclaim_nick = False
+        self._nick_attempts = 0
+
+        self.logger = get_logger('ircconnection.logger', logfile, verbosity)
+        # raw lines in and out, see tools.get_logger for its level and
+        # sampling
+        self.traffic = self.logger.getChild('traffic')
+
+        self.metrics = registry
+        # lines read, and skipped unparsed: plain counts, a metric per
+        # line would cost more than the parsing
+        self.lines_read = self.lines_skipped = 0
+
+        self._valid_orders = OrderDispatcher()
+
+        # per sender and per channel token buckets, see limits.OrderLimiter
+        self.limiter = OrderLimiter(order_limits)
+
+        # identical orders asked while one is served, or less than
+        # merge_window seconds after, are answered by the same execution
+        self.merge_window = merge_window
+        self._pending_orders = {}
+
+        # replies are packed in full lines, page_lines of them at most (None
+        # for no limit), the more order sends the next ones: by sender, the
+        # cursor to the lines left
+        self.page_lines = page_lines
+        self._cursors = LRUCacher(600, max_entries=1000)
+
+        # handler name ('*' for the others) => seconds an order may take,
+        # from when it is asked, engines cancel it then
+        self.order_deadlines = order_deadlines or {}
+
+        # handlers of the CPU heavy orders, run by cpu_workers processes
+        self.cpu_workers = cpu_workers
+        self._cpu_heavy = set()
+        self._process_pool = None
+
+        # handlers of the orders only the admins (nicks) may ask
+        self.admins = set(admins or ())
+        self._admin_orders = set()
+
+        # joined channels and their ChannelPolicy, self.channel is the
+        # first one joined
+        self.channels = {}
+        self.channel = None
+
+        # lines with other commands are dropped right after the command
+        self._wanted_commands = self._get_wanted_commands()
+
+    def parsemsg(self, msg):
+        """
+            Breaks a message from an IRC server into its prefix, command, and arguments.
+        """
+        '''
+            according to rfc2812, the message format is:
+            :<prefix> <command> <params> :<trailing>
+
+            here are some examples:
+            :CalebDelnay!calebd@localhost PRIVMSG #mychannel :Hello everyone!
+            :CalebDelnay!calebd@localhost QUIT :Bye bye!
+            :CalebDelnay!calebd@localhost JOIN #mychannel
+            :CalebDelnay!calebd@localhost MODE #mychannel -l
+            PING :irc.localhost.localdomain
+        '''
+        message = parse_message(msg)
+        return message.prefix, message.command, message.params
+
+    def _get_wanted_commands(self):
+        '''
+            Commands the bot has a handler for, or None if every command
+            has to be handled since irc_unknown is overridden.
+        '''
+        if self.irc_unknown.__code__ is not IRCProtocol.irc_unknown.__code__:
+            return None
+
+        commands = set(name[4:] for name in dir(self)
+            if name.startswith('irc_') and name != 'irc_unknown')
+        commands.discard('IGNORECMD')
+
+        for digit, command in self.digit_cmd_map.items():
+            if command.upper() in commands:
+                commands.add(digit)
+
+        return commands
+
+    def _handleMsg(self, prefix, command, params):
+        """
+            Determine the function to call for the given command and call it with
+            the given arguments.
+        """
+        if command.isdigit():
+            command = self.convert_digit_cmd(command)
+
+        # we could get nothing if the command is digits format as 433
+        # if we get the digits command those we don't know how to handle
+        # it, using irc_IGNORECMD instead
+        method = getattr(self, "irc_%s" % command.upper(), None)
+
+        try:
+            if method is not None:
+                method(prefix, params)
+
+            else:
+                self.irc_unknown(prefix, command, params)
+        except BaseException as e:
+            self.logger.error('Exception: %s', e)
+        
+    def convert_digit_cmd(self, cmd):
+        real_cmd_name = self.digit_cmd_map.get(cmd, 'ignorecmd')
+        return real_cmd_name.upper()
+
+    def irc_NICKINUSE(self, prefix, params):
+        ''' 
+            handle message like this:
+            :wright.freenode.net 433 * bot :Nickname is already in use.
+        '''
+        if not self.reclaim_nick:
+            # seems there is already a bot running now
+            self.disconnect_ircserver()
+            return
+
+        if params and params[0] != '*':
+            # registered, base_nick is still held by the former session
+            self.logger.info('Nick %s still in use, keeping %s',
+                self.base_nick, self.nick)
+            return
+
+        self._nick_attempts += 1
+        self.nick = self.alternate_nick(self._nick_attempts)
+        self.logger.info('Nick in use, registering %s', self.nick)
+        self.send('NICK %s' % self.nick)
+
+    def alternate_nick(self, attempt):
+        return '%s%s' % (self.base_nick, '_' * attempt)
+
+    def irc_NICK(self, prefix, params):
+        ''' :bot_!~bot@host NICK :bot, base_nick regained '''
+        if prefix.split('!', 1)[0] == self.nick and params:
+            self.nick = params[0]
+            self.logger.info('Nick changed to %s', self.nick)
+
+    def disconnect_ircserver(self):
+        raise NotImplementedError
+
+    def irc_unknown(self, prefix, command, params):
+        """
+        Called by L{handleCommand} on a command that doesn't have a defined
+        handler. Subclasses should override this method.
+        """
+        raise NotImplementedError(command, prefix, params)
+
+    def irc_IGNORECMD(self, prefix, params):
+        self.logger.info('Request ignored')
+
+    def send(self, msg):
+        self.traffic.info('<< %s', msg)
+
+        if not msg.endswith('\r\n'):
+            msg += '\r\n'
+        
+        self._outbound.put(msg)
+
+    def handle(self, msg):
+        self.lines_read += 1
+        message = parse_message(msg, self._wanted_commands)
+
+        if message is None:
+            self.lines_skipped += 1
+            self.traffic.debug('Skipped %s', msg)
+            return
+
+        self.traffic.info('>> %s', msg)
+        self.traffic.debug('parsed message: %r', message)
+
+        self._handleMsg(message.prefix, message.command, message.params)
+
+    def register_nick(self):
+        # every connection tries base_nick first
+        self.nick = self.base_nick
+        self._nick_attempts = 0
+
+        self.logger.info('Registering nick %s', self.nick)
+        self.send('NICK %s' % self.nick)
+
+    def register(self):
+        self.logger.info('Authing as %s', self.nick)
+        self.send('USER %s %s bla :%s' % (self.nick, self.server, self.nick))
+
+    def irc_PING(self, prefix, params):
+        """
+            NOTE: ONLY response to periodic PING messages from server 
+
+            If there is no prefix, then the source of the 
+            message is the server for the current connection, 
+            as in this PING method
+        """
+        assert prefix == '', 'where is this PING message from?'
+
+        # ping message from server
+        self.send('PONG :%s' % params[0])
+
+        if self.reclaim_nick and self.nick != self.base_nick:
+            self.send('NICK %s' % self.base_nick)
+
+    def irc_PRIVMSG(self, prefix, params):
+        # handle msg like the following:
+        # :xpen!~xpen@10.0.0.1 PRIVMSG bot :git project
+        # ('xpen!~xpen@10.0.0.1', 'PRIVMSG', ['bot', 'bot: hi'])
+        # ('xpen!~xpen@10.0.0.1', 'PRIVMSG', ['bot', 'hi'])
+
+        # in channel: bot: hi
+        # :xpen!~xpen@10.0.0.1 PRIVMSG #channel :bot: hi
+        # ('xpen!~xpen@10.0.0.1', 'PRIVMSG', ['#channel', 'bot: hi'])
+
+        # in channel: xxx
+        # :xpen!~xpen@10.0.0.1 PRIVMSG #channel :xxx
+        # ('xpen!~xpen@10.0.0.1', 'PRIVMSG', ['#channel', 'xxx'])
+
+        # NOTE: always send message as private msg to the person who emits this
+        # check this message is send to me
+        channel, msg = params
+        sender = prefix.split('!', 1)[0]
+
+        if channel not in self.channels and channel != self.nick:
+            self.logger.info('Peeping Tom is here')
+            self.send('PRIVMSG %s :%s' % (sender, "Hey, Leave me alone!"))
+            return
+
+        # don't interupt normal communication(talking in the channel)
+        if re.match('%s:'%self.nick, msg):
+            me, msg = msg.split(':', 1)
+            
+            # echo in channel
+            if channel == self.nick:
+                channel = None
+            self.serve(sender, msg.strip(), channel)
+
+    def join(self, channel, policy=None):
+        '''
+            Join channel, orders asked in it are served according to policy,
+            a ChannelPolicy.
+        '''
+        if not channel.startswith('#'):
+            channel = '#%s' % channel
+
+        self.channels[channel] = policy or ChannelPolicy()
+        if self.channel is None:
+            self.channel = channel
+
+        self.logger.debug('joining %s', channel)
+        self.send('JOIN %s' % channel)
+
+    def rejoin(self):
+        ''' Join the channels again, after a reconnection. '''
+        for channel in self.channels:
+            self.logger.debug('joining %s', channel)
+            self.send('JOIN %s' % channel)
+
+    def join_all(self, channels):
+        '''
+            channels is a channel name, a list of them, or a dict of
+            channel name => ChannelPolicy.
+        '''
+        if isinstance(channels, str):
+            channels = [channels]
+
+        if isinstance(channels, dict):
+            channels = channels.items()
+        else:
+            channels = [(channel, None) for channel in channels]
+
+        for channel, policy in channels:
+            self.join(channel, policy)
+
+    def _register_single_order(self, order):
+        '''
+            order should be a tuple, and values are: 
+            (re object, handler, help_txt)
+        '''
+        if not isinstance(order, tuple):
+            raise Exception('tuple required')
+            
+        if self._validate_order(order):
+            raise Exception('Order already defined')
+
+        help_text = order[2]
+        if (help_text == '' or help_text is None or
+            not isinstance(help_text, str)):
+            raise Exception('Help text required')
+
+        handler = order[1]
+        if callable(handler):
+            self._valid_orders.add(order)
+            self.logger.info('successfully added handler')
+
+        else:
+            raise Exception('Your order seems invalid')
+
+    def register_order(self, orders, cpu_heavy=False, admin=False):
+        '''
+            Orders registered cpu_heavy are served in a worker process, see
+            workers. Orders registered admin are served to self.admins only.
+        '''
+        for order in orders:
+            if cpu_heavy and isinstance(order, tuple):
+                workers.check_handler(order[1])
+
+            self._register_single_order(order)
+
+            if cpu_heavy:
+                self._cpu_heavy.add(order[1])
+            if admin:
+                self._admin_orders.add(order[1])
+
+    def _validate_order(self, order):
+        is_valid = False
+        if isinstance(order, tuple):
+            is_valid = order[0] in self._valid_orders
+
+        if isinstance(order, str):
+            is_valid = self._valid_orders.match(order) is not None
+
+        return is_valid
+
+    # always send private msg to the person who asks for 
+    # it even get this from channel, unless the channel policy says
+    # otherwise
+    # if get message from channel, give a feedback as 
+    # 'message has been send privately!'
+    def serve(self, sender, order, channel=None):
+        matched = self.match_order(sender, order, channel)
+        if matched is None:
+            return
+
+        handler, kwargs = matched
+        if handler == self.more:
+            pending = PendingOrder(None, sender, channel)
+        else:
+            pending = self.merge_order(sender, channel, handler, kwargs)
+            if pending is None:
+                return
+
+        # ok, let's do it
+        self.execute_order(pending, handler, kwargs)
+
+    def execute_order(self, pending, handler, kwargs):
+        ''' Engines may override this to run the order elsewhere. '''
+        self.run_order(pending, handler, kwargs)
+
+    def run_order(self, pending, handler, kwargs, queued=None):
+        ''' queued is when the order was queued, if it was. '''
+        name = handler.__name__
+        if queued is not None:
+            self.metrics.observe('order_queue_seconds', time.time() - queued)
+
+        self.metrics.inc('orders_total', order=name)
+        try:
+            # generated results are produced while they are delivered
+            with self.metrics.timer('order_seconds', order=name):
+                result = self.call_handler(handler, kwargs)
+                self.deliver(pending, result)
+        except BaseException:
+            self.metrics.inc('order_errors_total', order=name)
+            self.abort_order(pending)
+            raise
+
+    def call_handler(self, handler, kwargs):
+        if handler not in self._cpu_heavy:
+            return handler(**kwargs)
+
+        return self.offload(workers.call_handler, handler, kwargs)
+
+    def offload(self, func, *args):
+        '''
+            func(*args) in a worker process, for the CPU heavy steps of the
+            orders: func must be a module level function, see workers.
+        '''
+        # waiting for the result is cooperative under gevent
+        future = self.process_pool().submit(func, *args)
+        try:
+            return future.result()
+        finally:
+            # not started yet at the deadline
+            future.cancel()
+
+    def process_pool(self):
+        if self._process_pool is None:
+            self._process_pool = workers.new_process_pool(self.cpu_workers)
+
+        return self._process_pool
+
+    def stop_workers(self):
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False)
+            self._process_pool = None
+
+    def order_deadline(self, handler, queued=None):
+        ''' Seconds left to serve the order, None for no deadline. '''
+        deadline = self.order_deadlines.get(handler.__name__,
+            self.order_deadlines.get('*'))
+
+        if deadline is not None and queued is not None:
+            deadline = max(0, deadline - (time.time() - queued))
+
+        return deadline
+
+    def order_dropped(self, pending, handler):
+        ''' The orders lane is full, pending is refused. '''
+        self.logger.error('Overloaded, order dropped: %s', handler.__name__)
+        self.metrics.inc('orders_dropped_total', order=handler.__name__)
+        self.abort_order(pending)
+
+        for sender, channel in pending.askers:
+            self.send('PRIVMSG %s :%s' % (sender, 'Busy, try later!'))
+
+    def order_timed_out(self, pending, handler):
+        self.logger.error('Order timed out: %s', handler.__name__)
+        self.metrics.inc('orders_timed_out_total', order=handler.__name__)
+        self.abort_order(pending)
+
+        for sender, channel in pending.askers:
+            self.send('PRIVMSG %s :%s' % (sender, 'Timed out, try later!'))
+
+    def match_order(self, sender, order, channel=None):
+        '''
+            Return (handler, kwargs) for order, or None after sending the
+            help to sender if order is not served here, or asking sender to
+            slow down.
+        '''
+        self.logger.info('In: sender=>[%s],  order=>[%s]', sender, order)
+        policy = self.channels.get(channel)
+
+        # only registered orders allowed, one match finds the handler
+        matched = self._valid_orders.match(order)
+        if matched is None and order.strip() == 'more':
+            matched = (None, self.more, None), {'sender': sender}
+
+        if matched is not None:
+            (pattern, handler, help_text), kwargs = matched
+            if handler in self._admin_orders and sender not in self.admins:
+                self.logger.error('Admin order refused to %s: %s', sender, order)
+                self.metrics.inc('orders_refused_total', order=handler.__name__)
+                self.send('PRIVMSG %s :%s' % (sender, 'Admins only!'))
+                return
+
+            if (policy is None or policy.allows(handler) or
+                    handler == self.more):
+                if self.limiter.allow(handler.__name__, sender, channel):
+                    return handler, kwargs
+
+                self.logger.error('Rate limited %s: %s', sender, order)
+                self.metrics.inc('orders_limited_total', order=handler.__name__)
+                self.send('PRIVMSG %s :%s' % (sender, 'Slow down, try later!'))
+                return
+
+        self.logger.error('Invalid order %s', order)
+        self.metrics.inc('orders_invalid_total')
+        if self.limiter.allow('help', sender, channel):
+            self.send_help(sender, policy)
+
+    def merge_order(self, sender, channel, handler, kwargs):
+        '''
+            Return the PendingOrder to execute, or None if an identical
+            order is pending and sender has been added to its askers.
+        '''
+        now = time.time()
+        for key, pending in list(self._pending_orders.items()):
+            if (pending.finished is not None and
+                    now - pending.finished >= self.merge_window):
+                del self._pending_orders[key]
+
+        key = (handler, tuple(sorted(kwargs.items())))
+        pending = self._pending_orders.get(key)
+        if pending is None:
+            pending = self._pending_orders[key] = PendingOrder(key, sender, channel)
+            return pending
+
+        self.logger.info('Merged order of %s: %s', sender, handler.__name__)
+        self.metrics.inc('orders_merged_total', order=handler.__name__)
+
+        target = self.reply_target(sender, channel)
+
+        # served already: the lines again, to this asker only
+        if pending.finished is not None:
+            for line in pending.lines:
+                self.send('PRIVMSG %s :%s' % (target, line))
+            self._save_cursors(pending.cursor, [(sender, channel)])
+            self._notify_channels([(sender, channel)])
+            return
+
+        # while it is served, lines already replied to the same target are
+        # not sent twice
+        if target not in self._reply_targets(pending.askers):
+            for line in pending.lines:
+                self.send('PRIVMSG %s :%s' % (target, line))
+        pending.askers.append((sender, channel))
+
+    def abort_order(self, pending):
+        ''' Forget a failed order, the next identical one is executed. '''
+        if self._pending_orders.get(pending.key) is pending:
+            del self._pending_orders[pending.key]
+
+    def deliver(self, pending, result):
+        '''
+            Send the first page of result to every asker of pending,
+            including the ones merged while the result is generated.
+
+            result is a line, a list or a generator of lines, or the Cursor
+            of a former result.
+        '''
+        if isinstance(result, Cursor):
+            cursor = result
+
+        else:
+            # results may be generated, each line is sent as soon as it
+            # is full
+            if not isinstance(result, (list, types.GeneratorType)):
+                result = [result]
+            cursor = Cursor(PagedReply(result))
+
+        for line in cursor.page(self.page_lines):
+            pending.lines.append(line)
+            for target in self._reply_targets(pending.askers):
+                self.send('PRIVMSG %s :%s' % (target, line))
+
+        pending.cursor = cursor
+        pending.finished = time.time()
+        self._save_cursors(cursor, pending.askers)
+        self._notify_channels(pending.askers)
+
+    def more(self, sender):
+        ''' The lines left of the last reply to sender. '''
+        cursor = self._cursors.get(sender)
+        if cursor is None:
+            return 'Nothing more'
+
+        return cursor
+
+    def _save_cursors(self, cursor, askers):
+        more = cursor.more()
+
+        for sender, channel in askers:
+            if not more:
+                self._cursors.retire(sender)
+                continue
+
+            self._cursors.set(sender, Cursor(cursor.reply, cursor.position))
+            self.send('PRIVMSG %s :%s' % (self.reply_target(sender, channel),
+                'Say "%s: more" for the next lines' % self.nick))
+
+    def reply(self, sender, result, channel=None):
+        self.deliver(PendingOrder(None, sender, channel), result)
+
+    def reply_target(self, sender, channel=None):
+        policy = self.channels.get(channel)
+        if policy is not None and not policy.reply_privately:
+            return channel
+
+        return sender
+
+    def _reply_targets(self, askers):
+        targets = []
+        for sender, channel in askers:
+            target = self.reply_target(sender, channel)
+            if target not in targets:
+                targets.append(target)
+
+        return targets
+
+    def _notify_channels(self, askers):
+        channels = []
+        for sender, channel in askers:
+            if (channel and channel not in channels and
+                    self.reply_target(sender, channel) == sender):
+                channels.append(channel)
+
+        for channel in channels:
+            self.send('PRIVMSG %s :%s' %(channel, 'Message has been send privately!'))
+
+    def register_gauges(self):
+        ''' Called by the engines on connect, once self.server is known. '''
+        # the registry doesn't keep a stopped bot alive
+        bot = weakref.ref(self)
+        self.metrics.gauge('outbound_queue_lines',
+            lambda: len(bot()._outbound), bot=self.base_nick, server=self.server)
+        self.metrics.gauge('irc_lines_read',
+            lambda: bot().lines_read, bot=self.base_nick, server=self.server)
+        self.metrics.gauge('irc_lines_skipped',
+            lambda: bot().lines_skipped, bot=self.base_nick, server=self.server)
+
+    def send_help(self, sender, policy=None):
+        for order in self._valid_orders.orders:
+            if order[1] in self._admin_orders and sender not in self.admins:
+                continue
+            if policy is None or policy.allows(order[1]):
+                self.send('PRIVMSG %s :%s' % (sender, order[2]))
+
+        if self.page_lines:
+            self.send('PRIVMSG %s :%s' % (sender,
+                'Get the next lines of a long reply: more'))
+
+
+class testIRCProtocol(unittest.TestCase):
+    class FakeOutbound(list):
+        def put(self, line):
+            self.append(line.rstrip())
+
+    def setUp(self):
+        self.protocol = IRCProtocol('bot',
+            order_limits={'*': {'sender_rate': 1, 'sender_burst': 2}})
+        self.protocol._outbound = self.FakeOutbound()
+        self.protocol.join('#c')
+        self.protocol.join('#public', ChannelPolicy(reply_privately=False))
+
+        self.executed = []
+        self.pending = []
+        self.protocol.execute_order = lambda pending, handler, kwargs: \
+            self.pending.append((pending, handler, kwargs))
+
+        def projects():
+            self.executed.append('projects')
+            return ['p1', 'p2']
+
+        self.protocol.register_order([
+            (re.compile(r'^git projects$'), projects, 'git projects'),
+        ])
+        del self.protocol._outbound[:]
+
+    def testAdminOrder(self):
+        self.protocol.admins = set(['xpen'])
+        self.protocol.register_order([
+            (re.compile(r'^metrics$'), lambda: ['m'], 'metrics'),
+        ], admin=True)
+
+        self.protocol.serve('alice', 'metrics')
+        self.assertEqual(self.pending, [])
+        self.assertEqual(self.protocol._outbound, ['PRIVMSG alice :Admins only!'])
+
+        self.protocol.serve('xpen', 'metrics')
+        self.assertEqual(len(self.pending), 1)
+
+        del self.protocol._outbound[:]
+        self.protocol.send_help('alice')
+        self.assertNotIn('PRIVMSG alice :metrics', self.protocol._outbound)
+
+    def testHandle(self):
+        self.protocol.handle('ping :irc.server')
+        self.protocol.handle(':n!u@h JOIN #c')
+
+        # commands are case insensitive
+        self.assertEqual(self.protocol._outbound, ['PONG :irc.server'])
+        self.assertEqual((self.protocol.lines_read,
+            self.protocol.lines_skipped), (2, 1))
+
+    def testNickInUse(self):
+        self.protocol.reclaim_nick = True
+        self.protocol.server = 'irc.server'
+        self.protocol.register_nick()
+
+        self.protocol.handle(':irc.server 433 * bot :Nickname is already in use.')
+        self.protocol.handle(':irc.server 433 * bot_ :Nickname is already in use.')
+        self.assertEqual(self.protocol.nick, 'bot__')
+
+        # the former session still holds it
+        self.protocol.handle('PING :irc.server')
+        self.protocol.handle(':irc.server 433 bot__ bot :Nickname is already in use.')
+        self.assertEqual(self.protocol.nick, 'bot__')
+
+        self.protocol.handle('PING :irc.server')
+        self.protocol.handle(':bot__!~bot@10.0.0.1 NICK :bot')
+        self.assertEqual(self.protocol.nick, 'bot')
+
+        self.assertEqual(self.protocol._outbound, ['NICK bot', 'NICK bot_',
+            'NICK bot__', 'PONG :irc.server', 'NICK bot', 'PONG :irc.server',
+            'NICK bot'])
+
+    def testMerge(self):
+        self.protocol.serve('xpen', 'git projects', '#c')
+        self.protocol.serve('alice', 'git projects', '#public')
+        self.assertEqual(len(self.pending), 1)
+
+        self.protocol.run_order(*self.pending[0])
+        self.protocol.serve('bob', 'git projects', '#c')
+
+        self.assertEqual(self.executed, ['projects'])
+        self.assertEqual(self.protocol._outbound, [
+            'PRIVMSG xpen :p1 | p2', 'PRIVMSG #public :p1 | p2',
+            'PRIVMSG #c :Message has been send privately!',
+            'PRIVMSG bob :p1 | p2',
+            'PRIVMSG #c :Message has been send privately!',
+        ])
+
+        self.protocol.merge_window = 0
+        self.protocol.serve('bob', 'git projects', '#c')
+        self.assertEqual(len(self.pending), 2)
+
+    def testMergeFinished(self):
+        self.protocol.serve('xpen', 'git projects')
+        self.protocol.run_order(*self.pending[0])
+        del self.protocol._outbound[:]
+
+        # asking again within merge_window gets the lines again, and
+        # nobody else does
+        self.protocol.serve('xpen', 'git projects')
+        self.protocol.serve('bob', 'git projects')
+        self.assertEqual(self.protocol._outbound, ['PRIVMSG xpen :p1 | p2',
+            'PRIVMSG bob :p1 | p2'])
+        self.assertEqual(self.executed, ['projects'])
+        self.assertEqual(self.pending[0][0].askers, [('xpen', None)])
+
+    def testPages(self):
+        self.protocol.limiter = OrderLimiter({
+            '*': {'sender_rate': None, 'channel_rate': None}})
+        self.protocol.page_lines = 2
+        self.protocol.register_order([
+            (re.compile(r'^long$'), lambda: [str(i) * 200 for i in range(5)],
+            'long'),
+        ])
+
+        def ask(order):
+            del self.protocol._outbound[:]
+            self.protocol.serve('xpen', order)
+            if self.pending:
+                self.protocol.run_order(*self.pending.pop())
+            return [line[len('PRIVMSG xpen :'):][:3]
+                for line in self.protocol._outbound]
+
+        more = 'Say "bot: more" for the next lines'[:3]
+        self.assertEqual(ask('long'), ['000', '111', more])
+        self.assertEqual(ask('more'), ['222', '333', more])
+        self.assertEqual(ask('more'), ['444'])
+        self.assertEqual(ask('more'), ['Not'])
+
+        # lines are cut to fit
+        self.assertEqual(ask('git projects'), ['p1 '])
+        self.protocol.reply('xpen', 'x' * 1000)
+        self.assertTrue(all(len(line) + 2 <= 512 - 100
+            for line in self.protocol._outbound))
+
+    def testRateLimit(self):
+        for _ in range(3):
+            self.protocol.serve('xpen', 'git projects')
+            if self.pending:
+                self.protocol.abort_order(self.pending.pop()[0])
+
+        self.assertEqual(self.protocol._outbound,
+            ['PRIVMSG xpen :Slow down, try later!'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- coding: utf8 -*-
+
+import time
+import unittest
+
+from tools import TokenBucket
+from addons.cache import LRUCacher
+
+
+# rates are in orders per second, None for no limit
+default_limits = {
+    'sender_rate': 0.2,
+    'sender_burst': 3,
+    'channel_rate': 1,
+    'channel_burst': 10,
+}
+
+
+class OrderLimiter(object):
+    '''
+        Per-sender and per-channel token buckets on orders.
+
+        limits maps order names (the handler names, 'help' for the help
+        sent on invalid orders) to dicts overriding default_limits, '*'
+        applies to every order. Each order has its own buckets.
+    '''
+    def __init__(self, limits=None, clock=time.time):
+        limits = limits or {}
+
+        self.default = dict(default_limits)
+        self.default.update(limits.get('*', {}))
+
+        self.limits = {}
+        for name, order_limits in limits.items():
+            self.limits[name] = dict(self.default)
+            self.limits[name].update(order_limits)
+
+        self._clock = clock
+        # a bucket idle for burst / rate seconds is full again, it is
+        # forgotten then
+        self._buckets = LRUCacher(max_entries=10000, clock=clock)
+
+    def allow(self, order, sender, channel=None):
+        ''' Take a token for order, return False if sender must slow down. '''
+        limits = self.limits.get(order, self.default)
+
+        limited = [('sender', sender, limits['sender_rate'],
+            limits['sender_burst'])]
+        if channel:
+            limited.append(('channel', channel, limits['channel_rate'],
+                limits['channel_burst']))
+
+        # key, bucket and seconds to fill up again of the limited ones
+        buckets = [((order, kind, name), self._bucket(order, kind, name,
+            rate, burst), float(burst) / rate)
+            for kind, name, rate, burst in limited if rate is not None]
+        if any(bucket.delay() > 0 for _, bucket, _ in buckets):
+            return False
+
+        for key, bucket, ttl in buckets:
+            bucket.take(1)
+            self._buckets.set(key, bucket, ttl=ttl)
+
+        return True
+
+    def _bucket(self, order, kind, name, rate, burst):
+        bucket = self._buckets.get((order, kind, name), count=False)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst, clock=self._clock)
+
+        return bucket
+
+
+class testOrderLimiter(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.limiter = OrderLimiter({
+            '*': {'sender_rate': 1, 'sender_burst': 2},
+            'projects': {'sender_burst': 1, 'channel_rate': 1, 'channel_burst': 2},
+            'free': {'sender_rate': None, 'channel_rate': None},
+        }, clock=lambda: self.now)
+
+    def testSender(self):
+        self.assertTrue(self.limiter.allow('commit', 'xpen'))
+        self.assertTrue(self.limiter.allow('commit', 'xpen'))
+        self.assertFalse(self.limiter.allow('commit', 'xpen'))
+
+        # other senders and orders have their own buckets
+        self.assertTrue(self.limiter.allow('commit', 'alice'))
+        self.assertTrue(self.limiter.allow('projects', 'xpen'))
+
+        self.now += 1
+        self.assertTrue(self.limiter.allow('commit', 'xpen'))
+
+    def testChannel(self):
+        self.assertTrue(self.limiter.allow('projects', 'xpen', '#c'))
+        self.assertTrue(self.limiter.allow('projects', 'alice', '#c'))
+        self.assertFalse(self.limiter.allow('projects', 'bob', '#c'))
+
+        # bob's token was not taken
+        self.assertTrue(self.limiter.allow('projects', 'bob', '#other'))
+
+    def testSlowLimit(self):
+        limiter = OrderLimiter({'*': {'sender_rate': 1.0 / 3600,
+            'sender_burst': 1}}, clock=lambda: self.now)
+        self.assertTrue(limiter.allow('projects', 'xpen'))
+
+        # idle buckets are forgotten once full again, not before
+        self.now += 1800
+        limiter._buckets.sweep()
+        self.assertFalse(limiter.allow('projects', 'xpen'))
+
+        self.now += 1800
+        limiter._buckets.sweep()
+        self.assertEqual(len(limiter._buckets), 0)
+        self.assertTrue(limiter.allow('projects', 'xpen'))
+
+    def testUnlimited(self):
+        for _ in range(100):
+            self.assertTrue(self.limiter.allow('free', 'xpen', '#c'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+# -*- coding: utf8 -*-
+'''
+    Counters, gauges and latency histograms of the bots, kept in the
+    process wide `registry`, rendered for the `metrics` order and in the
+    Prometheus text format.
+
+    Recording is a dict lookup and an addition, cheap enough for every
+    received line.
+'''
+
+import time
+import bisect
+import unittest
+
+
+# seconds
+default_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        ''' Upper bound of the bucket holding the q quantile, None for +Inf. '''
+        wanted = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+
+        return None
+
+
+class Timer(object):
+    ''' Context manager observing the seconds spent in its block. '''
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.time() - self.start, **self.labels)
+
+
+class Metrics(object):
+    '''
+        Metrics are identified by a name and labels (keyword arguments):
+
+            registry.inc('orders_total', order='get_project_commit')
+            with registry.timer('gitlab_request_seconds', endpoint='projects'):
+                ...
+
+        Gauges are callables evaluated when the metrics are rendered.
+    '''
+    def __init__(self):
+        # (name, labels) => value
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+        # name => buckets of its histograms
+        self._buckets = {}
+
+    def histogram(self, name, buckets):
+        ''' Set the buckets of the histograms called name. '''
+        self._buckets[name] = tuple(buckets)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(
+                self._buckets.get(name, default_buckets))
+
+        histogram.observe(value)
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def gauge(self, name, func, **labels):
+        ''' Report func() as name, the counters of LRUCacher for instance. '''
+        self._gauges[(name, tuple(sorted(labels.items())))] = func
+
+    def _metric_name(self, name, labels):
+        if not labels:
+            return name
+
+        return '%s{%s}' % (name, ','.join('%s="%s"' % (label, value)
+            for label, value in labels))
+
+    def _gauge_values(self):
+        values = []
+        for (name, labels), func in sorted(self._gauges.items()):
+            try:
+                values.append((name, labels, func()))
+            except Exception:
+                continue
+
+        return values
+
+    def summary(self):
+        ''' Lines for humans: counters, gauges and latency percentiles. '''
+        lines = []
+        for (name, labels), value in sorted(self._counters.items()):
+            lines.append('%s %s' % (self._metric_name(name, labels), value))
+
+        for name, labels, value in self._gauge_values():
+            lines.append('%s %s' % (self._metric_name(name, labels), value))
+
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            percentiles = []
+            for q in (0.5, 0.9, 0.99):
+                bound = histogram.quantile(q)
+                percentiles.append('p%d<=%s' % (q * 100,
+                    '+Inf' if bound is None else '%gs' % bound))
+
+            lines.append('%s count=%d avg=%.4fs %s' % (
+                self._metric_name(name, labels), histogram.count,
+                histogram.sum / histogram.count, ' '.join(percentiles)))
+
+        return lines
+
+    def render(self):
+        ''' The Prometheus text exposition format. '''
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        for (name, labels), value in sorted(self._counters.items()):
+            declare(name, 'counter')
+            lines.append('%s %s' % (self._metric_name(name, labels), value))
+
+        for name, labels, value in self._gauge_values():
+            declare(name, 'gauge')
+            lines.append('%s %s' % (self._metric_name(name, labels), value))
+
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            declare(name, 'histogram')
+
+            seen = 0
+            bounds = ['%g' % bound for bound in histogram.buckets] + ['+Inf']
+            for bound, count in zip(bounds, histogram.counts):
+                seen += count
+                lines.append('%s %d' % (self._metric_name(name + '_bucket',
+                    labels + (('le', bound),)), seen))
+
+            lines.append('%s %r' % (self._metric_name(name + '_sum', labels),
+                histogram.sum))
+            lines.append('%s %d' % (self._metric_name(name + '_count', labels),
+                histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsApp(object):
+    ''' WSGI application serving the metrics to Prometheus. '''
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        body = self.metrics.render().encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+
+class PathRouter(object):
+    '''
+        WSGI application dispatching on the request path: routes maps
+        paths to applications, default gets the other requests.
+    '''
+    def __init__(self, routes, default):
+        self.routes = routes
+        self.default = default
+
+    def __call__(self, environ, start_response):
+        app = self.routes.get(environ.get('PATH_INFO'), self.default)
+        return app(environ, start_response)
+
+
+registry = Metrics()
+
+
+class testMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.histogram('parse_seconds', (0.001, 0.01))
+
+    def testRender(self):
+        self.metrics.inc('orders_total', order='projects')
+        self.metrics.inc('orders_total', 2, order='projects')
+        self.metrics.gauge('queue_lines', lambda: 7, bot='bot')
+        for value in (0.0005, 0.005, 0.5):
+            self.metrics.observe('parse_seconds', value)
+
+        text = self.metrics.render()
+        self.assertIn('# TYPE orders_total counter\norders_total{order="projects"} 3\n', text)
+        self.assertIn('queue_lines{bot="bot"} 7\n', text)
+        self.assertIn('parse_seconds_bucket{le="0.001"} 1\n', text)
+        self.assertIn('parse_seconds_bucket{le="0.01"} 2\n', text)
+        self.assertIn('parse_seconds_bucket{le="+Inf"} 3\n', text)
+        self.assertIn('parse_seconds_count 3\n', text)
+
+    def testSummary(self):
+        with self.metrics.timer('handler_seconds', order='projects'):
+            pass
+        self.metrics.gauge('broken', lambda: 1 / 0)
+
+        lines = self.metrics.summary()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith(
+            'handler_seconds{order="projects"} count=1'))
+        self.assertIn('p99<=0.001s', lines[0])
+
+    def testRouter(self):
+        router = PathRouter({'/metrics': MetricsApp(self.metrics)},
+            lambda environ, start_response: [b'hook'])
+        status = []
+
+        body = router({'PATH_INFO': '/metrics'}, lambda s, h: status.append(s))
+        self.assertEqual(status, ['200 OK'])
+        self.assertEqual(body, [b'\n'])
+        self.assertEqual(router({'PATH_INFO': '/'}, None), [b'hook'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,288 @@
+# -*- coding: utf8 -*-
+
+import re
+import unittest
+
+
+# named groups and named back references inside a single order's pattern
+_group_name_re = re.compile(r'\(\?P([<=])(\w+)')
+
+# leading literal keyword of a pattern, e.g. 'git' in r'^\s*git projects\s*$'
+_keyword_re = re.compile(r'^\^?(?:\\s[*+])?([A-Za-z0-9_-]+)(.?.?.?)')
+
+# what can't be nested in the alternation: numbered back references (and
+# conditional ones), they would count the groups of the combined pattern,
+# and global flags leading a pattern, e.g. r'(?i)^help$'
+_standalone_re = re.compile(r'\\\d|\(\?\(|^\(\?[aiLmsux]+\)')
+
+
+def has_top_level_alternation(source):
+    ''' Whether source has a | outside of any group or character class. '''
+    depth = 0
+    in_class = False
+    escaped = False
+
+    for char in source:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+
+    return False
+
+
+class OrderDispatcher(object):
+    '''
+        Compiles every registered order into one dispatch structure.
+
+        Orders are bucketed by their leading literal keyword (the first word
+        a user has to type), and each bucket is compiled into a single
+        alternation regex, one alternative per order:
+
+            (?P<_o0>...)|(?P<_o1>...)|...
+
+        so a single match against the bucket finds the order (by the name of
+        the last closed group) and its named groups at once. Orders without a
+        usable keyword are kept in a wildcard bucket which is tried with every
+        keyword.
+    '''
+    def __init__(self):
+        # (re object, handler, help_txt), in registration order
+        self.orders = []
+
+        self._patterns = set()
+        self._keywords = {}
+        self._wildcards = []
+        self._compiled = {}
+        # pattern matched on its own => index of its order
+        self._standalone = {}
+
+    def __contains__(self, pattern):
+        return pattern in self._patterns
+
+    def __len__(self):
+        return len(self.orders)
+
+    def add(self, order):
+        index = len(self.orders)
+        self.orders.append(order)
+        self._patterns.add(order[0])
+
+        keyword = self._extract_keyword(order[0])
+        if keyword is None:
+            self._wildcards.append(index)
+        else:
+            self._keywords.setdefault(keyword, []).append(index)
+
+        # buckets are compiled lazily, at the first command hitting them
+        self._compiled = {}
+
+    def match(self, text):
+        '''
+            Return (order, groupdict) of the first registered order whose
+            pattern matches text, or None.
+        '''
+        words = text.split(None, 1)
+        keyword = words[0] if words else ''
+
+        if keyword not in self._keywords:
+            keyword = None
+
+        try:
+            buckets = self._compiled[keyword]
+        except KeyError:
+            buckets = self._compiled[keyword] = self._compile(keyword)
+
+        for combined, groups in buckets:
+            match = combined.match(text)
+            if not match:
+                continue
+
+            # a pattern matched on its own
+            if groups is None:
+                return self.orders[self._standalone[combined]], match.groupdict()
+
+            index, names = groups[match.lastgroup]
+            kwargs = dict((name, match.group(alias)) for alias, name in names)
+            return self.orders[index], kwargs
+
+        return None
+
+    def _extract_keyword(self, pattern):
+        # case insensitive patterns can't be looked up by the literal word
+        if pattern.flags & re.IGNORECASE:
+            return None
+
+        # r'^git projects$|^projects$' has other first words
+        if has_top_level_alternation(pattern.pattern):
+            return None
+
+        match = _keyword_re.match(pattern.pattern)
+        if not match:
+            return None
+
+        # the keyword has to be a whole word, e.g. r'^git' also matches 'gitlab'
+        # and r'^gits?' matches 'git'
+        keyword, following = match.groups()
+        if following[:1] in ('$', ''):
+            return keyword
+
+        if following[:1] == ' ':
+            rest = following[1:]
+        elif following[:2] == '\\s':
+            rest = following[2:]
+        else:
+            return None
+
+        # an optional separator, r'^git\s*projects' also matches 'gitprojects'
+        if rest[:1] in ('*', '?', '{'):
+            return None
+
+        return keyword
+
+    def _compile(self, keyword):
+        indexes = sorted(self._keywords.get(keyword, []) + self._wildcards)
+
+        # orders are only combined with orders sharing the same flags, the
+        # ones _standalone_re finds are matched on their own, unwrapped
+        buckets = []
+        pending = []
+        for index in indexes:
+            pattern = self.orders[index][0]
+            if _standalone_re.search(pattern.pattern):
+                if pending:
+                    buckets.append(self._combine(pending))
+                    pending = []
+                self._standalone[pattern] = index
+                buckets.append((pattern, None))
+                continue
+
+            if pending and self.orders[pending[0]][0].flags != pattern.flags:
+                buckets.append(self._combine(pending))
+                pending = []
+            pending.append(index)
+
+        if pending:
+            buckets.append(self._combine(pending))
+
+        return buckets
+
+    def _combine(self, indexes):
+        alternatives = []
+        groups = {}
+
+        for index in indexes:
+            pattern = self.orders[index][0]
+            prefix = '_o%d_' % index
+            names = [(prefix + name, name) for name in pattern.groupindex]
+
+            source = _group_name_re.sub(
+                lambda m: '(?P%s%s%s' % (m.group(1), prefix, m.group(2)),
+                pattern.pattern)
+            alternatives.append('(?P<_o%d>%s)' % (index, source))
+            groups['_o%d' % index] = (index, names)
+
+        flags = self.orders[indexes[0]][0].flags
+        return re.compile('|'.join(alternatives), flags), groups
+
+
+class testOrderDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = OrderDispatcher()
+        self.dispatcher.add((re.compile(r'^\s*git projects\s*$'), 'projects', 'help'))
+        self.dispatcher.add((re.compile(r'^\s*project\s(?P<project_id>.*?)\scommit'),
+            'commit', 'help'))
+        self.dispatcher.add((re.compile(r'^\s*project\s(?P<project_id>\d+)\stags'),
+            'tags', 'help'))
+        self.dispatcher.add((re.compile(r'^(?P<word>\w+)\?$'), 'wildcard', 'help'))
+
+    def testMatch(self):
+        order, kwargs = self.dispatcher.match('git projects')
+        self.assertEqual(order[1], 'projects')
+        self.assertEqual(kwargs, {})
+
+        order, kwargs = self.dispatcher.match('project 123 commit')
+        self.assertEqual(order[1], 'commit')
+        self.assertEqual(kwargs, {'project_id': '123'})
+
+        order, kwargs = self.dispatcher.match('project 42 tags')
+        self.assertEqual(order[1], 'tags')
+        self.assertEqual(kwargs, {'project_id': '42'})
+
+    def testWildcard(self):
+        order, kwargs = self.dispatcher.match('help?')
+        self.assertEqual(order[1], 'wildcard')
+        self.assertEqual(kwargs, {'word': 'help'})
+
+    def testNoMatch(self):
+        self.assertIsNone(self.dispatcher.match('git project'))
+        self.assertIsNone(self.dispatcher.match(''))
+
+    def testInlineFlags(self):
+        self.dispatcher.add((re.compile(r'(?i)^help$'), 'help', 'help'))
+
+        order, kwargs = self.dispatcher.match('HELP')
+        self.assertEqual(order[1], 'help')
+        order, kwargs = self.dispatcher.match('git projects')
+        self.assertEqual(order[1], 'projects')
+
+    def testBackReference(self):
+        self.dispatcher.add((re.compile(r'^(\w+) \1$'), 'twice', 'help'))
+        self.dispatcher.add((re.compile(r'^(<)?(?P<tag>\w+)(?(1)>)!$'),
+            'tag', 'help'))
+
+        self.assertEqual(self.dispatcher.match('git projects')[0][1], 'projects')
+        self.assertEqual(self.dispatcher.match('hey hey')[0][1], 'twice')
+        order, kwargs = self.dispatcher.match('<b>!')
+        self.assertEqual(order[1], 'tag')
+        self.assertEqual(kwargs, {'tag': 'b'})
+
+    def testAlternation(self):
+        self.dispatcher.add((re.compile(r'^git tags$|^tags$'), 'tags', 'help'))
+        self.dispatcher.add((re.compile(r'^git (tag|branch)es$'), 'refs', 'help'))
+        self.assertIsNone(self.dispatcher._extract_keyword(
+            self.dispatcher.orders[-2][0]))
+        self.assertEqual(self.dispatcher._extract_keyword(
+            self.dispatcher.orders[-1][0]), 'git')
+
+        self.assertEqual(self.dispatcher.match('tags')[0][1], 'tags')
+        self.assertEqual(self.dispatcher.match('git tags')[0][1], 'tags')
+        self.assertEqual(self.dispatcher.match('git branches')[0][1], 'refs')
+
+    def testOptionalSeparator(self):
+        self.dispatcher.add((re.compile(r'^git\s*tags$'), 'tags', 'help'))
+        self.assertIsNone(self.dispatcher._extract_keyword(
+            self.dispatcher.orders[-1][0]))
+        self.assertEqual(self.dispatcher.match('gittags')[0][1], 'tags')
+        self.assertEqual(self.dispatcher.match('git tags')[0][1], 'tags')
+        self.assertEqual(self.dispatcher._extract_keyword(
+            re.compile(r'^\s*git\s+tags$')), 'git')
+        self.assertEqual(self.dispatcher._extract_keyword(
+            re.compile(r'^git\stags$')), 'git')
+
+    def testContains(self):
+        pattern = self.dispatcher.orders[0][0]
+        self.assertTrue(pattern in self.dispatcher)
+        self.assertFalse(re.compile('other') in self.dispatcher)
+
+    def testLateRegistration(self):
+        self.dispatcher.match('git projects')
+        self.dispatcher.add((re.compile(r'^git (?P<project_id>\d+)$'), 'late', 'help'))
+
+        order, kwargs = self.dispatcher.match('git 7')
+        self.assertEqual(order[1], 'late')
+        self.assertEqual(kwargs, {'project_id': '7'})
+
+
+if __name__ == '__main__':
+    unittest.main()
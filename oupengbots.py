@@ -1,72 +1,618 @@
 # -*- coding: utf8 -*-
+if '__main__' == __name__:
+    # GitLab calls must not block the other connections' greenlets
+    from gevent import monkey
+    monkey.patch_all()
+
+import os
 import re
+import time
+import atexit
+import itertools
+import tempfile
+import unittest
 
+import gevent
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from tools import get_logger
+from metrics import registry, MetricsApp, PathRouter
 from ircbots import IRCBot 
 from settings import global_conf as gc
 from addons import gitlab
 from addons import cache
+from addons import snapshot
+from addons import webhook
+from addons.memoize import Memoizer
+from addons.projects import ProjectIndex, format_projects
+from addons.commits import CommitIndex
+from addons.sync import CommitSync
+from hosts import BotHost
 
 
 class OupengBot(IRCBot):
-    def __init__(self, nick):
-        super(OupengBot, self).__init__(nick)
+    '''
+        gitlab_api, cache, projects (the ProjectIndex), commits (the
+        CommitIndex), sync (the CommitSync) and latest_commits (the Memoizer
+        over the cache) can be shared by the bots of one process, the cache
+        and the indexes are filled and kept up to date only when the bot
+        creates its own cache.
+    '''
+    def __init__(self, nick, gitlab_api=None, cache=None, projects=None,
+            commits=None, sync=None, latest_commits=None):
+        super(OupengBot, self).__init__(nick,
+            send_rate=gc.irc['send_rate'],
+            send_burst=gc.irc['send_burst'],
+            order_concurrency=gc.irc['order_concurrency'],
+            order_queue=gc.irc['order_queue'],
+            order_limits=gc.irc['order_limits'],
+            merge_window=gc.irc['merge_window'],
+            page_lines=gc.irc['page_lines'],
+            reconnect_delay=gc.irc['reconnect_delay'],
+            reconnect_max_delay=gc.irc['reconnect_max_delay'],
+            order_deadlines=gc.irc['order_deadlines'],
+            cpu_workers=gc.irc['cpu_workers'],
+            admins=gc.irc['admins'],
+            idle_timeout=gc.irc['idle_timeout'])
 
-        self.gitlab_api = gitlab.GitLabApi(gc.gitlab['api_baseurl'],
-            gc.gitlab['private_token'])
+        self.gitlab_api = gitlab_api or new_gitlab_api()
 
         self.register_order([
             (re.compile(r'^\s*git projects\s*$'), self.get_gitlab_projects, 
             'Get all git projects: git projects'),
 
             (re.compile(r'^\s*project\s(?P<project_id>.*?)\scommit'), self.get_project_commit,
-            'Get project\'s latest commit by project id: project 123 commit'),
+            'Get project\'s latest commit by project id or name: project 123 commit'),
+
+            (re.compile(r'^\s*search commits\s+(?P<terms>.*?)\s*$'), self.search_commits,
+            'Search commits of all projects by message, author or project: search commits fix login'),
         ])
 
-        self.cache = cache.Cacher(60)
-        self.init_projects_commits_cache()
+        self.register_order([
+            (re.compile(r'^\s*metrics\s*$'), self.get_metrics,
+            'Get the bot\'s counters and latencies: metrics'),
+        ], admin=True)
 
-    def get_gitlab_projects(self, raw=False):
-        msg = []
+        self.cache = new_cache() if cache is None else cache
+        self.projects = ProjectIndex() if projects is None else projects
+        self.commits = (CommitIndex(gc.search['max_commits'])
+            if commits is None else commits)
+        self.sync = (CommitSync(self.gitlab_api, self.on_new_commits)
+            if sync is None else sync)
 
-        projects = self.gitlab_api.get_projects()
-        if raw:
-            return projects
+        # latest commit by project id, shared so that concurrent misses
+        # from all the networks make one request
+        self.latest_commits = (latest_commits if latest_commits is not None
+            else Memoizer(self.cache, self._fetch_latest_commit, self.logger))
 
-        for proj in projects.json:
-            _msg = 'project name: %s, id: %s, owner: %s' % (proj['name'],
-                proj['id'], proj['owner']['name'])
-            msg.append(_msg)
+        if cache is None:
+            self.init_metrics()
+            self.init_cache_snapshot()
+            self.init_projects_commits_cache()
+            self.init_webhook()
 
-        return msg
+    def get_gitlab_projects(self, page_size=100):
+        '''
+            A generator, the first lines are sent while the next pages
+            load. The lines of each page are formatted in a worker
+            process, off the event loop.
+        '''
+        projects = self.iter_projects()
+        while True:
+            page = list(itertools.islice(projects, page_size))
+            if not page:
+                return
 
-    def get_project_commit(self, project_id):
-        project_id = int(project_id)
-        latest_commit = cached_data = self.cache.get(project_id)
+            for line in self.offload(format_projects, page):
+                yield line
+
+    def get_metrics(self):
+        return registry.summary()
+
+    def search_commits(self, terms):
+        ''' Answered from the commit index, without calling GitLab. '''
+        found = self.commits.search(terms, gc.search['max_results'])
+        if not found:
+            return 'No commit matches %s' % terms
+
+        return ('project: %s, commit: %s, commiter: %s, message: %s' % (
+            commit['project_name'] or commit['project_id'], commit['short_id'],
+            commit['author_name'], commit['title']) for commit in found)
+
+    def on_new_commits(self, project_id, commits):
+        ''' Commits found by the sync, newest first. '''
+        self.index_commits(project_id, commits)
+        self.cache.set(project_id, self.sync.latest(project_id))
+
+    def index_commits(self, project_id, commits):
+        ''' Add commits, listed newest first, to the commit index. '''
+        project = self.projects.get(project_id) or {}
+        self.commits.add_commits(project_id, project.get('name'), commits)
+
+    def iter_projects(self):
+        ''' Projects from the api, indexed on their way. '''
+        for proj in self.gitlab_api.iter_projects():
+            self.projects.add(proj)
+            yield proj
 
-        if not cached_data:
-            commits = self.gitlab_api.get_project_commits(project_id)
-            latest_commit = commits.json[0]
-            self.cache.set(project_id, latest_commit)
+    def find_project(self, text):
+        '''
+            Return the project text (an id or a name) stands for, or the
+            message telling why there is none.
+        '''
+        found = self.projects.find(text)
 
-        # TODO cache this
-        project_name = self.gitlab_api.get_project_name_by_pid(project_id)
+        # the index may not know a project yet
+        if not found and text.strip().isdigit():
+            project_id = int(text)
+            try:
+                project = gitlab.response_json(
+                    self.gitlab_api.get_single_project(project_id))
+            except gitlab.api_errors:
+                return None, 'No project matches %s' % text
+            found = [self.projects.add(project)]
+
+        if not found:
+            return None, 'No project matches %s' % text
+
+        if len(found) > 1:
+            return None, 'Which one: %s' % ', '.join('%s (%s)' % (
+                proj['path_with_namespace'] or proj['name'], proj['id'])
+                for proj in found)
+
+        return found[0], None
+
+    def get_project_commit(self, project_id):
+        project, error = self.find_project(project_id)
+        if project is None:
+            return error
+
+        latest_commit = self.latest_commits.get(project['id'])
+        if latest_commit is None:
+            return 'project: %s has no commits' % project['name']
 
         msg = 'project: %s, commiter: %s, message: %s' % (
-            project_name, latest_commit['author_name'],
+            project['name'], latest_commit['author_name'],
             latest_commit['title'])
 
         return msg
 
+    def _fetch_latest_commit(self, project_id):
+        ''' A delta request, once the project has a cursor. '''
+        project = self.projects.get(project_id) or {}
+        return self.sync.sync_project(project_id, project.get('default_branch'))
+
+    def init_metrics(self):
+        for name in ('entries', 'bytes', 'hits', 'stale_hits', 'misses',
+                'evictions', 'expirations'):
+            registry.gauge('cache_%s' % name,
+                lambda name=name: self.cache.stats()[name])
+
+    def init_cache_snapshot(self):
+        '''
+            Fill the cache from the snapshot left by the former run, and
+            save it every snapshot_interval seconds and at exit.
+        '''
+        path = gc.cache['snapshot']
+        if not path:
+            return
+
+        self.snapshot = snapshot.CacheSnapshot(path)
+        count = self.snapshot.load(self.cache)
+        self.logger.info('%d entries loaded from %s', count, path)
+
+        atexit.register(self.snapshot.save, self.cache)
+        gevent.spawn(self._save_snapshot, gc.cache['snapshot_interval'])
+
+    def _save_snapshot(self, interval):
+        while True:
+            gevent.sleep(interval)
+            self.save_snapshot()
+
+    def save_snapshot(self):
+        # the entries are listed in the loop, they are encoded and written
+        # in a thread while the bot serves
+        entries = self.cache.entries()
+        try:
+            gevent.get_hub().threadpool.apply(self.snapshot.write, (entries,))
+        except Exception as e:
+            self.logger.error('Unable to save the cache snapshot: %s', e)
+
+    def init_webhook(self):
+        '''
+            Serve the GitLab web hooks in the bot's event loop, they keep
+            the cache current without polling, and the metrics for
+            Prometheus on the same server.
+        '''
+        listen = gc.webhook['listen']
+        if not listen:
+            return
+
+        # tag pushes are dropped: a tag doesn't move the default branch,
+        # and its commits came with their push
+        app = webhook.GitLabWebhook({
+            'push': self.on_push,
+            'project_create': self.on_project_update,
+            'project_rename': self.on_project_update,
+            'project_transfer': self.on_project_update,
+            'project_destroy': self.on_project_destroy,
+        }, gc.webhook['token'], self.logger, gc.webhook['max_body'])
+
+        if gc.metrics['path']:
+            app = PathRouter({gc.metrics['path']: MetricsApp(registry)}, app)
+
+        self.webhook_server = WSGIServer(listen, app, log=None)
+        self.webhook_server.start()
+
+    def on_push(self, payload):
+        project_id = payload['project_id']
+        commits = payload.get('commits')
+
+        project = payload.get('project') or payload.get('repository') or {}
+        default_branch = project.get('default_branch')
+
+        # the commits of a push are listed oldest first
+        if commits:
+            self.index_commits(project_id, [webhook.commit_from_push(commit)
+                for commit in reversed(commits)])
+
+        if default_branch is None:
+            # don't know which branch the commits api lists, ask it
+            self.latest_commits.refresh(project_id)
+
+        elif payload.get('ref') == 'refs/heads/%s' % default_branch:
+            if commits:
+                # the last commit of the push is the latest one
+                latest_commit = webhook.commit_from_push(commits[-1])
+                self.cache.set(project_id, latest_commit)
+                self.sync.advance(project_id, latest_commit)
+            else:
+                self.latest_commits.refresh(project_id)
+
+    def on_project_update(self, payload):
+        self.projects.add(webhook.project_from_system_hook(payload))
+
+    def on_project_destroy(self, payload):
+        self.cache.retire(payload['project_id'])
+        self.projects.remove(payload['project_id'])
+        self.commits.remove_project(payload['project_id'])
+        self.sync.forget(payload['project_id'])
+
     def init_projects_commits_cache(self):
-        projects = self.get_gitlab_projects(raw=True)
-        
-        for proj in projects.json:
-            commits = self.gitlab_api.get_project_commits(proj['id'])
-            # get the latest commit
-            self.cache.set(proj['id'], commits.json[0])
-
-    
+        '''
+            Warm the commits cache up in a background greenlet, so the bot
+            serves while it runs, then sync the commits of the active
+            projects every sync_interval seconds. Failures are kept in
+            self.warmup_errors, by project id.
+        '''
+        self.warmup_errors = {}
+        self.warmup = gevent.spawn(self._warm_up_cache,
+            gc.gitlab['warmup_concurrency'], gc.gitlab['warmup_budget'])
+
+        return self.warmup
+
+    def _warm_up_cache(self, concurrency, budget):
+        try:
+            projects = list(self.iter_projects())
+        except gitlab.api_errors as e:
+            self.logger.error('Unable to warm the cache up: %s', e)
+            return
+
+        # most recently active projects first
+        projects = sorted(projects, reverse=True,
+            key=lambda proj: proj.get('last_activity_at') or '')
+
+        pool = Pool(concurrency)
+        with gevent.Timeout(budget, False):
+            for proj in projects:
+                pool.spawn(self._warm_up_project, proj)
+            pool.join()
+
+        pool.kill()
+        self.logger.info('cache warmed up: %d projects, %d failures',
+            len(projects), len(self.warmup_errors))
+
+        if gc.gitlab['sync_interval']:
+            gevent.spawn(self._sync_commits, gc.gitlab['sync_interval'],
+                concurrency)
+
+    def _sync_commits(self, interval, concurrency):
+        '''
+            The projects list is a conditional GET, its pages are mostly
+            answered 304, and the projects whose last_activity_at didn't
+            move cost nothing more.
+        '''
+        while True:
+            gevent.sleep(interval)
+
+            errors = {}
+            try:
+                synced = self.sync.sync_projects(self.iter_projects(),
+                    concurrency, errors)
+            except gitlab.api_errors as e:
+                self.logger.error('Unable to sync the commits: %s', e)
+                continue
+
+            self.logger.info('commits synced: %d active projects, %d failures',
+                synced, len(errors))
+
+    def _warm_up_project(self, project):
+        project_id = project['id']
+
+        # fresh from the snapshot, the next sync starts from there, and
+        # searches find it
+        cached = self.cache.get(project_id, count=False)
+        if cached is not None:
+            self.sync.advance(project_id, cached)
+            self.index_commits(project_id, [cached])
+            return
+
+        try:
+            # on_new_commits caches the latest one
+            self.sync.sync_project(project_id, project.get('default_branch'),
+                project.get('last_activity_at'))
+        except gitlab.api_errors as e:
+            self.warmup_errors[project_id] = e
+            self.logger.error('Unable to cache project %s commits: %s',
+                project_id, e)
+
+
+def new_gitlab_api():
+    return gitlab.GitLabApi(gc.gitlab['api_baseurl'],
+        gc.gitlab['private_token'], gc.gitlab['max_in_flight'],
+        gc.gitlab['pool_size'], gc.gitlab['max_validators'],
+        timeout=gc.gitlab['timeout'],
+        breaker_failures=gc.gitlab['breaker_failures'],
+        breaker_reset=gc.gitlab['breaker_reset'])
+
+
+def new_cache():
+    return cache.LRUCacher(gc.cache['expired'], gc.cache['max_entries'],
+        gc.cache['max_bytes'], grace=gc.cache['stale'])
+
+
+def new_host(networks):
+    '''
+        BotHost running an OupengBot per network, all of them sharing one
+        GitLab client and one cache, warmed up once.
+    '''
+    gitlab_api = new_gitlab_api()
+    shared = {}
+
+    def bot_factory(nickname):
+        # the first bot warms the cache and the indexes up, and keeps
+        # them up to date for all of them
+        bot = OupengBot(nickname, gitlab_api, shared.get('cache'),
+            shared.get('projects'), shared.get('commits'), shared.get('sync'),
+            shared.get('latest_commits'))
+        shared['cache'] = bot.cache
+        shared['projects'] = bot.projects
+        shared['commits'] = bot.commits
+        shared['sync'] = bot.sync
+        shared['latest_commits'] = bot.latest_commits
+        return bot
+
+    host = BotHost(bot_factory)
+    for network in networks:
+        host.add_network(network['server'], network['port'],
+            network['nickname'], network['channels'])
+
+    return host
+
+
+class FakeGitLabApi(object):
+    def __init__(self, projects, commits):
+        self.projects = projects
+        # project id => commits, newest first
+        self.commits = commits
+        self.requests = []
+
+    def iter_projects(self):
+        return iter(self.projects)
+
+    def get_project_commits(self, project_id, ref_name=None, since=None):
+        from addons.sync import FakeResponse
+
+        self.requests.append(('commits', project_id, since))
+        return FakeResponse([commit for commit in self.commits[project_id]
+            if since is None or commit['created_at'] >= since])
+
+
+class testOupengBot(unittest.TestCase):
+    def setUp(self):
+        # no snapshot, web hooks server nor periodic sync
+        self.settings = (gc.cache['snapshot'], gc.webhook['listen'],
+            gc.gitlab['sync_interval'], gc.gitlab['warmup_concurrency'],
+            gc.gitlab['warmup_budget'])
+        gc.cache['snapshot'] = gc.webhook['listen'] = None
+        gc.gitlab['sync_interval'] = None
+
+        self.api = FakeGitLabApi([
+            {'id': 1, 'name': 'ircbot', 'default_branch': 'master',
+                'last_activity_at': '2013-02-02', 'owner': {'name': 'xpen'}},
+            {'id': 2, 'name': 'browser', 'default_branch': 'master',
+                'last_activity_at': '2013-01-01', 'owner': {'name': 'alice'}},
+        ], {
+            1: [{'id': 'b' * 40, 'title': 'Fix the reconnect',
+                'author_name': 'xpen', 'created_at': '2013-02-02'}],
+            2: [{'id': 'a' * 40, 'title': 'Fix rendering',
+                'author_name': 'xpen', 'created_at': '2013-01-01'}],
+        })
+
+    def tearDown(self):
+        (gc.cache['snapshot'], gc.webhook['listen'],
+            gc.gitlab['sync_interval'], gc.gitlab['warmup_concurrency'],
+            gc.gitlab['warmup_budget']) = self.settings
+
+    def testWarmUp(self):
+        gc.gitlab['warmup_concurrency'] = 1
+        # no commits for it, its failure is kept
+        self.api.projects.append({'id': 3, 'name': 'gone',
+            'last_activity_at': '2013-03-03', 'owner': {'name': 'xpen'}})
+
+        bot = OupengBot('bot', self.api)
+        # serving already
+        self.assertFalse(bot.warmup.ready())
+        bot.warmup.join()
+
+        # most recently active first
+        self.assertEqual(self.api.requests, [('commits', 3, None),
+            ('commits', 1, None), ('commits', 2, None)])
+        self.assertEqual(list(bot.warmup_errors), [3])
+        self.assertEqual(bot.cache.get(1)['id'], 'b' * 40)
+        self.assertEqual(bot.cache.get(2)['id'], 'a' * 40)
+
+    def testWarmUpBudget(self):
+        gc.gitlab['warmup_concurrency'] = 1
+        gc.gitlab['warmup_budget'] = 0.05
+
+        get_project_commits = self.api.get_project_commits
+
+        def slow_commits(*args, **kwargs):
+            gevent.sleep(0.04)
+            return get_project_commits(*args, **kwargs)
+
+        self.api.get_project_commits = slow_commits
+
+        bot = OupengBot('bot', self.api)
+        bot.warmup.join(1)
+
+        # the second fetch is cut short
+        self.assertTrue(bot.warmup.ready())
+        self.assertEqual(self.api.requests, [('commits', 1, None)])
+        self.assertIsNone(bot.cache.get(2))
+
+    def testProjects(self):
+        bot = OupengBot('bot', self.api)
+        try:
+            lines = list(bot.get_gitlab_projects(page_size=1))
+        finally:
+            bot.stop_workers()
+
+        self.assertEqual(lines, ['project name: ircbot, id: 1, owner: xpen',
+            'project name: browser, id: 2, owner: alice'])
+        self.assertEqual(len(bot.projects), 2)
+
+    def testPush(self):
+        bot = OupengBot('bot', self.api)
+        bot.warmup.join()
+
+        bot.on_push({'object_kind': 'push', 'project_id': 1,
+            'ref': 'refs/heads/master',
+            'project': {'default_branch': 'master'},
+            'commits': [
+                {'id': 'c' * 40, 'message': 'Pushed first\n\nbody',
+                    'timestamp': '2013-03-03', 'author': {'name': 'xpen'}},
+                {'id': 'd' * 40, 'message': 'Pushed last',
+                    'timestamp': '2013-04-04', 'author': {'name': 'alice'}},
+            ]})
+
+        self.assertEqual(bot.cache.get(1)['title'], 'Pushed last')
+        self.assertEqual(bot.sync.latest(1)['id'], 'd' * 40)
+        self.assertEqual(list(bot.search_commits('pushed')), [
+            'project: ircbot, commit: ddddddddddd, commiter: alice, message: Pushed last',
+            'project: ircbot, commit: ccccccccccc, commiter: xpen, message: Pushed first'])
+
+        # another branch: indexed, the latest commit stays
+        bot.on_push({'object_kind': 'push', 'project_id': 1,
+            'ref': 'refs/heads/topic',
+            'project': {'default_branch': 'master'},
+            'commits': [{'id': 'e' * 40, 'message': 'Topic',
+                'timestamp': '2013-05-05', 'author': {'name': 'bob'}}]})
+
+        self.assertEqual(bot.cache.get(1)['title'], 'Pushed last')
+        self.assertEqual(len(list(bot.search_commits('topic'))), 1)
+        # known from the warmup, nothing more asked
+        self.assertEqual(sorted(self.api.requests), [('commits', 1, None),
+            ('commits', 2, None)])
+
+    def testSaveSnapshot(self):
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        try:
+            bot = OupengBot('bot', self.api)
+            bot.warmup.join()
+            bot.snapshot = snapshot.CacheSnapshot(path)
+
+            # the loop goes on while the snapshot is written
+            ticks = []
+            ticker = gevent.spawn(lambda: [ticks.append(gevent.sleep(0.001))
+                for _ in range(1000)])
+            writer = bot.snapshot.write
+
+            def slow_write(entries):
+                time.sleep(0.05)
+                return writer(entries)
+
+            bot.snapshot.write = slow_write
+            bot.save_snapshot()
+            ticker.kill()
+
+            restored = new_cache()
+            snapshot.CacheSnapshot(path).load(restored)
+        finally:
+            os.remove(path)
+
+        self.assertTrue(ticks)
+        self.assertEqual(restored.get(1)['id'], 'b' * 40)
+
+    def testHost(self):
+        global new_gitlab_api
+        former, new_gitlab_api = new_gitlab_api, lambda: self.api
+        try:
+            host = new_host([
+                {'server': 'irc.dev', 'port': 6667, 'nickname': 'bot',
+                    'channels': {'#dev': {}}},
+                {'server': 'irc.other', 'port': 6667, 'nickname': 'bot2',
+                    'channels': {'#other': {'reply_privately': False}}},
+            ])
+        finally:
+            new_gitlab_api = former
+
+        (first, _, _, _), (second, _, _, channels) = host.networks
+        first.warmup.join()
+
+        for name in ('gitlab_api', 'cache', 'projects', 'commits', 'sync',
+                'latest_commits'):
+            self.assertIs(getattr(first, name), getattr(second, name))
+        self.assertFalse(channels['#other'].reply_privately)
+
+        # warmed up once, for both
+        self.assertEqual(sorted(self.api.requests), [('commits', 1, None),
+            ('commits', 2, None)])
+        self.assertEqual(len(list(second.search_commits('fix'))), 2)
+
+    def testSnapshotSearch(self):
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        try:
+            former = new_cache()
+            former.set(1, {'id': 'c' * 40, 'title': 'Restored commit',
+                'author_name': 'xpen', 'created_at': '2013-03-03'})
+            snapshot.CacheSnapshot(path).save(former)
+
+            bot = OupengBot('bot', self.api)
+            # as init_cache_snapshot, before the warmup runs
+            snapshot.CacheSnapshot(path).load(bot.cache)
+            bot.warmup.join()
+        finally:
+            os.remove(path)
+
+        self.assertEqual(self.api.requests, [('commits', 2, None)])
+        self.assertEqual(list(bot.search_commits('restored')), [
+            'project: ircbot, commit: ccccccccccc, commiter: xpen, message: Restored commit'])
+        self.assertEqual(len(list(bot.search_commits('fix'))), 1)
+
+
 if '__main__' == __name__:
-    bot = OupengBot(gc.irc['nickname'])
-    bot.connect_ircserver(gc.irc['server'], gc.irc['port'])
-    bot.join_channel(gc.irc['channel'])
+    # before the bots get the logger
+    get_logger('ircconnection.logger', gc.log['file'], gc.log['verbosity'],
+        gc.log['levels'], gc.log['sample'])
+
+    if gc.networks:
+        new_host(gc.networks).serve_forever()
+
+    else:
+        bot = OupengBot(gc.irc['nickname'])
+        bot.run(gc.irc['server'], gc.irc['port'], gc.irc['channel'])
@@ -0,0 +1,138 @@
+# -*- coding: utf8 -*-
+
+import unittest
+from collections import deque
+
+from tools import TokenBucket
+
+
+class OutboundQueue(object):
+    '''
+        Per-connection outbound queue, drained by a single writer.
+
+        Every line queued since the last write goes out in one write call, as
+        far as the token bucket allows. Control traffic (PONG, NICK, ...)
+        jumps the queue and is never held back by the bucket.
+
+        The writer itself depends on the connection engine, see
+        ircbots.GeventOutboundQueue and aioircbots.AsyncOutboundQueue.
+    '''
+    control_commands = frozenset(['PONG', 'PING', 'PASS', 'NICK', 'USER',
+        'JOIN', 'PART', 'QUIT'])
+
+    def __init__(self, write, bucket=None, logger=None):
+        self._write = write
+        self.bucket = bucket
+        self.logger = logger
+
+        self._control = deque()
+        self._lines = deque()
+
+    def __len__(self):
+        return len(self._control) + len(self._lines)
+
+    def put(self, line):
+        command = line.split(' ', 1)[0].upper()
+
+        if command in self.control_commands:
+            self._control.append(line)
+        else:
+            self._lines.append(line)
+
+        self._notify()
+
+    def discard_control(self):
+        '''
+            Drop the control traffic of a lost connection, the other lines
+            are kept for the next one.
+        '''
+        self._control.clear()
+
+    def start(self):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def _notify(self):
+        ''' Wake the writer up, a line has been queued. '''
+        raise NotImplementedError
+
+    def _next_batch(self):
+        '''
+            Return the lines to write now and how many of them, at the
+            beginning, are control traffic.
+        '''
+        batch = list(self._control)
+        self._control.clear()
+
+        count = len(self._lines)
+        if self.bucket is not None:
+            self.bucket.take(len(batch), force=True)
+            count = self.bucket.take(count)
+
+        control = len(batch)
+        for _ in range(count):
+            batch.append(self._lines.popleft())
+
+        return batch, control
+
+    def _next_timeout(self):
+        ''' Seconds the writer may sleep before the next batch, None for ever. '''
+        if self._lines:
+            return self.bucket.delay()
+        return None
+
+    def _write_failed(self, batch, control, error):
+        # keep the unsent lines for the next connection, control traffic
+        # is bound to the dead one
+        self._lines.extendleft(reversed(batch[control:]))
+        if self.logger:
+            self.logger.error('Unable to send: %s', error)
+
+
+class testOutboundQueue(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.queue = OutboundQueue(None, TokenBucket(2, 3, clock=lambda: self.now))
+        self.queue._notify = lambda: None
+
+    def testBatching(self):
+        for i in range(5):
+            self.queue.put('PRIVMSG xpen :%d\r\n' % i)
+
+        batch, control = self.queue._next_batch()
+        self.assertEqual(control, 0)
+        self.assertEqual(batch, ['PRIVMSG xpen :%d\r\n' % i for i in range(3)])
+        self.assertEqual(self.queue._next_timeout(), 0.5)
+
+    def testControlFirst(self):
+        for i in range(5):
+            self.queue.put('PRIVMSG xpen :%d\r\n' % i)
+        self.queue.put('PONG :server\r\n')
+
+        batch, control = self.queue._next_batch()
+        self.assertEqual(control, 1)
+        self.assertEqual(batch[0], 'PONG :server\r\n')
+        self.assertEqual(len(batch), 3)
+
+    def testWriteFailed(self):
+        self.queue.put('PRIVMSG xpen :0\r\n')
+        self.queue.put('PONG :server\r\n')
+
+        batch, control = self.queue._next_batch()
+        self.queue._write_failed(batch, control, IOError('broken pipe'))
+        self.assertEqual(list(self.queue._lines), ['PRIVMSG xpen :0\r\n'])
+        self.assertEqual(len(self.queue), 1)
+
+    def testDiscardControl(self):
+        self.queue.put('PRIVMSG xpen :0\r\n')
+        self.queue.put('JOIN #channel\r\n')
+
+        self.queue.discard_control()
+        batch, control = self.queue._next_batch()
+        self.assertEqual((batch, control), (['PRIVMSG xpen :0\r\n'], 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+# -*- coding: utf8 -*-
+
+import unittest
+
+
+# rfc2812: 512 bytes per line, CRLF included. The server prepends
+# :nick!user@host to the lines it relays, and targets are at most 50
+# characters long
+max_line_bytes = 512
+prefix_reserve = 100
+max_target = 50
+
+# bytes of text a PRIVMSG line can carry to any target
+reply_bytes = max_line_bytes - 2 - len('PRIVMSG  :') - max_target - prefix_reserve
+
+
+def split_utf8(text, size):
+    '''
+        Yield the pieces of text, at most size bytes long once encoded,
+        without cutting any character.
+    '''
+    # a piece must hold any character, or no cut moves forward
+    if size < 4:
+        raise ValueError('Pieces of %d bytes cannot hold a character' % size)
+
+    data = text.encode('utf-8')
+
+    while len(data) > size:
+        cut = size
+        # continuation bytes are 10xxxxxx
+        while cut > 0 and (ord(data[cut:cut + 1]) & 0xC0) == 0x80:
+            cut -= 1
+
+        yield data[:cut].decode('utf-8')
+        data = data[cut:]
+
+    if data:
+        yield data.decode('utf-8')
+
+
+def pack_lines(items, size, separator=' | '):
+    '''
+        Yield lines of at most size bytes, each holding as many items as
+        fit, long items are split. Items are read only as lines are needed.
+    '''
+    line = []
+    line_size = 0
+    separator_size = len(separator.encode('utf-8'))
+
+    for item in items:
+        # a line break would end the IRC line
+        item = ('%s' % item).replace('\r', ' ').replace('\n', ' ')
+        item_size = len(item.encode('utf-8'))
+
+        if line and line_size + separator_size + item_size <= size:
+            line.append(item)
+            line_size += separator_size + item_size
+            continue
+
+        if line:
+            yield separator.join(line)
+
+        line = []
+        line_size = 0
+        for piece in split_utf8(item, size):
+            if line:
+                yield line[0]
+            line = [piece]
+            line_size = len(piece.encode('utf-8'))
+
+    if line:
+        yield separator.join(line)
+
+
+class PagedReply(object):
+    '''
+        The packed lines of a result, produced as the readers need them.
+    '''
+    def __init__(self, items, size=reply_bytes):
+        self._source = pack_lines(items, size)
+        self.lines = []
+        self.exhausted = False
+
+    def line(self, index):
+        ''' Line at index, None past the last one. '''
+        while len(self.lines) <= index and not self.exhausted:
+            try:
+                self.lines.append(next(self._source))
+            except StopIteration:
+                self.exhausted = True
+
+        if index < len(self.lines):
+            return self.lines[index]
+
+
+class Cursor(object):
+    ''' A reader's position in a PagedReply. '''
+    __slots__ = ('reply', 'position')
+
+    def __init__(self, reply, position=0):
+        self.reply = reply
+        self.position = position
+
+    def page(self, count=None):
+        ''' Yield the next count lines, all of them if count is None. '''
+        while count is None or count > 0:
+            line = self.reply.line(self.position)
+            if line is None:
+                return
+
+            self.position += 1
+            if count is not None:
+                count -= 1
+            yield line
+
+    def more(self):
+        return self.reply.line(self.position) is not None
+
+
+class testReplies(unittest.TestCase):
+    def testSplitUtf8(self):
+        pieces = list(split_utf8(u'aé中文b', 4))
+        self.assertEqual(pieces, [u'aé', u'中', u'文b'])
+        self.assertTrue(all(len(piece.encode('utf-8')) <= 4 for piece in pieces))
+
+        self.assertRaises(ValueError, list, split_utf8(u'中', 2))
+        self.assertRaises(ValueError, list, split_utf8(u'ab', 0))
+
+    def testPackLines(self):
+        lines = list(pack_lines(['ab', 'cd', 'ef', 'x' * 12, 'gh'], 10))
+        self.assertEqual(lines, ['ab | cd', 'ef', 'xxxxxxxxxx', 'xx | gh'])
+
+    def testCursor(self):
+        generated = []
+
+        def items():
+            for i in range(10):
+                generated.append(i)
+                yield 'item %d' % i
+
+        reply = PagedReply(items(), 6)
+        cursor = Cursor(reply)
+        self.assertEqual(list(cursor.page(3)), ['item 0', 'item 1', 'item 2'])
+        # one item ahead, to know a line is full
+        self.assertEqual(generated, [0, 1, 2, 3])
+        self.assertTrue(cursor.more())
+
+        other = Cursor(reply, 1)
+        self.assertEqual(list(other.page(2)), ['item 1', 'item 2'])
+        self.assertEqual(len(list(cursor.page())), 7)
+        self.assertFalse(cursor.more())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+# -*- coding: utf8 -*-
+
+import unittest
+
+import gevent
+from gevent import GreenletExit
+from gevent.queue import Queue
+
+
+class Lane(object):
+    '''
+        A queue of jobs, run by `concurrency` worker greenlets, with at most
+        max_queue jobs waiting for a worker.
+    '''
+    def __init__(self, name, concurrency, max_queue, logger=None):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.logger = logger
+
+        self.queue = Queue()
+        self.running = 0
+        self._workers = []
+
+    def submit(self, func, *args, **kwargs):
+        ''' Queue func, return False if the lane is overloaded. '''
+        if not self._workers:
+            self.start()
+
+        # jobs put since the workers last ran are still in the queue
+        waiting = self.queue.qsize() + self.running - self.concurrency
+        if waiting >= self.max_queue:
+            return False
+
+        self.queue.put_nowait((func, args, kwargs))
+        return True
+
+    def start(self):
+        self._workers = [gevent.spawn(self._work)
+            for _ in range(self.concurrency)]
+
+    def kill(self):
+        gevent.killall(self._workers)
+        self._workers = []
+
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+
+            self.running += 1
+            try:
+                func(*args, **kwargs)
+            except GreenletExit:
+                raise
+            except BaseException as e:
+                # GitLabApi exceptions derive from BaseException
+                if self.logger:
+                    self.logger.error('Exception in %s lane: %s', self.name, e)
+            finally:
+                self.running -= 1
+
+
+class Scheduler(object):
+    '''
+        Runs jobs in separate lanes, each with its own concurrency and
+        queue bound, so slow jobs of one lane never hold the others (nor the
+        reader greenlet) up.
+
+        lanes maps lane names to (concurrency, max queued jobs).
+    '''
+    def __init__(self, lanes, logger=None):
+        self.lanes = dict((name, Lane(name, concurrency, max_queue, logger))
+            for name, (concurrency, max_queue) in lanes.items())
+
+    def submit(self, lane, func, *args, **kwargs):
+        return self.lanes[lane].submit(func, *args, **kwargs)
+
+    def kill(self):
+        for lane in self.lanes.values():
+            lane.kill()
+
+
+class testScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler({'orders': (2, 2), 'other': (1, 1)})
+        self.done = []
+
+    def job(self, name, duration=0.01):
+        gevent.sleep(duration)
+        self.done.append(name)
+
+    def testConcurrency(self):
+        for i in range(4):
+            self.assertTrue(self.scheduler.submit('orders', self.job, i))
+
+        gevent.sleep(0)
+        self.assertEqual(self.scheduler.lanes['orders'].running, 2)
+
+        gevent.sleep(0.05)
+        self.assertEqual(sorted(self.done), [0, 1, 2, 3])
+
+    def testShedding(self):
+        results = [self.scheduler.submit('orders', self.job, i) for i in range(6)]
+        gevent.sleep(0)
+        results.extend(self.scheduler.submit('orders', self.job, i) for i in range(6, 9))
+
+        # 2 running, 2 waiting
+        self.assertEqual(results, [True] * 4 + [False] * 5)
+
+        # other lanes are not affected
+        self.assertTrue(self.scheduler.submit('other', self.job, 'other'))
+        gevent.sleep(0.05)
+        self.assertIn('other', self.done)
+
+    def testErrors(self):
+        def fail():
+            raise KeyError('boom')
+
+        self.scheduler.submit('orders', fail)
+        self.scheduler.submit('orders', self.job, 'after')
+        gevent.sleep(0.05)
+        self.assertEqual(self.done, ['after'])
+
+    def tearDown(self):
+        self.scheduler.kill()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,9 +5,134 @@ irc = {
     'port': 6667,
     'channel': '',
     'nickname': '',
+    # flood control: lines per second, and the size of a burst
+    'send_rate': 1,
+    'send_burst': 5,
+    # orders run order_concurrency at once, with at most order_queue more
+    # waiting, the next ones are answered busy
+    'order_concurrency': 10,
+    'order_queue': 50,
+    # token buckets on orders, per sender and per channel: handler name
+    # ('help' for the help sent on invalid orders, '*' for all of them) =>
+    # sender_rate, sender_burst, channel_rate, channel_burst (orders per
+    # second, None for no limit), see limits.default_limits
+    'order_limits': {
+        'get_gitlab_projects': {'sender_rate': 1.0 / 60, 'sender_burst': 1},
+    },
+    # identical orders asked less than merge_window seconds apart are
+    # answered by one execution
+    'merge_window': 5,
+    # replies are packed in lines of at most 512 bytes, and stop after
+    # page_lines lines (None for no limit), the more order continues them
+    'page_lines': 10,
+    # a lost connection is opened again after a random delay, up to
+    # reconnect_delay * 2 ** attempts seconds and at most reconnect_max_delay
+    'reconnect_delay': 1,
+    'reconnect_max_delay': 300,
+    # the server is sent a PING after idle_timeout seconds without a line,
+    # and the connection is lost if none comes idle_timeout seconds more
+    'idle_timeout': 120,
+    # seconds an order may take from when it is asked, by handler name ('*'
+    # for the others, None for no limit), it is answered timed out then
+    'order_deadlines': {
+        '*': 30,
+        'get_gitlab_projects': 60,
+    },
+    # worker processes serving the orders registered cpu_heavy
+    'cpu_workers': 2,
+    # nicks allowed to ask the admin orders (metrics), use nicks the
+    # server reserves to their owners
+    'admins': [],
 }
 
+# logging is written by a thread, off the event loop. levels sets the
+# verbosity of the categories (traffic: the raw lines in and out), sample
+# the fraction of their records which is kept
+log = {
+    'file': None,
+    'verbosity': 'INFO',
+    'levels': {'traffic': 'INFO'},
+    'sample': {'traffic': 1},
+}
+
+# run the bot on several networks and channels in one process, irc above is
+# used if this is empty. channels maps channel names to their policy: the
+# orders (handler names) served there, None for all of them, and whether
+# replies are sent privately
+networks = [
+    # {
+    #     'server': 'irc.freenode.net',
+    #     'port': 6667,
+    #     'nickname': 'bot',
+    #     'channels': {
+    #         '#dev': {},
+    #         '#ops': {'orders': ['get_project_commit'], 'reply_privately': False},
+    #     },
+    # },
+]
+
 gitlab = {
     'api_baseurl' : '',
     'private_token' : '',
+    # at most max_in_flight requests at once to the gitlab host, over at
+    # most pool_size keep-alive connections
+    'max_in_flight': 10,
+    'pool_size': 10,
+    # the commits cache is warmed up in the background, with at most
+    # warmup_concurrency requests at once, and for at most warmup_budget
+    # seconds (None for no limit)
+    'warmup_concurrency': 8,
+    'warmup_budget': 300,
+    # seconds to connect, and to wait for the next bytes of a response
+    'timeout': 10,
+    # after breaker_failures failures in a row (timeouts, errors, 5xx) an
+    # endpoint is not called for breaker_reset seconds: the last responses
+    # are served instead, if any
+    'breaker_failures': 5,
+    'breaker_reset': 30,
+    # the validators (ETag/Last-Modified) and bodies of the last responses
+    # are kept for the max_validators urls used last
+    'max_validators': 1000,
+    # after the warmup, the commits of the projects whose last_activity_at
+    # moved are fetched every sync_interval seconds, only the ones since
+    # the last known commit (None not to sync)
+    'sync_interval': 300,
+}
+
+# commits cache: entries live for `expired` seconds, at most max_entries
+# entries and max_bytes bytes are kept (None for no limit). Entries expired
+# less than `stale` seconds ago are still answered, while being refreshed
+cache = {
+    'expired': 60,
+    'stale': 60,
+    'max_entries': 10000,
+    'max_bytes': 64 * 1024 * 1024,
+    # SQLite file the cache is saved to, every snapshot_interval seconds and
+    # at exit, and loaded from at startup (None to disable)
+    'snapshot': 'cache.sqlite',
+    'snapshot_interval': 300,
+}
+
+# search commits order: the commits seen (warmup, lookups, pushes) are
+# indexed, at most max_commits of them, and max_results are answered
+search = {
+    'max_commits': 50000,
+    'max_results': 20,
+}
+
+# GitLab web hooks endpoint (push and system hooks), e.g. ('0.0.0.0', 8088),
+# None to disable. With it the cache is kept current on push, and
+# cache['expired'] above can be raised. Requests must carry token in their
+# X-Gitlab-Token header, it must be set to enable the web hooks, and have a
+# body of at most max_body bytes
+webhook = {
+    'listen': None,
+    'token': '',
+    'max_body': 1024 * 1024,
+}
+
+# counters and latencies, see metrics.py: served at path by the web hooks
+# server (None not to), and by the metrics order
+metrics = {
+    'path': '/metrics',
 }
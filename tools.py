@@ -1,7 +1,11 @@
 # -*- coding: utf8 -*-
 
+import time
+import atexit
+import random
 import logging
-from logging.handlers import RotatingFileHandler
+import unittest
+from logging.handlers import QueueHandler, RotatingFileHandler
 
 # mapping for logging verbosity
 verbosity_map = {
@@ -10,20 +14,272 @@ verbosity_map = {
     'DEBUG': logging.DEBUG,
 }
 
+# logger name => its LogWriter
+_writers = {}
 
-def get_logger(logger_name, logfile, verbosity):
+
+def _os_threading():
+    '''
+        Queue, locks and thread starter of the OS threads, the original
+        ones if gevent monkey patched them.
+    '''
+    try:
+        from gevent.monkey import get_original
+    except ImportError:
+        import queue
+        import _thread
+        return (queue.SimpleQueue, _thread.allocate_lock, _thread.RLock,
+            _thread.start_new_thread)
+
+    return (get_original('queue', 'SimpleQueue'),
+        get_original('_thread', 'allocate_lock'),
+        get_original('_thread', 'RLock'),
+        get_original('_thread', 'start_new_thread'))
+
+
+class LogWriter(object):
+    '''
+        Formats and writes the records queued by LazyQueueHandler in an OS
+        thread (a real one even under gevent), so file and stream I/O never
+        stall the event loop.
+    '''
+    def __init__(self, handlers):
+        SimpleQueue, allocate_lock, RLock, start_new_thread = _os_threading()
+
+        self.queue = SimpleQueue()
+        self.handlers = handlers
+        for handler in handlers:
+            # only the writer thread uses the handlers
+            handler.lock = RLock()
+
+        self._done = allocate_lock()
+        self._done.acquire()
+        self._running = True
+        start_new_thread(self._run, ())
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+        self._done.release()
+
+    def stop(self):
+        ''' Write the queued records and stop the thread. '''
+        if self._running:
+            self._running = False
+            self.queue.put(None)
+            self._done.acquire()
+
+
+class LazyQueueHandler(QueueHandler):
+    '''
+        Queues the records as they are, the message is formatted by the
+        LogWriter: arguments must not be modified after the logging call.
+    '''
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
+class SampleFilter(logging.Filter):
+    ''' Keeps a fraction of the records, evenly spread. '''
+    def __init__(self, fraction):
+        logging.Filter.__init__(self)
+        self.fraction = fraction
+        self._credit = 1.0 - fraction
+
+    def filter(self, record):
+        self._credit += self.fraction
+        if self._credit < 1:
+            return False
+
+        self._credit -= 1
+        return True
+
+
+def get_logger(logger_name, logfile, verbosity, levels=None, sample=None):
+    '''
+        Configure logger_name on the first call, later calls return it as
+        is: each call used to add its handlers again.
+
+        levels maps categories, the child loggers as logger_name.traffic,
+        to their verbosity, and sample to the fraction of their records
+        which is kept.
+    '''
     log = logging.getLogger(logger_name)
+    if logger_name in _writers:
+        return log
+
     log.setLevel(verbosity_map.get(verbosity, logging.INFO))
-    
+
+    handlers = []
     if logfile:
         handler = RotatingFileHandler(logfile, maxBytes=1024*1024, backupCount=2)
         handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-        log.addHandler(handler)
+        handlers.append(handler)
     
     if verbosity == 'INFO' or not logfile:
         stream_handler = logging.StreamHandler()
         stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-        log.addHandler(stream_handler)
+        handlers.append(stream_handler)
+
+    writer = _writers[logger_name] = LogWriter(handlers)
+    atexit.register(writer.stop)
+    log.addHandler(LazyQueueHandler(writer.queue))
+
+    for category, level in (levels or {}).items():
+        child = log.getChild(category)
+        child.setLevel(verbosity_map.get(level, logging.INFO))
+
+    for category, fraction in (sample or {}).items():
+        if fraction < 1:
+            log.getChild(category).addFilter(SampleFilter(fraction))
     
     return log
 
+
+class TokenBucket(object):
+    '''
+        Flood control: `rate` lines per second on average, with bursts of
+        at most `burst` lines.
+    '''
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+
+        self._clock = clock
+        self._last = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def take(self, wanted, force=False):
+        '''
+            Take up to `wanted` tokens and return how many were taken.
+            With force, all of them are taken, even if that puts the bucket
+            in debt.
+        '''
+        self._refill()
+
+        taken = wanted if force else max(0, min(wanted, int(self.tokens)))
+        self.tokens -= taken
+
+        return taken
+
+    def delay(self, wanted=1):
+        ''' Seconds until `wanted` tokens are available. '''
+        self._refill()
+        return max(0.0, (wanted - self.tokens) / self.rate)
+
+
+class Backoff(object):
+    '''
+        Jittered exponential backoff: the n-th delay is drawn between 0 and
+        min(max_delay, delay * 2 ** n), so that many clients dropped at once
+        don't come back at once.
+    '''
+    def __init__(self, delay=1, max_delay=300, random=random.random):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.attempts = 0
+
+        self._random = random
+
+    def next(self):
+        ceiling = min(self.max_delay, self.delay * 2 ** self.attempts)
+        if ceiling < self.max_delay:
+            self.attempts += 1
+
+        return self._random() * ceiling
+
+    def reset(self):
+        self.attempts = 0
+
+
+class testTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.bucket = TokenBucket(2, 5, clock=lambda: self.now)
+
+    def testBurst(self):
+        self.assertEqual(self.bucket.take(10), 5)
+        self.assertEqual(self.bucket.take(1), 0)
+        self.assertEqual(self.bucket.delay(), 0.5)
+
+    def testRefill(self):
+        self.bucket.take(5)
+        self.now += 1
+        self.assertEqual(self.bucket.take(10), 2)
+
+        self.now += 100
+        self.assertEqual(self.bucket.take(10), 5)
+
+    def testForce(self):
+        self.assertEqual(self.bucket.take(7, force=True), 7)
+        self.assertEqual(self.bucket.delay(), 1.5)
+
+
+class testBackoff(unittest.TestCase):
+    def testDelays(self):
+        backoff = Backoff(1, 10, random=lambda: 1)
+        self.assertEqual([backoff.next() for _ in range(6)], [1, 2, 4, 8, 10, 10])
+
+        backoff.reset()
+        self.assertEqual(backoff.next(), 1)
+
+    def testJitter(self):
+        backoff = Backoff(1, 10, random=lambda: 0.5)
+        self.assertEqual([backoff.next() for _ in range(3)], [0.5, 1, 2])
+
+
+class testLogging(unittest.TestCase):
+    def testGetLogger(self):
+        import os
+        import tempfile
+
+        logfile = os.path.join(tempfile.mkdtemp(), 'test.log')
+        log = get_logger('tools.test', logfile, 'ERROR',
+            levels={'traffic': 'DEBUG'}, sample={'traffic': 0.5})
+        self.assertIs(get_logger('tools.test', None, 'INFO'), log)
+        self.assertEqual(len(log.handlers), 1)
+
+        log.info('dropped')
+        log.error('kept %s', 1)
+        for i in range(4):
+            log.getChild('traffic').debug('line %d', i)
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            log.error('failed', exc_info=1)
+
+        _writers['tools.test'].stop()
+        with open(logfile) as f:
+            content = f.read()
+
+        self.assertNotIn('dropped', content)
+        self.assertIn('kept 1', content)
+        self.assertIn('line 0', content)
+        self.assertNotIn('line 1', content)
+        self.assertIn('line 2', content)
+        self.assertIn('ZeroDivisionError', content)
+
+    def testSampleFilter(self):
+        sample = SampleFilter(0.25)
+        kept = [sample.filter(None) for _ in range(8)]
+        self.assertEqual(kept, [True, False, False, False] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
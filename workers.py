@@ -0,0 +1,73 @@
+# -*- coding: utf8 -*-
+'''
+    Worker processes for the CPU heavy orders (see IRCProtocol.register_order)
+    and steps of orders (see IRCProtocol.offload), which would hold the event
+    loop, and every connection with it, up.
+
+    What runs in another process must be a module level function, with
+    picklable arguments and results, and can't use the bot.
+'''
+
+import types
+import pickle
+import unittest
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def new_process_pool(workers):
+    # spawned, not forked: the children don't inherit the event loop
+    return ProcessPoolExecutor(workers,
+        mp_context=multiprocessing.get_context('spawn'))
+
+
+def check_handler(handler):
+    try:
+        pickle.dumps(handler)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        raise Exception('CPU heavy orders need a module level function')
+
+
+def call_handler(handler, kwargs):
+    ''' Run in a worker, generated results are listed there. '''
+    result = handler(**kwargs)
+    if isinstance(result, types.GeneratorType):
+        result = list(result)
+
+    return result
+
+
+def squares(count):
+    for i in range(int(count)):
+        yield '%d' % (i * i)
+
+
+class testWorkers(unittest.TestCase):
+    def testHeavyOrder(self):
+        import re
+        from ircprotocol import IRCProtocol
+
+        class FakeOutbound(list):
+            def put(self, line):
+                self.append(line.rstrip())
+
+        protocol = IRCProtocol('bot', cpu_workers=1)
+        protocol._outbound = FakeOutbound()
+        protocol.register_order([
+            (re.compile(r'^squares (?P<count>\d+)$'), squares, 'squares'),
+        ], cpu_heavy=True)
+
+        self.assertRaises(Exception, protocol.register_order, [
+            (re.compile(r'^lambda$'), lambda: 1, 'lambda'),
+        ], cpu_heavy=True)
+
+        try:
+            protocol.serve('xpen', 'squares 4')
+        finally:
+            protocol.stop_workers()
+
+        self.assertEqual(protocol._outbound, ['PRIVMSG xpen :0 | 1 | 4 | 9'])
+
+
+if __name__ == '__main__':
+    unittest.main()